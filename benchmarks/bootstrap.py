@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# This file is part of volian
+
+# volian is an installer for Debian or Ubuntu.
+# Copyright (C) 2021 Volitank
+
+# volian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# volian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with volian.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compares the native bootstrap against debootstrap.
+# Both install from a local stand-in for the mirror, a caching http server, so the
+# network isn't what we measure. The first run of each fills the stand-in and is left out.
+# usage: sudo python3 benchmarks/bootstrap.py [--mirror http://deb.debian.org/debian] [--release stable] [--runs 3] [--minimal]
+# Needs root, debootstrap, and the archive keyring for the native bootstrap.
+
+import argparse
+import sys
+from http.client import HTTPException
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from shutil import rmtree
+from socketserver import ThreadingMixIn
+from tempfile import mkdtemp
+from threading import Thread
+from time import perf_counter
+from urllib.parse import urlsplit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'volian'))
+
+from proxy import mirror_pool
+from native import native_bootstrap
+from bootstrap import debootstrap
+
+class stand_in(ThreadingMixIn, HTTPServer):
+	'serves the mirror from a local directory, filling it from upstream the first time a file is asked for'
+	daemon_threads = True
+
+class stand_in_handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		path = self.path.split('?')[0].lstrip('/')
+		local = self.server.dir / path
+		if not local.is_file():
+			try:
+				status, body = self.server.upstream.get(path)
+			except (OSError, HTTPException):
+				self.send_error(502)
+				return
+			if status != 200:
+				self.send_error(status)
+				return
+			# Index files change under us, so only packages are kept
+			if path.endswith('.deb'):
+				local.parent.mkdir(parents=True, exist_ok=True)
+				local.write_bytes(body)
+		else:
+			body = local.read_bytes()
+		self.send_response(200)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+def serve(upstream: str, directory: Path):
+	'starts the stand-in and returns its url'
+	parts = urlsplit(upstream)
+	server = stand_in(('127.0.0.1', 0), stand_in_handler)
+	server.dir = directory
+	server.upstream = mirror_pool(parts.netloc, parts.path, 16)
+	Thread(target=server.serve_forever, daemon=True).start()
+	return f"http://127.0.0.1:{server.server_address[1]}/"
+
+def run_native(distro, release, url, arch, minimal, work):
+	native = native_bootstrap(distro, release, url, arch, minimal, staging=work / 'staging')
+	native.install(work / 'target')
+	return native.timings
+
+def run_debootstrap(distro, release, url, arch, minimal, work):
+	debootstrap(release, work / 'target', url, minimal)
+	return {}
+
+def time_it(func, runs, root):
+	'returns (median, best, phases of the median run). The first run only warms the stand-in'
+	results = []
+	for run in range(runs + 1):
+		work = Path(mkdtemp(prefix='bench-', dir=root))
+		try:
+			start = perf_counter()
+			phases = func(work)
+			seconds = perf_counter() - start
+		finally:
+			rmtree(work, ignore_errors=True)
+		if run:
+			results.append((seconds, phases))
+	results.sort(key=lambda result: result[0])
+	median = results[len(results) // 2]
+	return median[0], results[0][0], median[1]
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--mirror', default='http://deb.debian.org/debian')
+	parser.add_argument('--distro', default='debian')
+	parser.add_argument('--release', default='stable')
+	parser.add_argument('--arch', default='amd64')
+	parser.add_argument('--runs', type=int, default=3)
+	parser.add_argument('--minimal', action='store_true')
+	parser.add_argument('--work', type=Path, default=Path('/tmp/volian-bench'))
+	argument = parser.parse_args()
+
+	argument.work.mkdir(parents=True, exist_ok=True)
+	url = serve(argument.mirror, argument.work / 'mirror')
+	args = (argument.distro, argument.release, url, argument.arch, argument.minimal)
+
+	results = {}
+	for name, func in (('native', run_native), ('debootstrap', run_debootstrap)):
+		results[name] = time_it(lambda work: func(*args, work), argument.runs, argument.work)
+
+	print(f"{'bootstrap:'.ljust(14)} {'median s:'.ljust(12)} {'best s:'.ljust(12)} phases:")
+	for name, (median, best, phases) in results.items():
+		detail = ', '.join(f"{phase} {seconds:.2f}s" for phase, seconds in phases.items())
+		print(f"{name.ljust(14)} {median:<12.2f} {best:<12.2f} {detail}")
+	print(f"speedup: {results['debootstrap'][0] / results['native'][0]:.1f}x")
+
+if __name__ == "__main__":
+	main()
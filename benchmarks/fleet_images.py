@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# This file is part of volian
+
+# volian is an installer for Debian or Ubuntu.
+# Copyright (C) 2021 Volitank
+
+# volian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# volian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with volian.  If not, see <https://www.gnu.org/licenses/>.
+
+# Times the fleet image path: making sparse images, attaching them to loop devices,
+# attaching them again and writing our partition table to each one.
+# It checks the images stay sparse, a second attach reuses the loop device, the partitions
+# show up and the volume group names are ones device mapper leaves alone.
+# usage: sudo python3 benchmarks/fleet_images.py [--count 3] [--size 8] [--dir /tmp/volian-fleet] [--keep]
+# Needs root, losetup and sfdisk. Exits 1 if a check fails.
+
+import argparse
+import sys
+from pathlib import Path
+from time import perf_counter, sleep
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'volian'))
+
+from fleet import install_target
+from partition import part_device
+from topology import disk_topology
+from utils import gig_to_byte
+from constant import BOOT_SIZE_M, EFI, ESP_SIZE_M, LINUX_BOOT, LINUX_LVM
+
+def partition(target):
+	'writes the partition table write_partition_table would and waits for the kernel to show the partitions'
+	topology = disk_topology(target.disk)
+	(esp_start, esp_sectors), (boot_start, boot_sectors), (lvm_start, lvm_sectors) = topology.layout([ESP_SIZE_M, BOOT_SIZE_M, None])
+	parts = (
+		f"{esp_start},{esp_sectors},{EFI}\n"
+		+f"{boot_start},{boot_sectors},{LINUX_BOOT}\n"
+		+f"{lvm_start},{lvm_sectors},{LINUX_LVM}"
+	)
+	target.shell.sfdisk.__quiet.__label.gpt(target.disk, input=parts)
+	# udev makes the nodes a little after the kernel reads the table
+	for _ in range(50):
+		if all(part_device(target.disk, number).is_block_device() for number in (1, 2, 3)):
+			return True
+		sleep(0.1)
+	return False
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--count', type=int, default=3)
+	parser.add_argument('--size', type=float, default=8, help="GB of each image")
+	parser.add_argument('--dir', type=Path, default=Path('/tmp/volian-fleet'))
+	parser.add_argument('--keep', action='store_true', help="leave the images attached")
+	argument = parser.parse_args()
+
+	argument.dir.mkdir(parents=True, exist_ok=True)
+	# The dash is on purpose. It has to be gone from the volume group name
+	targets = [install_target(argument.dir / f"rack-{number}.img", 'debian', argument.dir) for number in range(argument.count)]
+	failed = []
+	results = {}
+	made = []
+	try:
+		for target in targets:
+			if target.path.exists():
+				failed.append(f"{target.path} is left over from an earlier run. remove it first")
+		if failed:
+			return
+
+		for target in targets:
+			if '-' in target.volume:
+				failed.append(f"{target.volume} has a dash, device mapper would write it as --")
+
+		start = perf_counter()
+		for target in targets:
+			made.append(target)
+			target.attach(gig_to_byte(argument.size))
+		results['make and attach'] = perf_counter() - start
+
+		for target in targets:
+			# A new image shouldn't take any space until something is written to it
+			used = target.path.stat().st_blocks * 512
+			if used > 1024**2:
+				failed.append(f"{target.path} isn't sparse, it takes {used} bytes")
+
+		start = perf_counter()
+		disks = [target.disk for target in targets]
+		for target in targets:
+			target.attach()
+		results['attach again'] = perf_counter() - start
+		if disks != [target.disk for target in targets]:
+			failed.append(f"attaching again moved the loop devices from {disks} to {[target.disk for target in targets]}")
+
+		start = perf_counter()
+		for target in targets:
+			if not partition(target):
+				failed.append(f"the partitions of {target.disk} never showed up")
+		results['partition'] = perf_counter() - start
+
+		print(f"{'step:'.ljust(18)} {'total s:'.ljust(12)} {'per image s:'.ljust(12)}")
+		for name, seconds in results.items():
+			print(f"{name.ljust(18)} {seconds:<12.3f} {seconds / len(targets):<12.3f}")
+	finally:
+		# Only what we made is taken down again
+		if not argument.keep:
+			for target in made:
+				if target.disk is not None:
+					target.shell.losetup('-d', target.disk)
+				target.path.unlink(missing_ok=True)
+		for message in failed:
+			print(f"FAILED: {message}")
+		exit(1 if failed else 0)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# This file is part of volian
+
+# volian is an installer for Debian or Ubuntu.
+# Copyright (C) 2021 Volitank
+
+# volian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# volian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with volian.  If not, see <https://www.gnu.org/licenses/>.
+
+# Compares loading the mirror index straight from Mirrors.masterlist (cold)
+# against loading it from the compiled cache (warm).
+# usage: python3 benchmarks/mirror_cache.py [--runs 50] [--drop-caches]
+# --drop-caches needs root and drops the page cache before every cold run.
+
+import argparse
+import sys
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'volian'))
+
+from mirror import load_mirror_index, mirror_index, parse_mirror_data, parse_mirror_master
+
+def drop_caches():
+	with open('/proc/sys/vm/drop_caches', 'w') as file:
+		file.write('3\n')
+
+def time_it(func, runs, before=None):
+	times = []
+	for _ in range(runs):
+		if before:
+			before()
+		start = perf_counter()
+		func()
+		times.append(perf_counter() - start)
+	times.sort()
+	return times[len(times) // 2], times[0]
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--runs', type=int, default=50)
+	parser.add_argument('--drop-caches', action='store_true')
+	argument = parser.parse_args()
+
+	before = drop_caches if argument.drop_caches else None
+	with TemporaryDirectory() as tmp:
+		cache = Path(tmp) / 'mirrors.cache'
+
+		cold = time_it(lambda: mirror_index(parse_mirror_data(parse_mirror_master())), argument.runs, before)
+		# First call builds the cache, everything after it is a warm load
+		load_mirror_index(cache=cache)
+		warm = time_it(lambda: load_mirror_index(cache=cache), argument.runs, before)
+
+	print(f"{'load:'.ljust(8)} {'median ms:'.ljust(12)} {'best ms:'.ljust(12)}")
+	for name, (median, best) in (('cold', cold), ('warm', warm)):
+		print(f"{name.ljust(8)} {median * 1000:<12.3f} {best * 1000:<12.3f}")
+	print(f"speedup: {cold[0] / warm[0]:.1f}x")
+
+if __name__ == "__main__":
+	main()
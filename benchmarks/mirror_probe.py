@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# This file is part of volian
+
+# volian is an installer for Debian or Ubuntu.
+# Copyright (C) 2021 Volitank
+
+# volian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# volian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with volian.  If not, see <https://www.gnu.org/licenses/>.
+
+# Times the probe the user sees when picking a mirror by hand, against local mirrors that
+# answer quickly, slowly, too late, never, refuse the connection or are out of date.
+# The bandwidth benchmark auto does on top is timed as well, for comparison.
+# usage: python3 benchmarks/mirror_probe.py [--runs 3] [--delay 0.3] [--size 4]
+# Exits 1 if the wrong mirror is picked or a probe outlasts its timeout.
+
+import argparse
+import socket
+import sys
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os import urandom
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from threading import Thread
+from time import perf_counter, sleep
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'volian'))
+
+import mirror
+from mirror import bench_mirrors, mirror_index, mirror_site, probe_country
+from constant import PROBE_TIMEOUT
+
+RELEASE = 'stable'
+ARCH = 'amd64'
+
+class local_mirror(ThreadingMixIn, HTTPServer):
+	'a mirror that waits delay seconds before answering and whose InRelease is age old'
+	daemon_threads = True
+
+class local_mirror_handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		sleep(self.server.delay)
+		if self.path.endswith('/InRelease'):
+			date = format_datetime(datetime.now(timezone.utc) - self.server.age, usegmt=True)
+			body = f"Origin: Debian\nSuite: {RELEASE}\nDate: {date}\n".encode()
+		elif self.path.endswith('/Packages.xz'):
+			body = self.server.payload
+		else:
+			self.send_error(404)
+			return
+		try:
+			self.send_response(200)
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+		except OSError:
+			# The probe gave up on us
+			pass
+
+	def log_message(self, format, *args):
+		pass
+
+def serve(delay: float, payload: bytes, age: timedelta=timedelta()):
+	'starts a local mirror and returns its site'
+	server = local_mirror(('127.0.0.1', 0), local_mirror_handler)
+	server.delay = delay
+	server.payload = payload
+	server.age = age
+	Thread(target=server.serve_forever, daemon=True).start()
+	return f"127.0.0.1:{server.server_address[1]}"
+
+def dead():
+	'a mirror that takes the connection and never says anything. The socket is kept so the port stays open'
+	listener = socket.socket()
+	listener.bind(('127.0.0.1', 0))
+	listener.listen(64)
+	return f"127.0.0.1:{listener.getsockname()[1]}", listener
+
+def refused():
+	'a port nothing listens on'
+	with socket.socket() as closed:
+		closed.bind(('127.0.0.1', 0))
+		return f"127.0.0.1:{closed.getsockname()[1]}"
+
+def make_index(countries: dict):
+	'returns a mirror_index of countries, a dict of country name to its sites'
+	sites = []
+	for country, site_list in countries.items():
+		for site in site_list:
+			sites.append(mirror_site(site, 'XX', country, http='/debian/', arch=frozenset({ARCH})))
+	return mirror_index(sites)
+
+def time_it(func, runs):
+	'returns (median, worst, result of the last run). Probes are cached for a run, so the cache is emptied first'
+	times = []
+	for _ in range(runs):
+		mirror._release_cache.clear()
+		start = perf_counter()
+		result = func()
+		times.append(perf_counter() - start)
+	times.sort()
+	return times[len(times) // 2], times[-1], result
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--runs', type=int, default=3)
+	parser.add_argument('--delay', type=float, default=0.3, help="how long the slow mirror takes to answer")
+	parser.add_argument('--size', type=int, default=4, help="MB of Packages.xz each mirror serves for the bandwidth benchmark")
+	argument = parser.parse_args()
+
+	payload = urandom(argument.size * 1024**2)
+	fast = serve(0, payload)
+	slow = serve(argument.delay, payload)
+	stale = serve(0, payload, timedelta(days=2))
+	# A site is in one country, so each gets its own mirrors that don't answer
+	late = [serve(PROBE_TIMEOUT + 1, payload) for _ in range(2)]
+	silent, listeners = zip(*(dead() for _ in range(2)))
+	closed = [refused() for _ in range(2)]
+
+	index = make_index({
+		'Mixed': [late[0], silent[0], closed[0], stale, slow, fast],
+		'Down': [late[1], silent[1], closed[1]],
+	})
+	# The fast mirror is our reference for freshness, so nothing here leaves the machine
+	probe = lambda country: probe_country(index, ARCH, RELEASE, country, reference=fast)
+
+	failed = []
+	results = {}
+	median, worst, fresh = time_it(lambda: probe('Mixed'), argument.runs)
+	results['probe mixed'] = (median, worst)
+	if [result.site for result in fresh] != [fast, slow]:
+		failed.append(f"expected {fast} then {slow}, got {[result.site for result in fresh]}")
+
+	median, worst, fresh = time_it(lambda: probe('Down'), argument.runs)
+	results['probe down'] = (median, worst)
+	if fresh:
+		failed.append(f"nothing in Down should have answered, got {[result.site for result in fresh]}")
+
+	# What picking by hand cost before, the bandwidth benchmark of what answered
+	median, worst, _ = time_it(lambda: bench_mirrors([fast, slow], RELEASE, ARCH, index, len(payload)), argument.runs)
+	results['bandwidth'] = (median, worst)
+
+	# Each probe has a hard timeout and they all run at once
+	for name in ('probe mixed', 'probe down'):
+		if results[name][1] > PROBE_TIMEOUT + 1:
+			failed.append(f"{name} took {results[name][1]:.2f}s, the timeout is {PROBE_TIMEOUT}s")
+
+	for listener in listeners:
+		listener.close()
+	print(f"{'step:'.ljust(14)} {'median s:'.ljust(12)} {'worst s:'.ljust(12)}")
+	for name, (median, worst) in results.items():
+		print(f"{name.ljust(14)} {median:<12.3f} {worst:<12.3f}")
+	for message in failed:
+		print(f"FAILED: {message}")
+	exit(1 if failed else 0)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# This file is part of volian
+
+# volian is an installer for Debian or Ubuntu.
+# Copyright (C) 2021 Volitank
+
+# volian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# volian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with volian.  If not, see <https://www.gnu.org/licenses/>.
+
+# Runs the striping proxy against local mirrors serving a made up archive. Two are good,
+# one answers 404 for every package and one sends packages that don't match their SHA256.
+# Everything is fetched through the proxy with a mirror_pool, the way debootstrap would, and
+# timed against fetching it straight from one good mirror.
+# It checks every package arrives intact, both good mirrors share the work, the bad ones
+# were asked and passed over, and a package no mirror has a good copy of is refused.
+# usage: python3 benchmarks/striping_proxy.py [--packages 200] [--size 256] [--jobs 8]
+# Exits 1 if a check fails.
+
+import argparse
+import lzma
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os import urandom
+from pathlib import Path
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from time import perf_counter
+from urllib.parse import urlsplit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'volian'))
+
+from proxy import mirror_pool, striping_proxy
+
+RELEASE = 'stable'
+PACKAGES = 'dists/stable/main/binary-amd64/Packages.xz'
+# Listed in Packages, but only the corrupt mirror has it
+GHOST = 'pool/main/g/ghost/ghost_1_amd64.deb'
+
+def make_archive(packages: int, size: int):
+	'returns a dict of path to body for a small archive, with a Release and Packages.xz that hash every file'
+	files = {f"pool/main/p/pkg{number}/pkg{number}_1_amd64.deb": urandom(size) for number in range(packages)}
+	stanzas = []
+	for path, body in list(files.items()) + [(GHOST, b'ghost')]:
+		name = path.rsplit('/', 1)[-1].split('_')[0]
+		stanzas.append(f"Package: {name}\nVersion: 1\nFilename: {path}\nSize: {len(body)}\nSHA256: {sha256(body).hexdigest()}\n")
+	index = lzma.compress('\n'.join(stanzas).encode())
+	files[PACKAGES] = index
+	files['dists/stable/Release'] = (
+		f"Origin: Debian\nSuite: {RELEASE}\nSHA256:\n"
+		f" {sha256(index).hexdigest()} {len(index)} main/binary-amd64/Packages.xz\n"
+	).encode()
+	return files
+
+class local_mirror(ThreadingMixIn, HTTPServer):
+	'serves files under /debian/. missing drops every package, corrupt flips a byte in each'
+	daemon_threads = True
+
+class local_mirror_handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		server = self.server
+		path = self.path[len('/debian/'):] if self.path.startswith('/debian/') else None
+		with server.lock:
+			server.requests += path is not None and path.startswith('pool/')
+		body = server.files.get(path)
+		if path is not None and path.startswith('pool/'):
+			if server.mode == 'missing':
+				body = None
+			elif server.mode == 'corrupt':
+				body = bytes([body[0] ^ 0xff]) + body[1:] if body else b'corrupt'
+		if body is None:
+			self.send_error(404)
+			return
+		self.send_response(200)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+def serve(files: dict, mode: str='good'):
+	'starts a local mirror and returns it'
+	server = local_mirror(('127.0.0.1', 0), local_mirror_handler)
+	server.files = files
+	server.mode = mode
+	server.requests = 0
+	server.lock = Lock()
+	server.site = f"127.0.0.1:{server.server_address[1]}"
+	Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+def fetch_all(pool, paths: list, jobs: int):
+	'fetches the indexes and then every path at once. returns a dict of path to (status, body)'
+	for path in ('dists/stable/Release', PACKAGES):
+		pool.get(path)
+	with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+		return dict(zip(paths, executor.map(pool.get, paths)))
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--packages', type=int, default=200)
+	parser.add_argument('--size', type=int, default=256, help="KB of each package")
+	parser.add_argument('--jobs', type=int, default=8)
+	argument = parser.parse_args()
+
+	files = make_archive(argument.packages, argument.size * 1024)
+	debs = [path for path in files if path.startswith('pool/')]
+	good = serve(files)
+	missing = serve(files, 'missing')
+	corrupt = serve(files, 'corrupt')
+	second = serve(files)
+	# The ghost is only on the corrupt mirror
+	corrupt.files = dict(files, **{GHOST: b'ghost'})
+
+	failed = []
+	results = {}
+
+	start = perf_counter()
+	direct = mirror_pool(good.site, '/debian/', argument.jobs)
+	fetch_all(direct, debs, argument.jobs)
+	direct.close()
+	results['one mirror'] = perf_counter() - start
+	for server in (good, missing, corrupt, second):
+		server.requests = 0
+
+	proxy = striping_proxy([(server.site, '/debian/') for server in (good, missing, corrupt, second)], '/debian', argument.jobs)
+	url = urlsplit(proxy.start())
+	client = mirror_pool(url.netloc, url.path, argument.jobs)
+	try:
+		start = perf_counter()
+		fetched = fetch_all(client, debs, argument.jobs)
+		results['proxy'] = perf_counter() - start
+		status, _ = client.get(GHOST)
+	finally:
+		client.close()
+		proxy.stop()
+
+	broken = [path for path in debs if fetched[path] != (200, files[path])]
+	if broken:
+		failed.append(f"{len(broken)} packages didn't come through intact, the first is {broken[0]}")
+	if status != 404:
+		failed.append(f"{GHOST} only has a bad copy, but the proxy served it")
+	if not proxy.served[good.site] or not proxy.served[second.site]:
+		failed.append(f"round robin didn't use both good mirrors: {proxy.served}")
+	for server in (missing, corrupt):
+		# The indexes come from the first mirror, so a bad one shouldn't have served anything
+		if proxy.served[server.site]:
+			failed.append(f"{server.site}, the {server.mode} mirror, served {proxy.served[server.site]} files")
+		if not server.requests:
+			failed.append(f"{server.site}, the {server.mode} mirror, was never asked so nothing was retried")
+
+	print(f"{'fetch:'.ljust(12)} {'seconds:'.ljust(10)} {'MB/s:'.ljust(10)}")
+	megabytes = len(debs) * argument.size / 1024
+	for name, seconds in results.items():
+		print(f"{name.ljust(12)} {seconds:<10.3f} {megabytes / seconds:<10.1f}")
+	print("served by: " + ', '.join(f"{server.mode} {proxy.served[server.site]}" for server in (good, missing, corrupt, second)))
+	for message in failed:
+		print(f"FAILED: {message}")
+	exit(1 if failed else 0)
+
+if __name__ == "__main__":
+	main()
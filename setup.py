@@ -17,6 +17,7 @@ for file in data_dir.rglob('*'):
 	files.append(str(file.relative_to(volian_dir)))
 # Append any extra files with path relative to volian
 files.append('Mirrors.masterlist')
+files.append('Country.centroids')
 # Get the long description from the README file
 long_description = (here / 'README.md').read_text(encoding='utf-8')
 
@@ -19,203 +19,433 @@
 # along with volian.  If not, see <https://www.gnu.org/licenses/>.
 
 from shutil import copy, move
+from getpass import getpass
 from platform import machine
 from pathlib import Path
+from os.path import ismount
+from subprocess import CalledProcessError
 
 from options import arg_parse
-from mirror import choose_mirror
+from answers import answer_error, check_disk, load_answers, luks_passphrase
+from engine import stage, stage_graph
+from journal import install_journal
+from fleet import fleet_error, fleet_install, install_target
+from mirror import choose_mirror, stripe_mirrors, update_mirror_master
+from proxy import striping_proxy
+from bootstrap import bootstrap_tarball, debootstrap, installed_packages, package_cache, staged_download
+from chroot import install_packages
+from luks import tune_luks
+from topology import disk_topology
+from native import estimate_install, native_bootstrap, native_error
 from logger import eprint, wprint
-from partition import define_partitions, write_fstab
-from utils import ask, get_password, shell, DEFAULT
-from netcfg import initial_network_configuration, write_interface_file
+from partition import define_partitions, discard_disk, format_partitions, get_uuid, layout_fits, mount_order, part_device, write_fstab
+from utils import ask, get_password, gig_to_byte, meg_to_byte, target_path, shell, DEFAULT
+from netcfg import initial_network_configuration, test_network, write_interface_file
 from constant import (	APT_SOURCES, BACKUP_BASHRC, RESOLV_CONF, TARGET_RESOLV_CONF, VOLIAN_LOG, EFI,
 						HOSTNAME_FILE, HOSTS_FILE, VIM_DEFAULT, VOLIAN_BASHRC, VOLIAN_VIM, ROOT_BASHRC, USER_BASHRC,
-						LOCALE_FILE, ROOT_DIR, LINUX_BOOT, LINUX_LVM
+						LOCALE_FILE, ROOT_DIR, LINUX_BOOT, LINUX_LVM, DPKG_STATUS, FSTAB_FILE, TARGET_PACKAGES, LUKS_PACKAGES, LVM_EXTENT,
+						DEBIAN_ORG, VOLIAN_JOURNAL
 						)
 
-def main():
+## Every step of the install is a stage. See engine.py
+## Each takes our context dict and returns a dict of what it adds to it
+## The check_ functions tell a resumed install if what a stage did still holds. See journal.py
 
-	parser = arg_parse()
-	argument = parser.parse_args()
-	distro = argument.distro
-	release = argument.release
+def setup_network(context):
+	# # Example of what a network tupel will look like
+	# # ip, subnet, gateway, domain, search, nameserver, interface
+	# network_tuple = ('10.0.1.20', '/24', '10.0.1.1', 'volitank.com', 'volitank.com', '10.0.1.1', 'ens18')
+	answers = context['answers']
+	return {'network_tuple': initial_network_configuration(answers and answers['network'])}
 
-	volume = distro
-	luks_name='root_crypt'
+def check_network(context):
+	return test_network()
 
-	# Lets do a check on our arch
-	if machine() == 'x86_64':
-		arch = 'amd64'
-	else:
-		eprint("arch other than amd64 is not supported at the moment")
-		exit(1)
+def select_mirror(context):
+	'picks our mirror and builds our sources.list'
+	argument = context['argument']
+	distro = context['distro']
+	release = context['release']
+	arch = context['arch']
+	answers = context['answers']
+	sources_nosid = None
 
-	print('welcome to volian installer v.01')
-	input('press enter to continue..')
+	# Handle what direction we go in with debootstrap
+	# And also build our sources.list
+	if distro == 'debian':
+		# Refresh our mirror list. This is a cheap conditional request and we fall back to our copy if it fails
+		if not argument.no_mirror_update and update_mirror_master(argument.masterlist_url):
+			print("mirror list updated")
+
+		# The command line wins over the answer file
+		mirror = argument.mirror
+		country = argument.country
+		if answers is not None:
+			mirror = mirror or answers['mirror']
+			country = country or answers['country']
+		url, archive = choose_mirror(arch, release, mirror,
+							argument.bench_top, meg_to_byte(argument.bench_size), argument.bench_jobs, argument.max_lag,
+							country)
+		# Mirrors don't all keep the archive under /debian/, the masterlist tells us where it is
+		archive_url = f"http://{url}{archive.rstrip('/')}"
 
-	wprint("this installer currently only supports configurations with lvm")
-	wprint("you may only use the entire disk")
-	wprint("NO mbr, efi only")
-	if not ask("Is that okay"):
-		print("this installer isn't good enough for you.. exiting..")
-		exit(0)
+		sources_list = (
+		"# Installed with https://github.com/volitank/volian\n\n"
+		f"deb {archive_url}/ {release} main\n"
+		f"deb-src {archive_url}/ {release} main\n\n"
+		)
 
-	# # Example of what a network tupel will look like
-	# # ip, subnet, gateway, domain, search, nameserver, interface
-	# network_tuple = ('10.0.1.20', '/24', '10.0.1.1', 'volitank.com', 'volitank.com', '10.0.1.1', 'ens18')
-	network_tuple = initial_network_configuration()
+		if release != 'sid' and release != 'unstable':
+			# debian-security isn't in the masterlist. A mirror laid out some other way gets it from the debian cdn
+			security_url = f"http://{url if archive == '/debian/' else DEBIAN_ORG}/debian-security"
+			sources_nosid = (
+			f"deb {archive_url}/ {release}-updates main\n"
+			f"deb-src {archive_url}/ {release}-updates main\n\n"
+			f"deb {security_url}/ {release}-security main\n"
+			f"deb-src {security_url}/ {release}-security main")
 
+	elif distro == 'ubuntu':
+		url, archive = "us.archive.ubuntu.com", "/ubuntu/"
+		archive_url = f"http://{url}{archive.rstrip('/')}"
+
+		sources_list = (
+		"# Installed with https://github.com/volitank/volian\n\n"
+		f"deb {archive_url} {release} main restricted universe multiverse\n"
+		f"deb {archive_url} {release}-updates main restricted universe multiverse\n"
+		f"deb {archive_url} {release}-backports main restricted universe multiverse\n"
+		f"deb {archive_url} {release}-security main restricted universe multiverse")
+
+	return {'url': url, 'archive': archive, 'archive_url': archive_url, 'sources_list': sources_list, 'sources_nosid': sources_nosid}
+
+def prepare_download(context):
+	'sets up the proxy, cache and tarball for debootstrap. With --pipeline this downloads everything as well'
+	argument = context['argument']
+	distro = context['distro']
+	release = context['release']
+	arch = context['arch']
+	url = context['url']
+	archive_url = context['archive_url']
+
+	# Spread our downloads over several mirrors if we were asked to
+	proxy = None
+	bootstrap_url = archive_url
+	if argument.stripe > 1 and distro == 'debian':
+		mirrors = stripe_mirrors(arch, release, (url, context['archive']), argument.stripe, argument.max_lag, argument.country)
+		print(f"downloading from {', '.join(site for site, base in mirrors)}")
+		proxy = striping_proxy(mirrors, f"/{distro}")
+		bootstrap_url = proxy.start()
+
+	cache = None
+	if argument.cache_dir is not None:
+		cache = package_cache(argument.cache_dir, distro, release, arch, gig_to_byte(argument.cache_size))
+	tarball = None
+	if argument.tarball_dir is not None:
+		tarball = bootstrap_tarball(argument.tarball_dir, distro, release, argument.minimal, arch)
+
+	native = None
+	if argument.native:
+		native = native_bootstrap(distro, release, bootstrap_url, arch, argument.minimal, cache)
+
+	# Nothing in the download depends on the disk, so get it going while we partition
+	staged = None
+	if argument.pipeline:
+		if native is not None:
+			native.start()
+		else:
+			staged = staged_download(release, bootstrap_url, argument.minimal, cache, tarball, archive_url).start()
+
+	return {'bootstrap_url': bootstrap_url, 'proxy': proxy, 'cache': cache, 'tarball': tarball, 'staged': staged, 'native': native}
+
+def estimate_size(context):
+	'works out how much space the install needs so the disk layout can be checked against it'
+	argument = context['argument']
+	distro = context['distro']
+	release = context['release']
+
+	print(f"working out how much space {distro} {release} needs")
+	# We don't know yet if we are encrypting, so count luks in
+	extra = TARGET_PACKAGES + LUKS_PACKAGES
+	try:
+		estimate = estimate_install(distro, release, context['archive_url'], context['arch'],
+									argument.minimal, extra, not argument.no_standard)
+	except native_error as error:
+		wprint(f"unable to estimate the install size: {error}. your layout won't be checked")
+		estimate = None
+	return {'estimate': estimate}
+
+def layout_disk(context):
 	# Returns a Partition object. Class is defined in partition.py
-	part_list, disk, space_left = define_partitions()
+	answers = context['answers']
+	estimate = context['estimate']
+	# The command line wins over the answer file
+	profile = context['argument'].mount_profile
+	if answers is not None:
+		profile = profile or answers['mount_profile']
+	profile = profile or 'tuned'
+	if answers is not None:
+		part_list, disk, space_left = define_partitions(answers['disk'], answers['partitions'], estimate, profile)
+		# Nobody is there to pick a new layout
+		errors = layout_fits(part_list, space_left, estimate)
+		if errors:
+			raise answer_error('\n'.join(errors))
+	else:
+		part_list, disk, space_left = define_partitions(estimate=estimate, profile=profile)
+	return {'part_list': part_list, 'disk': disk, 'space_left': space_left}
+
+def check_layout(context):
+	return context['disk'].is_block_device()
+
+def ask_encryption(context):
+	'asks if we will be encrypting and for the passphrase if we are'
+	luks_pass = None
+	if context['answers'] is not None:
+		luks_pass = luks_passphrase(context['answers']['luks'])
+	elif ask("do you want to ecrypt your system with luks"):
+		luks_pass = get_password()
+	return {'luks_pass': luks_pass}
+
+def discard_target(context):
+	'discards the whole disk with --discard. nothing is written to it until every question has been answered'
+	if context['argument'].discard:
+		discard_disk(context['disk'], shell=context['shell'])
+	return {'discarded': True}
+
+def write_partition_table(context):
+	disk = context['disk']
+	part_list = context['part_list']
 
 	# Create our partitions
 	print(f'\ncreating partitions on {disk}')
 	for partition in part_list:
-		# We have to convert the bytes to sectors
 		if partition.name == 'boot_efi':
-			esp_size = int(partition.size / 512)
+			esp_size = partition.size
 		if partition.name == 'boot':
-			boot_size = int(partition.size /512)
+			boot_size = partition.size
+
+	# sfdisk counts in the disk's own sectors, which aren't always 512 bytes
+	topology = disk_topology(disk)
+	print(topology.describe())
+	(esp_start, esp_sectors), (boot_start, boot_sectors), (lvm_start, lvm_sectors) = topology.layout([esp_size, boot_size, None])
 
 	parts = (
 	# Format is <start>,<size>,<type>\n to separate entries
-	f",{esp_size},{EFI}\n"
-	+f",{boot_size},{LINUX_BOOT}\n"
-	+f",,{LINUX_LVM}"
+	f"{esp_start},{esp_sectors},{EFI}\n"
+	+f"{boot_start},{boot_sectors},{LINUX_BOOT}\n"
+	+f"{lvm_start},{lvm_sectors},{LINUX_LVM}"
 	)
 
 	# Who ever wrote pyshell is a genius!
-	shell.sfdisk.__quiet.__label.gpt(disk, input=parts)
-
-	# Ask if we'll be encrypting, then format luks if we are.
-	if ask("do you want to ecrypt your system with luks"):
-		luks_pass = get_password()
-		luks_disk = Path(str(disk)+'3')
+	context['shell'].sfdisk.__quiet.__label.gpt(disk, input=parts)
+	return {'partitioned': True}
+
+def check_partition_table(context):
+	disk = context['disk']
+	return all(part_device(disk, number).is_block_device() for number in (1, 2, 3))
+
+def benchmark_luks(context):
+	'picks the luks cipher and options for this machine. It only reads the disk, so it runs while the disk is set up'
+	if context['luks_pass'] is None:
+		return {'luks_tuning': None}
+	return {'luks_tuning': tune_luks(context['disk'], context['log'], context['shell'])}
+
+def setup_luks(context):
+	'formats and opens luks if we are encrypting. provides the device our physical volume goes on'
+	disk = context['disk']
+	luks_name = context['luks_name']
+	luks_pass = context['luks_pass']
+	tuning = context['luks_tuning']
+	shell = context['shell']
+
+	if luks_pass is not None:
+		luks_disk = part_device(disk, 3)
 		print("formatting your luks volume..")
-		shell.cryptsetup.luksFormat("--hash=sha512", "--key-size=512", luks_disk, input=luks_pass)
+		shell.cryptsetup.luksFormat(*tuning['format'], luks_disk, input=luks_pass)
 
 		print("opening luks volume..")
-		shell.cryptsetup.open(luks_disk, luks_name, luks_pass)
-
-		del luks_pass
+		shell.cryptsetup.open(*tuning['open'], luks_disk, luks_name, input=luks_pass)
 
 		pv_part = Path(f"/dev/mapper/{luks_name}")
 	else:
 		# Our pysical volume will be /dev/sdx3
-		pv_part = Path(str(disk)+'3')
-
-	# Create LVM
-	print("\ncreating physical volume and volume group")
-	# Create our physical volume on either our disk or luks container
-	shell.pvcreate(pv_part)
-	shell.vgcreate(volume, pv_part)
-
-	# Now time to create our Logical Volumes from our part_list
-	for partition in part_list:
-		# We don't need boot or efi, they aren't going to be lvm
-		if partition.name != 'boot_efi' and partition.name != 'boot':
-			partition.lv_create(volume, space_left)
-			partition.mkfs(volume)
-			partition.mount(volume)
+		pv_part = part_device(disk, 3)
 
-	# Now that root and everything has been mounted we can do the boot and efi
-	print("making /boot and /boot/efi filesystems")
-
-	for partition in part_list:
-		if partition.name == 'boot':
-			partition.mkfs()
-			partition.mount()
-
-	# We have to iterate this separately becuase boot has to be mounted before /boot/efi
-	for partition in part_list:
-		if partition.name == 'boot_efi':
-			partition.mkfs()
-			partition.mount()
-
-	# Now we need to do our installation
-	# Handle what direction we go in with debootstrap
-	# And also build our sources.list
-	if distro == 'debian':
-		distro = "debian"
-		url = choose_mirror(arch)
-
-		if release is None:
-			print("debian release not selected. defaulting to stable")
-			release="stable"
-
-		sources_list = (
-		"# Installed with https://github.com/volitank/volian\n\n"
-		f"deb http://{url}/debian/ {release} main\n"
-		f"deb-src http://{url}/debian/ {release} main\n\n"
-		)
+	return {'pv_part': pv_part}
 
-		sources_nosid = (
-		f"deb http://{url}/debian/ {release}-updates main\n"
-		f"deb-src http://{url}/debian/ {release}-updates main\n\n"
-		f"deb http://{url}/debian-security/ {release}-security main\n"
-		f"deb-src http://{url}/debian-security/ {release}-security main")
+def open_luks(context):
+	"""Unlocks the luks volume a resumed install finds closed
 
-	elif distro == 'ubuntu':
-		distro = "ubuntu"
-		url = "us.archive.ubuntu.com"
+	returns False if there is no luks volume. One that won't unlock is never formatted over, we exit instead
+	"""
+	luks_disk = part_device(context['disk'], 3)
+	tuning = context['luks_tuning']
+	shell = context['shell']
+	try:
+		shell.cryptsetup.isLuks(luks_disk)
+	except CalledProcessError:
+		return False
+
+	print(f"{luks_disk} already holds our luks volume. unlocking it instead of formatting it again")
+	answers = context['answers']
+	# cryptsetup gives three tries as well
+	for _ in range(1 if answers is not None else 3):
+		luks_pass = luks_passphrase(answers['luks']) if answers is not None else getpass("luks passphrase:")
+		if luks_pass is None:
+			break
+		try:
+			shell.cryptsetup.open(*(tuning['open'] if tuning else ()), luks_disk, context['luks_name'], input=luks_pass)
+			return True
+		except CalledProcessError:
+			eprint("unable to unlock the luks volume")
+	eprint(f"{luks_disk} wasn't unlocked. run with --fresh to start over, which formats it again")
+	exit(1)
+
+def check_luks(context):
+	# The mapping is gone after a reboot, but the volume isn't. Formatting it again would wipe everything on it
+	pv_part = context['pv_part']
+	if pv_part.is_block_device():
+		return True
+	return pv_part.parent == Path('/dev/mapper') and open_luks(context)
+
+def setup_lvm(context):
+	pv_part = context['pv_part']
+	volume = context['volume']
+	shell = context['shell']
 
-		if release is None:
-			print("ubuntu release not selected. defaulting to hirsute")
-			release="hirsute"
+	# Create LVM
+	print("\ncreating physical volume and volume group")
+	# Data starts on the grain of whatever is under the pv, luks included, and extents are a whole number of MiB
+	topology = disk_topology(pv_part)
+	print(topology.describe())
+	# Create our physical volume on either our disk or luks container
+	shell.pvcreate('--dataalignment', f"{topology.grain // 1024}k", pv_part)
+	shell.vgcreate('-s', f"{LVM_EXTENT // 1024}k", volume, pv_part)
+	return {'volume_group': volume}
 
-		sources_list = (
-		"# Installed with https://github.com/volitank/volian\n\n"
-		f"deb http://{url}/ubuntu {release} main restricted universe multiverse\n"
-		f"deb http://{url}/ubuntu {release}-updates main restricted universe multiverse\n"
-		f"deb http://{url}/ubuntu {release}-backports main restricted universe multiverse\n"
-		f"deb http://{url}/ubuntu {release}-security main restricted universe multiverse")
+def check_lvm(context):
+	try:
+		context['shell'].vgs(context['volume_group'], logfile=DEFAULT, capture_output=True)
+		return True
+	except CalledProcessError:
+		return False
+
+def make_filesystems(context):
+	disk = context['disk']
+	# Create our logical volumes, make the filesystems and mount it all under /target
+	format_partitions(context['part_list'], context['volume_group'], context['space_left'], context['argument'].mkfs_jobs,
+						context['root'], context['shell'])
+	uuids = {'efi': get_uuid(part_device(disk, 1)), 'boot': get_uuid(part_device(disk, 2))}
+	return {'mounted': True, 'uuids': uuids}
+
+def check_filesystems(context):
+	disk = context['disk']
+	for partition in mount_order(context['part_list']):
+		if not ismount(context['root'] / str(partition.path).lstrip('/')):
+			return False
+	# Make sure nobody reformatted boot or efi behind our back
+	uuids = context['uuids']
+	return uuids == {'efi': get_uuid(part_device(disk, 1)), 'boot': get_uuid(part_device(disk, 2))}
+
+def bootstrap_system(context):
+	argument = context['argument']
+	distro = context['distro']
+	release = context['release']
+	proxy = context['proxy']
 
 	print(f'starting installation of {distro} {release}.. this can take a while..')
 
+	# debootstrap is our fallback if the native bootstrap can't get what it needs
+	native = context['native']
+	if native is not None:
+		try:
+			native.prepare()
+		except native_error as error:
+			wprint(f"native bootstrap failed: {error}. falling back to debootstrap")
+			native = None
+
 	# Start installation
-	print(f'initial bootstrapping log can be found at {VOLIAN_LOG}')
-	if argument.minimal:
-		shell.debootstrap.__variant_minbase(release, ROOT_DIR, f"http://{url}/{distro}")
-	else:
-		shell.debootstrap(release, ROOT_DIR, f"http://{url}/{distro}")
+	print(f"initial bootstrapping log can be found at {context['log']}")
+	try:
+		if native is not None:
+			try:
+				native.install(context['root'], context['shell'])
+			except native_error as error:
+				wprint(f"native bootstrap failed: {error}. falling back to debootstrap")
+				native = None
+		if native is None:
+			debootstrap(release, context['root'], context['bootstrap_url'], argument.minimal, context['cache'],
+						context['tarball'], context['archive_url'], context['staged'], context['shell'])
+	finally:
+		# A fleet shares the proxy. It is stopped once every target is done
+		if proxy is not None and not context.get('fleet'):
+			proxy.stop()
 	print('initial bootstrapping complete')
+	return {'bootstrapped': True}
 
-	# Let's write our sources.list
-	with open(APT_SOURCES, 'w') as file:
-		file.write(sources_list)
-		if distro == 'debian':
-			if release != 'sid' and release != 'unstable':
-				file.write(sources_nosid)
-
-	efi_uuid = shell.blkid(Path(str(disk)+'1'), "--output", "value", logfile=DEFAULT, capture_output=True).stdout.decode().split()[0]
-	boot_uuid= shell.blkid(Path(str(disk)+'2'), "--output", "value", logfile=DEFAULT, capture_output=True).stdout.decode().split()[0]
-	write_fstab(boot_uuid, efi_uuid, volume, part_list)
+def check_bootstrap(context):
+	# debootstrap removes its working directory once it has finished
+	root = context['root']
+	return (root / DPKG_STATUS).exists() and not (root / 'debootstrap').exists()
 
+def write_sources(context):
+	# Let's write our sources.list
+	with open(target_path(context['root'], APT_SOURCES), 'w') as file:
+		file.write(context['sources_list'])
+		if context['sources_nosid'] is not None:
+			file.write(context['sources_nosid'])
+	return {'sources': True}
+
+def write_target_fstab(context):
+	uuids = context['uuids']
+	write_fstab(uuids['boot'], uuids['efi'], context['volume_group'], context['part_list'], context['root'])
+	return {'fstab': True}
+
+def install_target_packages(context):
+	'installs what the system needs to boot, and the standard task, in one go'
+	argument = context['argument']
+	root = context['root']
+	# apt in the chroot needs to be able to find the mirror
+	copy(RESOLV_CONF, target_path(root, TARGET_RESOLV_CONF))
+
+	packages = list(TARGET_PACKAGES)
+	if str(context['pv_part']).startswith('/dev/mapper/'):
+		packages.extend(LUKS_PACKAGES)
+	tasks = [] if argument.no_standard else ['standard']
+	install_packages(root, packages, tasks, context['shell'], not argument.safe_io)
+	return {'packages': True}
+
+def check_packages(context):
+	installed = installed_packages(context['root'])
+	return all(package in installed for package in TARGET_PACKAGES)
+
+def copy_customizations(context):
+	root = context['root']
 	# Let us copy volian customizations
-	copy(VOLIAN_BASHRC, ROOT_BASHRC)
-	move(USER_BASHRC, BACKUP_BASHRC)
-	copy(VOLIAN_BASHRC, USER_BASHRC)
-	copy(VOLIAN_VIM, VIM_DEFAULT)
-
-	exit()
-	# We need to install tasksel standard through the chroot before we do this.
-	# Put an exit statement here for now until I can do more testing.
+	copy(VOLIAN_BASHRC, target_path(root, ROOT_BASHRC))
+	move(target_path(root, USER_BASHRC), target_path(root, BACKUP_BASHRC))
+	copy(VOLIAN_BASHRC, target_path(root, USER_BASHRC))
+	copy(VOLIAN_VIM, target_path(root, VIM_DEFAULT))
+	return {'customized': True}
+
+def configure_system(context):
+	# The packages stage has to run before this.
+	# This isn't in the install graph until I can do more testing.
 	# But this is well on it's way
+	root = context['root']
 
 	# Update locale. Will be configurable eventually
 	locale = 'en_US.UTF-8 UTF-8\n'
-	with open(LOCALE_FILE, 'r') as file:
+	with open(target_path(root, LOCALE_FILE), 'r') as file:
 		locale_data = ''
 		for line in file.readlines():
 			if locale in line:
 				line = locale
 			locale_data = locale_data + line
-	with open(LOCALE_FILE, 'w') as file:
+	with open(target_path(root, LOCALE_FILE), 'w') as file:
 		file.write(locale_data)
 
 	# Set our hostname. Will make it configurable eventually
 	hostname = 'volian\n'
-	with open(HOSTNAME_FILE, 'w') as file:
+	with open(target_path(root, HOSTNAME_FILE), 'w') as file:
 		file.write(hostname)
 
 	# Define basic etc hosts file and write it
@@ -230,30 +460,203 @@ def main():
 	'ff02::1 ip6-allnodes\n'
 	'ff02::2 ip6-allrouters')
 
-	with open(HOSTS_FILE, 'w') as file:
+	with open(target_path(root, HOSTS_FILE), 'w') as file:
 		file.write(etc_hosts)
 
 	# Copy installer resolve.conf
-	copy(RESOLV_CONF, TARGET_RESOLV_CONF)
+	copy(RESOLV_CONF, target_path(root, TARGET_RESOLV_CONF))
 
 	# Generate configuration file. 
-	write_interface_file(network_tuple)
+	write_interface_file(context['network_tuple'], root)
 
 	print('Everything is finished and you should now be able to chroot')
+	return {'configured': True}
+
+# The stages a fleet runs once for every target
+SHARED_STAGES = ('network', 'mirror', 'size estimate', 'encryption', 'download')
+
+def install_graph(jobs: int, shared: bool=None):
+	"""Returns the stage_graph for a full install
+
+	Interactive stages are asked in the order they are listed here.
+	For a fleet, shared True gives only the SHARED_STAGES and False only the stages each target runs.
+	"""
+	# The passphrase is asked after the disk layout, as it always was. A fleet's shared stages have no disk layout to wait on
+	after_layout = ('part_list',) if shared is None else ()
+	stages = [
+		stage('network', setup_network, provides=('network_tuple',), interactive=True, validate=check_network),
+		stage('mirror', select_mirror, ('network_tuple',), ('url', 'archive', 'archive_url', 'sources_list', 'sources_nosid'), interactive=True),
+		stage('size estimate', estimate_size, ('archive_url',), ('estimate',)),
+		stage('disk layout', layout_disk, ('estimate',), ('part_list', 'disk', 'space_left'), interactive=True, validate=check_layout),
+		# We never write the passphrase down. It is only asked again if luks still has to be set up
+		stage('encryption', ask_encryption, after_layout, ('luks_pass',), interactive=True, journal=False),
+		stage('download', prepare_download, ('url', 'archive', 'archive_url'), ('bootstrap_url', 'proxy', 'cache', 'tarball', 'staged', 'native'), journal=False),
+		# Waiting on luks_pass means every question is answered before we touch the disk. The partition table waits on the discard
+		stage('discard', discard_target, ('disk', 'luks_pass'), ('discarded',)),
+		stage('partition table', write_partition_table, ('disk', 'part_list', 'discarded'), ('partitioned',),
+				validate=check_partition_table),
+		stage('luks benchmark', benchmark_luks, ('disk', 'luks_pass'), ('luks_tuning',)),
+		stage('luks', setup_luks, ('partitioned', 'luks_pass', 'luks_tuning'), ('pv_part',), validate=check_luks),
+		stage('lvm', setup_lvm, ('pv_part',), ('volume_group',), validate=check_lvm),
+		stage('filesystems', make_filesystems, ('volume_group', 'part_list', 'space_left'), ('mounted', 'uuids'),
+				validate=check_filesystems),
+		stage('bootstrap', bootstrap_system, ('mounted', 'bootstrap_url'), ('bootstrapped',), validate=check_bootstrap),
+		stage('sources', write_sources, ('bootstrapped', 'sources_list'), ('sources',), validate=lambda context: target_path(context['root'], APT_SOURCES).exists()),
+		stage('fstab', write_target_fstab, ('bootstrapped', 'uuids', 'part_list', 'volume_group'), ('fstab',),
+				validate=lambda context: target_path(context['root'], FSTAB_FILE).exists()),
+		# initramfs is built while we install, so it needs the fstab in place
+		stage('packages', install_target_packages, ('sources', 'fstab', 'pv_part'), ('packages',), validate=check_packages),
+		stage('customizations', copy_customizations, ('bootstrapped',), ('customized',), validate=lambda context: target_path(context['root'], BACKUP_BASHRC).exists()),
+	]
+	if shared is not None:
+		stages = [node for node in stages if (node.name in SHARED_STAGES) == shared]
+	return stage_graph(stages, jobs)
+
+def journal_path(argument):
+	'the journal has to outlive a reboot. --journal wins, then beside the answer file, which is often on a usb stick'
+	if argument.journal is not None:
+		return argument.journal
+	if argument.config is not None:
+		return argument.config.resolve().parent / VOLIAN_JOURNAL.name
+	return VOLIAN_JOURNAL
+
+def fleet_main(argument, context: dict, key: dict):
+	'installs to every --fleet target at once. The network, mirror, passphrase and download are shared'
+	targets = [install_target(path, context['distro'], journal_path(argument).parent) for path in argument.fleet]
+	names = [target.name for target in targets]
+	if len(set(names)) != len(names):
+		eprint("every fleet target needs a different name")
+		exit(1)
+
+	# Make sure every target is usable before we start on any of them
+	image_size = gig_to_byte(argument.image_size) if argument.image_size is not None else None
+	errors = []
+	for target in targets:
+		try:
+			target.attach(image_size)
+		except fleet_error as error:
+			errors.append(str(error))
+			continue
+		errors.extend(check_disk(target.disk, context['answers']['partitions']))
+	if errors:
+		for error in errors:
+			eprint(error)
+		exit(1)
+
+	# Every target installs from the one download
+	argument.pipeline = True
+	graph = install_graph(argument.jobs, shared=True)
+	try:
+		graph.run(context)
+	except answer_error as error:
+		eprint(str(error))
+		exit(1)
+	else:
+		failed = fleet_install(targets, context, lambda: install_graph(argument.jobs, shared=False),
+								argument.fleet_jobs, key, argument.fresh)
+	finally:
+		context.pop('luks_pass', None)
+		if context.get('proxy') is not None:
+			context['proxy'].stop()
+		graph.print_timings()
+	if failed:
+		exit(1)
+
+def main():
+
+	parser = arg_parse()
+	argument = parser.parse_args()
+	distro = argument.distro
+	release = argument.release
+
+	# Check the whole answer file now so it can't stop us halfway through
+	answers = None
+	if argument.config is not None:
+		try:
+			answers = load_answers(argument.config, fleet=argument.fleet is not None)
+		except answer_error as error:
+			eprint(str(error))
+			exit(1)
+		release = release or answers['release']
+	# Nobody can answer questions for several installs at once
+	if argument.fleet is not None and answers is None:
+		eprint("--fleet needs an answer file. see --config")
+		exit(1)
+
+	volume = distro
+	luks_name='root_crypt'
+
+	# Lets do a check on our arch
+	if machine() == 'x86_64':
+		arch = 'amd64'
+	else:
+		eprint("arch other than amd64 is not supported at the moment")
+		exit(1)
+
+	if release is None:
+		if distro == 'debian':
+			print("debian release not selected. defaulting to stable")
+			release="stable"
+		elif distro == 'ubuntu':
+			print("ubuntu release not selected. defaulting to hirsute")
+			release="hirsute"
+
+	print('welcome to volian installer v.01')
+	# With an answer file nobody is there to press enter
+	if answers is None:
+		input('press enter to continue..')
+
+		wprint("this installer currently only supports configurations with lvm")
+		wprint("you may only use the entire disk")
+		wprint("NO mbr, efi only")
+		if not ask("Is that okay"):
+			print("this installer isn't good enough for you.. exiting..")
+			exit(0)
+
+	context = {
+		'argument': argument,
+		'answers': answers,
+		'distro': distro,
+		'release': release,
+		'arch': arch,
+		'volume': volume,
+		'luks_name': luks_name,
+		'root': ROOT_DIR,
+		'shell': shell,
+		'log': VOLIAN_LOG,
+	}
+
+	# Anything that changes what we install means an old journal is no use to us
+	key = {'distro': distro, 'release': release, 'minimal': argument.minimal, 'arch': arch}
+	if argument.fleet is not None:
+		fleet_main(argument, context, key)
+		exit()
+	journal = install_journal(key, journal_path(argument))
+	if argument.fresh:
+		journal.clear()
+
+	graph = install_graph(argument.jobs)
+	try:
+		graph.run(context, journal)
+	except answer_error as error:
+		# Some answers can only be checked against what earlier stages found, like the layout against the size estimate
+		eprint(str(error))
+		exit(1)
+	finally:
+		# Don't keep the passphrase around any longer than we have to
+		context.pop('luks_pass', None)
+		graph.print_timings()
+	journal.clear()
+	# Finished. Returning would start the installer over on the disk we just installed
+	exit()
+
 ## Run These in the chroot when we get there
-# apt update
-# apt install makedev sudo lvm2 cryptsetup cryptsetup-initramfs grub-efi command-not-found
+## The packages stage installs sudo lvm2 cryptsetup grub-efi command-not-found and tasksel standard
 
 ## NEED TO VERIFY IF NECESSARY
 #apt-file update
 #update-command-not-found
 
-## Ask user if they would like to install standard packages.
-## Encourage them too as things like 
-## wget, file, apt-listchanges, xz-utils, bzip2, manpages, bash-completion, openssh-client, lsof, traceroute
-## tools you'd expect such as manpages, bash-completion, and ssh won't be available. 
-## Are not available without it
-# tasksel install standard
 # dpkg-reconfigure tzdata
 # echo volian > /etc/hostname
 #tasksel instal ssh-server
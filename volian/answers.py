@@ -0,0 +1,276 @@
+# This file is part of volian
+
+# volian is an installer for Debian or Ubuntu.
+# Copyright (C) 2021 Volitank
+
+# volian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# volian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with volian.  If not, see <https://www.gnu.org/licenses/>.
+
+if __name__ == "__main__":
+	print("answers isn't intended to be run directly.. exiting")
+	exit(1)
+
+import json
+from collections import Counter
+from ipaddress import ip_address, ip_interface, ip_network
+from os import environ
+from pathlib import Path
+
+from netcfg import get_eth_list
+from partition import disk_size
+from utils import get_password, gig_to_byte, meg_to_byte
+from constant import DEBIAN_ORG, FILESYSTEMS, MOUNT_PROFILES, SUBNET_MASK_DICT
+
+## Notes on how to use this module.
+## An answer file is json and answers every question the installer would ask
+# {
+#	"release": "bullseye",
+#	"mirror": "auto",
+#	"network": {"mode": "static", "interface": "ens18", "ip": "10.0.1.20", "subnet": "/24",
+#				"gateway": "10.0.1.1", "domain": "volitank.com", "search": "volitank.com", "nameserver": "10.0.1.1"},
+#	"disk": "/dev/sda",
+#	"partitions": [
+#		{"path": "/boot/efi", "size": "512M"},
+#		{"path": "/boot", "size": "1G", "filesystem": "ext4"},
+#		{"path": "/", "size": "20G", "filesystem": "ext4"},
+#		{"path": "/home", "size": "free", "filesystem": "xfs"}
+#	],
+#	"luks": "env:VOLIAN_LUKS",
+#	"mount_profile": "tuned"
+# }
+## network may also just be "dhcp". luks is "file:<path>", "env:<variable>", "prompt" or null for no encryption
+## mount_profile is one of MOUNT_PROFILES
+# answers = load_answers(Path('volian.json'))
+
+ANSWER_KEYS = ('release', 'mirror', 'country', 'network', 'disk', 'partitions', 'luks', 'mount_profile')
+NETWORK_KEYS = ('mode', 'interface', 'ip', 'subnet', 'gateway', 'domain', 'search', 'nameserver')
+PARTITION_KEYS = ('path', 'size', 'filesystem')
+
+class answer_error(Exception):
+	'raised when an answer file is missing something or has something wrong in it'
+
+def load_answers(path: Path, fleet: bool=False):
+	"""Reads and checks an answer file
+
+	Everything is checked here before we start so a bad answer file never stops an install halfway.
+	raises answer_error with everything that is wrong with it
+
+	In fleet mode the disks come from the command line, so disk may be left out. See check_disk
+
+	returns a dict with the answers in the form the installer uses them
+	"""
+	try:
+		data = json.loads(Path(path).read_text())
+	except OSError as error:
+		raise answer_error(f"unable to read {path}: {error.strerror}")
+	except ValueError as error:
+		raise answer_error(f"{path} isn't valid json: {error}")
+	if not isinstance(data, dict):
+		raise answer_error(f"{path} should hold a json object")
+
+	errors = []
+	unknown = [key for key in data if key not in ANSWER_KEYS]
+	if unknown:
+		errors.append(f"unknown keys {', '.join(unknown)}")
+
+	answers = {
+		'release': data.get('release'),
+		'mirror': data.get('mirror') or DEBIAN_ORG,
+		'country': data.get('country'),
+		'luks': data.get('luks'),
+		'mount_profile': data.get('mount_profile'),
+	}
+	for key in ('release', 'mirror', 'country', 'luks', 'mount_profile'):
+		if answers[key] is not None and not isinstance(answers[key], str):
+			errors.append(f"{key} should be a string")
+	if isinstance(answers['mount_profile'], str) and answers['mount_profile'] not in MOUNT_PROFILES:
+		errors.append(f"mount_profile should be one of {', '.join(MOUNT_PROFILES)}")
+
+	answers['network'] = check_network(data.get('network'), errors)
+	answers['disk'], answers['partitions'] = check_partitions(data.get('disk'), data.get('partitions'), errors, fleet)
+	check_luks(answers['luks'], errors)
+
+	if errors:
+		raise answer_error(f"problems with {path}:\n" + '\n'.join(f"  {error}" for error in errors))
+	return answers
+
+def check_network(network, errors: list):
+	'returns the network answers with the mode filled in. Problems are added to errors'
+	if network is None:
+		errors.append("network is required")
+		return None
+	if network == 'dhcp':
+		network = {'mode': 'dhcp'}
+	if not isinstance(network, dict):
+		errors.append("network should be 'dhcp' or an object")
+		return None
+
+	network = dict(network)
+	unknown = [key for key in network if key not in NETWORK_KEYS]
+	if unknown:
+		errors.append(f"unknown network keys {', '.join(unknown)}")
+
+	interface = network.get('interface')
+	eth_list = get_eth_list()
+	if interface is None and len(eth_list) > 1:
+		errors.append(f"network interface is required when there is more than one. {', '.join(eth_list)}")
+	elif interface is not None and interface not in eth_list:
+		errors.append(f"network interface {interface} isn't an ethernet interface we have")
+
+	mode = network.setdefault('mode', 'static')
+	if mode == 'dhcp':
+		return network
+	if mode != 'static':
+		errors.append("network mode should be dhcp or static")
+		return None
+
+	for key in ('ip', 'subnet', 'gateway'):
+		if not network.get(key):
+			errors.append(f"network {key} is required for a static network")
+	if any(not network.get(key) for key in ('ip', 'subnet', 'gateway')):
+		return None
+
+	subnet = network['subnet']
+	# Both notations are accepted, we keep slash notation
+	subnet = SUBNET_MASK_DICT.get(subnet, subnet)
+	if subnet not in SUBNET_MASK_DICT.values():
+		errors.append(f"network subnet {network['subnet']} isn't valid")
+		return None
+	network['subnet'] = subnet
+
+	try:
+		ip = ip_address(network['ip'])
+		gateway = ip_address(network['gateway'])
+		nameserver = ip_address(network.get('nameserver') or network['gateway'])
+	except ValueError as error:
+		errors.append(f"network {error}")
+		return None
+	if gateway == ip:
+		errors.append("network gateway can't be the same as the ip address")
+	elif gateway not in ip_network(ip_interface(str(ip)+subnet).network):
+		errors.append("network gateway isn't in the network")
+
+	network['ip'] = str(ip)
+	network['gateway'] = str(gateway)
+	network['nameserver'] = str(nameserver)
+	network.setdefault('domain', None)
+	network.setdefault('search', None)
+	return network
+
+def parse_size(size):
+	"returns size in bytes from '512M', '10G' or a number of bytes. 'free' becomes '100%FREE'"
+	if isinstance(size, bool):
+		raise ValueError
+	if isinstance(size, int):
+		return size
+	if size in ('free', 'Free'):
+		return '100%FREE'
+	if size.endswith('M'):
+		return int(meg_to_byte(float(size[:-1])))
+	if size.endswith('G'):
+		return int(gig_to_byte(float(size[:-1])))
+	raise ValueError
+
+def check_partitions(disk, layout, errors: list, fleet: bool=False):
+	'returns the disk as a Path and a list of (path, size, filesystem). Problems are added to errors'
+	if disk is None and fleet:
+		pass
+	elif not isinstance(disk, str):
+		errors.append("disk is required")
+		return None, None
+	else:
+		disk = Path(disk)
+
+	if not isinstance(layout, list) or not layout:
+		errors.append("partitions should be a list")
+		return disk, None
+
+	partitions = []
+	defined = []
+	for entry in layout:
+		if not isinstance(entry, dict) or not isinstance(entry.get('path'), str):
+			errors.append(f"partition {entry} needs a path")
+			continue
+		unknown = [key for key in entry if key not in PARTITION_KEYS]
+		if unknown:
+			errors.append(f"unknown partition keys {', '.join(unknown)}")
+
+		path = Path('/' + entry['path'].lstrip('/'))
+		defined.append(path)
+		try:
+			size = parse_size(entry.get('size'))
+		except (ValueError, TypeError, AttributeError):
+			errors.append(f"partition {path} needs a size like 512M, 10G or free")
+			continue
+		# These are real partitions in front of the lvm one. Only logical volumes can take what's left
+		if size == '100%FREE' and path in (Path('/boot'), Path('/boot/efi')):
+			errors.append(f"partition {path} can't be free, give it a size like 512M")
+			continue
+
+		if path == Path('/boot/efi'):
+			filesystem = 'fat32'
+		else:
+			filesystem = entry.get('filesystem')
+			if filesystem not in FILESYSTEMS:
+				errors.append(f"partition {path} needs a filesystem. one of {', '.join(FILESYSTEMS)}")
+				continue
+		partitions.append((path, size, filesystem))
+
+	for path in (Path('/'), Path('/boot'), Path('/boot/efi')):
+		if path not in defined:
+			errors.append(f"partitions need {path}")
+	for path, times in Counter(defined).items():
+		if times > 1:
+			errors.append(f"you can't define '{path}' more than once")
+	if [size for path, size, filesystem in partitions].count('100%FREE') > 1:
+		errors.append("you can't have free defined twice")
+
+	if disk is not None:
+		errors.extend(check_disk(disk, partitions))
+	return disk, partitions
+
+def check_disk(disk: Path, partitions: list):
+	'returns a list of reasons partitions can\'t go on disk'
+	if not disk.is_block_device():
+		return [f"disk {disk} is not a block device"]
+	wanted = sum(size for path, size, filesystem in partitions if size != '100%FREE')
+	disk_bytes = disk_size(disk)
+	if wanted > disk_bytes:
+		return [f"partitions want {wanted} bytes but {disk} only has {int(disk_bytes)}"]
+	return []
+
+def check_luks(source, errors: list):
+	'makes sure we will be able to get the passphrase before we start. Problems are added to errors'
+	if source is None or source == 'prompt':
+		return
+	if not isinstance(source, str):
+		return
+	if source.startswith('file:'):
+		if not Path(source[5:]).is_file():
+			errors.append(f"luks passphrase file {source[5:]} doesn't exist")
+	elif source.startswith('env:'):
+		if not environ.get(source[4:]):
+			errors.append(f"luks passphrase variable {source[4:]} isn't set")
+	else:
+		errors.append("luks should be file:<path>, env:<variable>, prompt or null")
+
+def luks_passphrase(source: str):
+	'returns the passphrase from an answer file luks source. None means no encryption'
+	if source is None:
+		return None
+	if source.startswith('file:'):
+		# A trailing newline in the file isn't part of the passphrase
+		return Path(source[5:]).read_text().rstrip('\n')
+	if source.startswith('env:'):
+		return environ[source[4:]]
+	return get_password()
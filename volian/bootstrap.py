@@ -0,0 +1,365 @@
+# This file is part of volian
+
+# volian is an installer for Debian or Ubuntu.
+# Copyright (C) 2021 Volitank
+
+# volian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# volian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with volian.  If not, see <https://www.gnu.org/licenses/>.
+
+if __name__ == "__main__":
+	print("bootstrap isn't intended to be run directly.. exiting")
+	exit(1)
+
+import json
+from datetime import datetime
+from hashlib import sha256
+from os import link, replace
+from pathlib import Path
+from shutil import copyfile, rmtree
+from tempfile import mkdtemp
+from threading import Lock, Thread
+from time import time
+from urllib.parse import urlsplit
+
+from logger import wprint
+from mirror import http_get, parse_release_date
+from utils import byte_to_gig_trunc, shell
+from constant import APT_ARCHIVES, DPKG_STATUS, STAGING_DIR
+
+## Notes on how to use this module.
+## A package cache is keyed by distro, release and arch under its root
+# cache = package_cache(Path('/srv/volian-cache'), 'debian', 'stable', 'amd64', gig_to_byte(4))
+## Hand it to debootstrap. It checks the cache before, and files what was downloaded after
+# debootstrap('stable', ROOT_DIR, 'http://deb.debian.org/debian', cache=cache)
+
+## A tarball is keyed by distro, release, variant and arch. It is built when missing or stale and then unpacked
+# tarball = bootstrap_tarball(Path('/srv/volian-tarballs'), 'debian', 'stable', False, 'amd64')
+# debootstrap('stable', ROOT_DIR, 'http://deb.debian.org/debian', tarball=tarball)
+
+## Or get the download going early and pick it up when the disk is ready
+# staged = staged_download('stable', 'http://deb.debian.org/debian').start()
+# debootstrap('stable', ROOT_DIR, 'http://deb.debian.org/debian', staged=staged)
+
+def bootstrap_options(minimal: bool=False, cache=None):
+	'returns the debootstrap options for minimal and cache. The cache is checked over here'
+	options = []
+	if minimal:
+		options.append('--variant=minbase')
+	if cache is not None:
+		cache.prepare()
+		options.append(f'--cache-dir={cache.dir}')
+	return options
+
+def prepare_tarball(options: list, release: str, url: str, tarball, mirror_url: str=None):
+	'builds tarball if it is missing or stale. returns its path, or None if it is no good'
+	date = mirror_release_date(mirror_url or url, release)
+	if not tarball.is_fresh(date):
+		tarball.build(options, release, url, date)
+	if tarball.verify():
+		return tarball.tarball
+	wprint(f"{tarball.tarball} doesn't match its manifest")
+	return None
+
+def debootstrap(release: str, target: Path, url: str, minimal: bool=False, cache=None, tarball=None,
+		mirror_url: str=None, staged=None, shell=shell):
+	"""Runs debootstrap for release into target from url
+
+	Arguments:
+		minimal: use the minbase variant
+		cache: a package_cache to take packages from and put them in
+		tarball: a bootstrap_tarball to install from. Built first if it is missing or stale
+		mirror_url: the real mirror when url is a local proxy. Used to check if the tarball is stale
+		staged: a staged_download that was started earlier. Its options win over minimal, cache and tarball.
+			Several installs can share one
+		shell: the pyshell to run debootstrap with. Each install of a fleet logs to its own
+	"""
+	if staged is not None:
+		options = list(staged.options)
+		path = staged.wait()
+		if path is None:
+			wprint("background download didn't finish. downloading now")
+	else:
+		options = bootstrap_options(minimal, cache)
+		path = prepare_tarball(options, release, url, tarball, mirror_url) if tarball is not None else None
+
+	if path is not None:
+		print(f"installing from {path}")
+		options.append(f'--unpack-tarball={path}')
+
+	shell.debootstrap(*options, release, target, url)
+
+	if cache is not None:
+		cache.update(target)
+
+class staged_download(object):
+	"""Downloads everything debootstrap needs in the background
+
+	Start it as soon as we know the mirror and it runs while the disk is being set up.
+	The packages are kept as a debootstrap tarball, in staging or as the bootstrap_tarball if we have one,
+	and debootstrap later installs from it without touching the network.
+
+	Arguments:
+		release, url: what to download and from where
+		minimal, cache, tarball, mirror_url: as for debootstrap
+		staging: where to put the tarball when we don't have a bootstrap_tarball
+	"""
+	def __init__(self, release: str, url: str, minimal: bool=False, cache=None, tarball=None,
+			mirror_url: str=None, staging: Path=STAGING_DIR):
+		self.release = release
+		self.url = url
+		self.tarball = tarball
+		self.mirror_url = mirror_url
+		self.staging = Path(staging)
+		self.options = bootstrap_options(minimal, cache)
+		self.path = None
+		self.error = None
+		self._thread = Thread(target=self._run, daemon=True)
+
+	def start(self):
+		print("downloading packages in the background")
+		self._thread.start()
+		return self
+
+	def _run(self):
+		try:
+			if self.tarball is not None:
+				self.path = prepare_tarball(self.options, self.release, self.url, self.tarball, self.mirror_url)
+				return
+			self.staging.mkdir(parents=True, exist_ok=True)
+			work = Path(mkdtemp(prefix='work-', dir=self.staging))
+			path = self.staging / f"{self.release}.tgz"
+			try:
+				shell.debootstrap(*self.options, f'--make-tarball={path}', self.release, work, self.url)
+			finally:
+				rmtree(work, ignore_errors=True)
+			self.path = path
+		except Exception as error:
+			self.error = error
+
+	def wait(self):
+		'blocks until the download is done. returns the tarball to install from or None if it failed'
+		if self._thread.is_alive():
+			print("waiting for the background download to finish..")
+		self._thread.join()
+		if self.error is not None:
+			wprint(f"background download failed: {self.error}")
+		return self.path
+
+def mirror_release_date(url: str, release: str):
+	'returns the Date of the InRelease for release at url as a datetime, or None if we can\'t get it'
+	parts = urlsplit(url)
+	result = http_get(parts.netloc, f"{parts.path.rstrip('/')}/dists/{release}/InRelease")
+	return result.date
+
+class bootstrap_tarball(object):
+	"""debootstrap tarball of a release kept between installs, with a manifest beside it
+
+	The tarball holds every package debootstrap needs so later installs make no network requests.
+	It is stale once the mirror publishes an InRelease newer than the one it was built from.
+
+	Arguments:
+		root: where tarballs live
+		distro, release, arch: what the tarball is for
+		minimal: whether it is the minbase variant
+	"""
+	def __init__(self, root: Path, distro: str, release: str, minimal: bool, arch: str):
+		variant = 'minbase' if minimal else 'default'
+		self.root = Path(root)
+		self.tarball = self.root / f"{distro}-{release}-{variant}-{arch}.tgz"
+		self.manifest_file = self.tarball.with_suffix('.json')
+		self.key = {'distro': distro, 'release': release, 'variant': variant, 'arch': arch}
+
+	def manifest(self):
+		try:
+			return json.loads(self.manifest_file.read_text())
+		except (OSError, ValueError):
+			return None
+
+	def is_fresh(self, date: datetime=None):
+		"""True if we have a tarball for our key and the mirror hasn't moved past it
+
+		With no date, because we're offline or the mirror didn't answer, any tarball we have is good enough.
+		"""
+		manifest = self.manifest()
+		if manifest is None or not self.tarball.is_file():
+			return False
+		if any(manifest.get(key) != value for key, value in self.key.items()):
+			return False
+		built_from = parse_release_date(manifest.get('release_date'))
+		if date is None or built_from is None:
+			return date is None
+		if date > built_from:
+			print(f"mirror has moved on since {self.tarball.name} was built. rebuilding")
+			return False
+		return True
+
+	def verify(self):
+		manifest = self.manifest()
+		return manifest is not None and self.tarball.is_file() and file_hash(self.tarball) == manifest.get('sha256')
+
+	def build(self, options: list, release: str, url: str, date: datetime=None):
+		'has debootstrap make our tarball and writes the manifest once it is in place'
+		self.root.mkdir(parents=True, exist_ok=True)
+		work = Path(mkdtemp(prefix='build-', dir=self.root))
+		tmp = self.tarball.with_name(self.tarball.name + '.tmp')
+		print(f"building {self.tarball.name}.. this can take a while..")
+		try:
+			shell.debootstrap(*options, f'--make-tarball={tmp}', release, work, url)
+			manifest = dict(self.key)
+			manifest.update({
+				'mirror': url,
+				'release_date': date.strftime('%a, %d %b %Y %H:%M:%S %z') if date is not None else None,
+				'built': datetime.now().isoformat(timespec='seconds'),
+				'size': tmp.stat().st_size,
+				'sha256': file_hash(tmp),
+			})
+			replace(tmp, self.tarball)
+			self.manifest_file.write_text(json.dumps(manifest, indent=1))
+		finally:
+			rmtree(work, ignore_errors=True)
+			if tmp.exists():
+				tmp.unlink()
+
+def deb_name(package: str, version: str, arch: str):
+	'returns the file name apt and debootstrap give a package. The epoch colon is escaped'
+	return f"{package}_{version.replace(':', '%3a')}_{arch}.deb"
+
+def installed_packages(target: Path):
+	'returns a dict of package name to its dpkg status fields for everything installed in target'
+	packages = {}
+	try:
+		status = (target / DPKG_STATUS).read_text()
+	except OSError:
+		return packages
+	for stanza in status.split('\n\n'):
+		fields = {}
+		for line in stanza.splitlines():
+			key, sep, value = line.partition(':')
+			if sep and not key.startswith(' '):
+				fields[key] = value.strip()
+		if 'install ok installed' in fields.get('Status', '') and 'Version' in fields:
+			packages[fields['Package']] = fields
+	return packages
+
+def installed_debs(target: Path):
+	'returns the set of .deb file names for everything installed in target'
+	return {deb_name(name, fields['Version'], fields.get('Architecture', 'all'))
+			for name, fields in installed_packages(target).items()}
+
+class package_cache(object):
+	"""Directory of .deb files kept between installs
+
+	Entries are recorded in a manifest with their size, sha256 and when they were last used.
+	prepare() throws out anything that no longer matches its hash and update() files new
+	downloads, seeds the target for apt, and evicts the least recently used entries over budget.
+
+	Arguments:
+		root: where caches live. Local disk or a mounted share
+		distro, release, arch: what this cache is for. Each gets its own directory
+		budget: the most bytes this cache may use
+	"""
+	def __init__(self, root: Path, distro: str, release: str, arch: str, budget: int):
+		self.dir = Path(root) / distro / release / arch
+		self.manifest_file = self.dir / 'manifest.json'
+		self.budget = budget
+		self.manifest = {}
+		# A fleet of installs all file into the same cache
+		self._lock = Lock()
+
+	def load(self):
+		try:
+			self.manifest = json.loads(self.manifest_file.read_text())
+		except (OSError, ValueError):
+			self.manifest = {}
+
+	def save(self):
+		tmp = self.manifest_file.with_name(self.manifest_file.name + '.tmp')
+		tmp.write_text(json.dumps(self.manifest))
+		replace(tmp, self.manifest_file)
+
+	def prepare(self):
+		'verifies every entry against the manifest. Anything that fails or we know nothing about is removed'
+		self.dir.mkdir(parents=True, exist_ok=True)
+		self.load()
+		removed = 0
+		for deb in self.dir.glob('*.deb'):
+			entry = self.manifest.get(deb.name)
+			if entry is None or deb.stat().st_size != entry['size'] or file_hash(deb) != entry['sha256']:
+				deb.unlink()
+				self.manifest.pop(deb.name, None)
+				removed += 1
+		# Forget entries whose file went missing
+		for name in [name for name in self.manifest if not (self.dir / name).exists()]:
+			del self.manifest[name]
+		if removed:
+			wprint(f"removed {removed} bad packages from {self.dir}")
+		self.save()
+		print(f"package cache {self.dir} has {len(self.manifest)} packages")
+
+	def update(self, target: Path):
+		"""Files what debootstrap left us, marks what target used, seeds its apt archives and evicts
+
+		debootstrap already checked new downloads against the Packages hashes so we record them as they are.
+		"""
+		with self._lock:
+			self._update(target)
+
+	def _update(self, target: Path):
+		now = time()
+		used = installed_debs(target)
+		archives = target / APT_ARCHIVES
+
+		# debootstrap may leave packages in the target as well as the cache
+		for deb in archives.glob('*.deb'):
+			if not (self.dir / deb.name).exists():
+				copyfile(deb, self.dir / deb.name)
+
+		for deb in self.dir.glob('*.deb'):
+			entry = self.manifest.get(deb.name)
+			if entry is None:
+				entry = self.manifest[deb.name] = {'size': deb.stat().st_size, 'sha256': file_hash(deb), 'used': now}
+			if deb.name in used:
+				entry['used'] = now
+				seed(deb, archives / deb.name)
+
+		self.evict()
+		self.save()
+
+	def evict(self):
+		'removes the least recently used entries until we are within budget'
+		total = sum(entry['size'] for entry in self.manifest.values())
+		for name, entry in sorted(self.manifest.items(), key=lambda item: item[1]['used']):
+			if total <= self.budget:
+				break
+			(self.dir / name).unlink()
+			total -= entry['size']
+			del self.manifest[name]
+		print(f"package cache is using {byte_to_gig_trunc(total)} GB")
+
+def seed(source: Path, dest: Path):
+	'puts a copy of source at dest, as a hard link when we can'
+	if dest.exists():
+		return
+	dest.parent.mkdir(parents=True, exist_ok=True)
+	try:
+		link(source, dest)
+	except OSError:
+		copyfile(source, dest)
+
+def file_hash(path: Path):
+	'returns the sha256 of a file'
+	digest = sha256()
+	with open(path, 'rb') as file:
+		for chunk in iter(lambda: file.read(1048576), b''):
+			digest.update(chunk)
+	return digest.hexdigest()
@@ -0,0 +1,144 @@
+# This file is part of volian
+
+# volian is an installer for Debian or Ubuntu.
+# Copyright (C) 2021 Volitank
+
+# volian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# volian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with volian.  If not, see <https://www.gnu.org/licenses/>.
+
+if __name__ == "__main__":
+	print("chroot isn't intended to be run directly.. exiting")
+	exit(1)
+
+import json
+from os import environ
+from os.path import ismount
+from pathlib import Path
+from subprocess import CalledProcessError
+from time import perf_counter
+
+from logger import wprint
+from utils import shell, DEFAULT
+from constant import DPKG_UNSAFE_IO, INSTALL_TIMINGS
+
+## Notes on how to use this module.
+## Everything in the target is installed in one apt transaction without dpkg fsyncing every file
+# install_packages(ROOT_DIR, ['sudo', 'lvm2'], tasks=['standard'])
+## Anything else that has to run in the chroot can use the mounts on their own
+# with chroot_mounts(ROOT_DIR):
+#	shell.chroot(ROOT_DIR, 'update-locale', 'LANG=en_US.UTF-8')
+
+class chroot_mounts(object):
+	"""Mounts proc, sys and dev in root for as long as we're in the with
+
+	Anything that was already mounted is left alone, and only what we mounted is unmounted after.
+	"""
+	MOUNTS = (
+		('proc', ('-t', 'proc', 'proc')),
+		('sys', ('-t', 'sysfs', 'sysfs')),
+		('dev', ('--bind', '/dev')),
+		('dev/pts', ('--bind', '/dev/pts')),
+	)
+
+	def __init__(self, root: Path, shell=shell):
+		self.root = Path(root)
+		self.shell = shell
+		self.mounted = []
+
+	def __enter__(self):
+		for path, options in self.MOUNTS:
+			mount_path = self.root / path
+			if ismount(mount_path):
+				continue
+			mount_path.mkdir(parents=True, exist_ok=True)
+			self.shell.mount(*options, mount_path)
+			self.mounted.append(mount_path)
+		return self
+
+	def __exit__(self, *exc):
+		for mount_path in reversed(self.mounted):
+			self.shell.umount(mount_path)
+		self.mounted = []
+
+def task_packages(root: Path, task: str, shell=shell):
+	'returns the packages in a tasksel task, or an empty list if tasksel can\'t tell us'
+	try:
+		output = shell.chroot(root, 'tasksel', '--task-packages', task, logfile=DEFAULT, capture_output=True).stdout
+	except (CalledProcessError, OSError) as error:
+		wprint(f"unable to list the {task} task: {error}")
+		return []
+	# Older tasksel can give back aptitude patterns, which apt-get can't use
+	return [package for package in output.decode().split() if not package.startswith('~')]
+
+def install_packages(root: Path, packages: list, tasks: list=(), shell=shell, unsafe_io: bool=True):
+	"""Installs packages and every package of tasks into root in a single apt transaction
+
+	With unsafe_io dpkg doesn't fsync every file it unpacks. Nothing is safe on disk until we sync,
+	so we do that once at the end. The option is removed again so the installed system doesn't keep it.
+
+	returns (install seconds, sync seconds)
+	"""
+	root = Path(root)
+	unsafe_file = root / DPKG_UNSAFE_IO
+	env = dict(environ, DEBIAN_FRONTEND='noninteractive')
+
+	start = perf_counter()
+	if unsafe_io:
+		unsafe_file.parent.mkdir(parents=True, exist_ok=True)
+		unsafe_file.write_text("# Written by volian for the install. It removes this when it is done\nforce-unsafe-io\n")
+	try:
+		with chroot_mounts(root, shell):
+			shell.chroot(root, 'apt-get', 'update', env=env)
+			packages = list(packages)
+			for task in tasks:
+				packages.extend(package for package in task_packages(root, task, shell) if package not in packages)
+			print(f"installing {len(packages)} packages in one transaction")
+			shell.chroot(root, 'apt-get', 'install', '--yes', *packages, env=env)
+	finally:
+		if unsafe_file.exists():
+			unsafe_file.unlink()
+	installed = perf_counter() - start
+
+	start = perf_counter()
+	shell.sync()
+	synced = perf_counter() - start
+
+	mode = "without fsync" if unsafe_io else "with fsync"
+	print(f"installed packages {mode} in {installed:.2f}s. the final sync took {synced:.2f}s")
+	report_io_timing('unsafe' if unsafe_io else 'safe', installed + synced, len(packages))
+	return installed, synced
+
+def report_io_timing(mode: str, seconds: float, packages: int, record: Path=INSTALL_TIMINGS):
+	"""Prints how the install did against the last one in the other mode, and keeps this one for next time
+
+	mode is 'unsafe' or 'safe'. seconds counts the final sync, as that is where unsafe io pays.
+	Installs of a different number of packages did different work, so they aren't compared.
+	"""
+	try:
+		timings = json.loads(record.read_text())
+	except (OSError, ValueError):
+		timings = {}
+	timings[mode] = {'seconds': seconds, 'packages': packages}
+	try:
+		record.parent.mkdir(parents=True, exist_ok=True)
+		record.write_text(json.dumps(timings))
+	except OSError:
+		pass
+
+	unsafe = timings.get('unsafe')
+	safe = timings.get('safe')
+	if unsafe is not None and safe is not None and unsafe['packages'] == safe['packages']:
+		print(f"unsafe io took {unsafe['seconds']:.2f}s against {safe['seconds']:.2f}s with --safe-io. "
+			f"{safe['seconds'] / max(unsafe['seconds'], 1e-6):.1f}x faster")
+	elif mode == 'unsafe' and safe is None:
+		print("install once with --safe-io to see how much unsafe io saves")
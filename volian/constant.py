@@ -20,17 +20,55 @@ if __name__ == "__main__":
 	print("constant isn't intended to be run directly.. exiting")
 	exit(1)
 
+from os import cpu_count
 from pathlib import Path
 # Convert our paths into pathlib objects
 
 ESP_SIZE_M = 536870912 # 512M
 BOOT_SIZE_M = 1610612736 # 1.5G
 
+# Partitions start and end on 1MiB, or a multiple of it the device asks for. The GPT keeps 16KiB of entries at each end
+PART_ALIGNMENT = 1048576 # 1M
+GPT_ENTRIES_SIZE = 16384
+# Mount option profiles for fstab. tuned picks options for each filesystem and the disk under it. See tuning.py
+MOUNT_PROFILES = ('tuned', 'defaults')
+
+# Block size we make filesystems with
+FS_BLOCK_SIZE = 4096
+# Size of an LVM physical extent. Logical volumes are whole extents
+LVM_EXTENT = 4194304 # 4M
+
 EFI = 'C12A7328-F81F-11D2-BA4B-00A0C93EC93B'
 LINUX_BOOT = 'BC13C2FF-59E6-4262-A352-B275FD6F7172'
 LINUX_LVM =  'E6D6D379-F507-44C2-A23C-238F2A3DF928'
 LINUX_FILESYSTEM = '0FC63DAF-8483-4772-8E79-3D69D8477DE4'
 DEBIAN_ORG = 'deb.debian.org'
+MASTERLIST_URL = 'https://salsa.debian.org/mirror-team/masterlist/-/raw/master/Mirrors.masterlist'
+MASTERLIST_TIMEOUT = 10
+
+# Mirror probing. Timeout is in seconds and applies to each probe as a whole
+PROBE_TIMEOUT = 2
+PROBE_JOBS = 32
+
+# Mirror bandwidth benchmark. How many of the fastest mirrors to test, how much of Packages.xz to pull from each
+BENCH_TOP = 5
+BENCH_JOBS = 5
+BENCH_SIZE_M = 4
+BENCH_TIMEOUT = 15
+
+# Mirrors whose InRelease Date is older than deb.debian.org by more than this are dropped. In hours
+MAX_MIRROR_LAG_H = 12
+
+# When we know where we are, auto only probes this many of the closest mirrors
+PROBE_NEAREST = 40
+
+# Striping proxy. Connections are per mirror, timeout is in seconds
+STRIPE_CONNECTIONS = 4
+STRIPE_TIMEOUT = 30
+
+# Native bootstrap. How many packages we download at once, and how many processes unpack them
+NATIVE_JOBS = 8
+UNPACK_JOBS = cpu_count() or 1
 
 ## Define file constants
 # Relative files
@@ -40,11 +78,29 @@ LICENSE = files / 'LICENSE'
 VOLIAN_BASHRC = files / '.bashrc'
 VOLIAN_VIM = files / 'defaults.vim'
 MIRROR_MASTER = here / 'Mirrors.masterlist'
+COUNTRY_CENTROIDS = here / 'Country.centroids'
 
 # Host Files
 INTERFACES_FILE = Path('/etc/network/interfaces')
 RESOLV_CONF = Path('/etc/resolv.conf')
 VOLIAN_LOG = Path('/tmp/volian.log')
+STAGING_DIR = Path('/tmp/volian-stage')
+# /tmp doesn't outlive a reboot. Live media keep /var in memory as well, so there use --journal or an answer file
+VOLIAN_JOURNAL = Path('/var/lib/volian/volian.journal')
+TIMEZONE_FILE = Path('/etc/timezone')
+LOCALTIME = Path('/etc/localtime')
+ARCHIVE_KEYRINGS = {
+	'debian': Path('/usr/share/keyrings/debian-archive-keyring.gpg'),
+	'ubuntu': Path('/usr/share/keyrings/ubuntu-archive-keyring.gpg'),
+}
+ZONEINFO = Path('/usr/share/zoneinfo')
+ZONE_TAB = ZONEINFO / 'zone.tab'
+VOLIAN_CACHE = Path('/var/cache/volian')
+MIRROR_CACHE = VOLIAN_CACHE / 'mirrors.cache'
+UPDATED_MASTER = VOLIAN_CACHE / 'Mirrors.masterlist'
+UPDATED_MASTER_META = VOLIAN_CACHE / 'Mirrors.masterlist.meta'
+# How long the last package install took with and without --safe-io, to compare against
+INSTALL_TIMINGS = VOLIAN_CACHE / 'install-timings.json'
 
 # Target files
 LOCALE_FILE = Path('/target/etc/locale.gen')
@@ -59,11 +115,50 @@ TARGET_RESOLV_CONF = Path('/target/etc/resolv.conf')
 INTERFACES_FILE = Path('/target/etc/network/interfaces')
 FSTAB_FILE = Path('/target/etc/fstab')
 
+# Paths inside a target, relative to its root
+APT_ARCHIVES = Path('var/cache/apt/archives')
+DPKG_STATUS = Path('var/lib/dpkg/status')
+DPKG_UNSAFE_IO = Path('etc/dpkg/dpkg.cfg.d/volian-unsafe-io')
+DPKG_INFO = Path('var/lib/dpkg/info')
+POLICY_RC_D = Path('usr/sbin/policy-rc.d')
+
+# Installed in the chroot in one apt transaction, along with the standard task
+TARGET_PACKAGES = ['sudo', 'lvm2', 'grub-efi-amd64', 'command-not-found']
+LUKS_PACKAGES = ['cryptsetup', 'cryptsetup-initramfs']
+
+# Installed-Size leaves out filesystem overhead, logs and what dpkg and apt keep around, so size estimates get this on top
+ESTIMATE_HEADROOM = 1.25
+
+# Package cache budget in GB
+PACKAGE_CACHE_G = 4
+
 # Define chroot constants
 ROOT_DIR = Path('/target')
 BOOT_DIR = Path('/target/boot')
 EFI_DIR = Path('/target/boot/efi')
 
+# How many install stages may run at once
+STAGE_JOBS = 4
+
+# How many filesystems we make at once
+MKFS_JOBS = min(4, cpu_count() or 1)
+
+# Discarding a disk before we partition it. Disks bigger than DISCARD_SPLIT are discarded in DISCARD_JOBS ranges at once
+DISCARD_JOBS = 4
+DISCARD_SPLIT = 68719476736 # 64G
+
+# luks. A bigger key is used if it is at most this much slower. Unlocking takes LUKS_UNLOCK_MS with up to LUKS_PBKDF_MEMORY KiB
+LUKS_KEY_TOLERANCE = 0.85
+LUKS_SECTOR_SIZE = 4096
+LUKS_UNLOCK_MS = 2000
+LUKS_PBKDF_MEMORY = 1048576 # 1G
+
+# Fleet installs. Each target is mounted under FLEET_ROOT and logs to FLEET_LOG_DIR
+FLEET_ROOT = Path('/mnt/volian')
+FLEET_LOG_DIR = Path('/tmp')
+# How many targets we install to at once
+FLEET_JOBS = min(4, cpu_count() or 1)
+
 #BLOCK_DEV = ['hd', 'sd', 'vd', 'md', 'ad', 'nb', 'ftl', 'pd', 'pf', 'mmc']
 FILESYSTEMS = ['ext4', 'ext2', 'fat32', 'xfs', 'btrfs', 'ext3', 'ntfs', 'hfs']
 
@@ -0,0 +1,238 @@
+# This file is part of volian
+
+# volian is an installer for Debian or Ubuntu.
+# Copyright (C) 2021 Volitank
+
+# volian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# volian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with volian.  If not, see <https://www.gnu.org/licenses/>.
+
+if __name__ == "__main__":
+	print("engine isn't intended to be run directly.. exiting")
+	exit(1)
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import perf_counter
+
+from constant import STAGE_JOBS
+
+## Notes on how to use this module.
+## A stage takes the context dict and returns a dict with everything it provides
+# def make_fs(context):
+#	...
+#	return {'mounted': True}
+## Declare what each stage needs and what it gives back, then run the graph on a starting context
+# graph = stage_graph([stage('disk', ask_disk, provides=('disk',), interactive=True),
+#					stage('mkfs', make_fs, requires=('disk',), provides=('mounted',))])
+# context = graph.run({'argument': argument})
+## With a journal, finished stages are recorded and skipped on the next run if they still validate
+# context = graph.run({'argument': argument}, install_journal(key))
+
+class stage_error(Exception):
+	'raised when a graph can never finish or a stage breaks its contract'
+
+class stage(object):
+	"""A single step of the install
+
+	Arguments:
+		name: unique name of the stage
+		func: called with the context dict. Returns a dict of what it provides
+		requires: context keys that must exist before the stage can run
+		provides: context keys the stage adds
+		interactive: the stage talks to the user. These run on the main thread one at a time
+		validate: called with the context restored from a journal. Returns False if what the stage
+			did is no longer true on disk and it has to run again
+		journal: whether to record the stage. Stages whose outputs can't be saved, or shouldn't be,
+			run again on resume, but only if a stage that still has to run needs them
+	"""
+	def __init__(self, name: str, func, requires: tuple=(), provides: tuple=(), interactive: bool=False,
+			validate=None, journal: bool=True):
+		self.name = name
+		self.func = func
+		self.requires = tuple(requires)
+		self.provides = tuple(provides)
+		self.interactive = interactive
+		self.validate = validate
+		self.journal = journal
+
+	def __repr__(self):
+		return f"stage({self.name!r})"
+
+	def run(self, context: dict):
+		result = self.func(context) or {}
+		missing = [key for key in self.provides if key not in result]
+		if missing:
+			raise stage_error(f"stage {self.name} didn't provide {', '.join(missing)}")
+		return result
+
+class stage_graph(object):
+	"""Runs stages as soon as their inputs are ready
+
+	Independent stages run concurrently on a pool of jobs threads, so the install takes as long
+	as its critical path rather than the sum of its stages. Interactive stages run in the order
+	they were added, one at a time, while background stages keep going.
+
+	Wall time of each stage is kept in timings as (start, end) seconds from the start of the run.
+	"""
+	def __init__(self, stages: list=(), jobs: int=STAGE_JOBS):
+		self.stages = []
+		self.jobs = jobs
+		self.timings = {}
+		for node in stages:
+			self.add(node)
+
+	def add(self, node: stage):
+		if any(existing.name == node.name for existing in self.stages):
+			raise stage_error(f"stage {node.name} is defined twice")
+		self.stages.append(node)
+		return node
+
+	def order(self, available):
+		"""Returns our stages in an order they could run in given the keys in available
+
+		Raises stage_error if some stages can never run.
+		"""
+		available = set(available)
+		pending = list(self.stages)
+		ordered = []
+		while pending:
+			ready = [node for node in pending if set(node.requires) <= available]
+			if not ready:
+				missing = {key for node in pending for key in node.requires} - available
+				names = ', '.join(node.name for node in pending)
+				raise stage_error(f"stages {names} can never run. nothing provides {', '.join(sorted(missing)) or 'their inputs'}")
+			for node in ready:
+				available.update(node.provides)
+				pending.remove(node)
+				ordered.append(node)
+		return ordered
+
+	def check(self, available):
+		'makes sure every stage can eventually run given the keys in available'
+		self.order(available)
+
+	def resume(self, context: dict, journal):
+		"""Works out which stages a journal lets us skip and puts their outputs in context
+
+		A journaled stage is skipped if it finished, everything it depends on is skipped as well
+		and it still validates. Stages that aren't journaled are skipped when nothing left needs them.
+
+		returns the set of stage names to skip
+		"""
+		done = journal.load()
+		skip = set()
+		providers = {key: node for node in self.stages for key in node.provides}
+
+		for node in self.order(context):
+			if not node.journal or node.name not in done:
+				continue
+			depends = {providers[key] for key in node.requires if key in providers}
+			if any(depend.journal and depend.name not in skip for depend in depends):
+				journal.forget(node.name)
+				continue
+			restored = dict(context)
+			restored.update(done[node.name])
+			if node.validate is not None and not node.validate(restored):
+				print(f"{node.name} has to be done again")
+				journal.forget(node.name)
+				continue
+			context.update(done[node.name])
+			skip.add(node.name)
+
+		# Drop stages we can't journal if nothing that is left to run needs them
+		while True:
+			needed = {key for node in self.stages if node.name not in skip for key in node.requires}
+			unneeded = [node for node in self.stages if not node.journal and node.name not in skip
+						and node.provides and not set(node.provides) & needed]
+			if not unneeded:
+				break
+			skip.update(node.name for node in unneeded)
+
+		if skip:
+			print(f"resuming install. already done: {', '.join(node.name for node in self.stages if node.name in skip)}")
+		return skip
+
+	def run(self, context: dict, journal=None):
+		"""Runs every stage and returns the context with all outputs in it
+
+		With a journal, stages it lets us skip are skipped and every stage is recorded as it finishes.
+		If a stage fails we let the ones already running finish and then raise its error.
+		"""
+		skip = self.resume(context, journal) if journal is not None else set()
+		self.check(set(context) | {key for node in self.stages if node.name in skip for key in node.provides})
+		pending = [node for node in self.stages if node.name not in skip]
+		running = {}
+		self._start = perf_counter()
+		error = None
+
+		with ThreadPoolExecutor(max_workers=max(1, self.jobs)) as pool:
+			while pending or running:
+				ready = [node for node in pending if all(key in context for key in node.requires)] if error is None else []
+
+				for node in [node for node in ready if not node.interactive]:
+					pending.remove(node)
+					running[pool.submit(self._timed, node, dict(context))] = node
+
+				interactive = [node for node in ready if node.interactive]
+				if interactive:
+					node = interactive[0]
+					pending.remove(node)
+					try:
+						self._finished(node, self._timed(node, context), context, journal)
+					except BaseException as err:
+						error = err
+					# Pick up anything that finished while the user was busy
+					done = [future for future in running if future.done()]
+				elif running:
+					done, _ = wait(running, return_when=FIRST_COMPLETED)
+				elif pending and error is None:
+					# check() makes sure this can't happen unless a stage lied about what it provides
+					raise stage_error(f"stages {', '.join(node.name for node in pending)} can't run")
+				else:
+					break
+
+				for future in done:
+					node = running.pop(future)
+					try:
+						self._finished(node, future.result(), context, journal)
+					except BaseException as err:
+						if error is None:
+							error = err
+
+		if error is not None:
+			raise error
+		return context
+
+	def _finished(self, node: stage, result: dict, context: dict, journal):
+		context.update(result)
+		if journal is not None and node.journal:
+			journal.record(node.name, result)
+
+	def _timed(self, node: stage, context: dict):
+		start = perf_counter() - self._start
+		try:
+			return node.run(context)
+		finally:
+			self.timings[node.name] = (start, perf_counter() - self._start)
+
+	def print_timings(self):
+		'prints when each stage ran and how the total compares to running them one after another'
+		if not self.timings:
+			return
+		col_width = max(len(name) for name in self.timings) + 1
+		col_width = max(col_width, len("Stage:") + 1)
+		print("Stage:".ljust(col_width), "Start:".ljust(10), "End:".ljust(10), "Took:")
+		for name, (start, end) in sorted(self.timings.items(), key=lambda item: item[1]):
+			print(name.ljust(col_width), f"{start:.2f}s".ljust(10), f"{end:.2f}s".ljust(10), f"{end - start:.2f}s")
+		total = max(end for start, end in self.timings.values())
+		serial = sum(end - start for start, end in self.timings.values())
+		print(f"finished in {total:.2f}s. one after another this would have taken {serial:.2f}s")
@@ -0,0 +1,159 @@
+# This file is part of volian
+
+# volian is an installer for Debian or Ubuntu.
+# Copyright (C) 2021 Volitank
+
+# volian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# volian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with volian.  If not, see <https://www.gnu.org/licenses/>.
+
+if __name__ == "__main__":
+	print("fleet isn't intended to be run directly.. exiting")
+	exit(1)
+
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from logger import eprint
+from journal import install_journal
+from utils import pyshell, DEFAULT
+from constant import FLEET_JOBS, FLEET_LOG_DIR, FLEET_ROOT, VOLIAN_JOURNAL
+
+## Notes on how to use this module.
+## Targets are block devices or image files. Image files are attached to loop devices
+# targets = [install_target(Path('/dev/sdb'), 'debian'), install_target(Path('/srv/rack1.img'), 'debian')]
+# for target in targets:
+#	target.attach(gig_to_byte(8))
+## Run what the targets share once, then hand each a copy of the context and its own graph
+# failed = fleet_install(targets, context, lambda: install_graph(jobs, shared=False))
+
+class fleet_error(Exception):
+	'raised when a fleet target can\'t be used'
+
+class install_target(object):
+	"""One disk of a fleet install
+
+	Every target gets its own mount root, volume group, luks name, log and journal so they can't get in each others way.
+
+	Arguments:
+		path: a block device or an image file
+		distro: used to name the volume group
+		journal_dir: where the journal goes
+	"""
+	def __init__(self, path: Path, distro: str, journal_dir: Path=VOLIAN_JOURNAL.parent):
+		self.path = Path(path)
+		self.image = not self.path.is_block_device()
+		self.disk = None if self.image else self.path
+		# Names end up in lvm and device mapper names, which are picky.
+		# device mapper writes a - in a volume group name as --, so fstab would point at something that isn't there
+		self.name = re.sub('[^a-zA-Z0-9_.+]', '_', self.path.stem if self.image else self.path.name)
+		self.root = FLEET_ROOT / self.name
+		self.volume = f"{distro}_{self.name}"
+		self.luks_name = f"root_crypt_{self.name}"
+		self.log = FLEET_LOG_DIR / f"volian-{self.name}.log"
+		self.journal = Path(journal_dir) / f"volian-{self.name}.journal"
+		self.shell = pyshell(logfile=self.log, check=True)
+		self.graph = None
+		self.error = None
+
+	def __repr__(self):
+		return f"install_target({str(self.path)!r})"
+
+	def attach(self, size: int=None):
+		"""Returns the block device for this target
+
+		Image files are attached to a loop device with their partitions scanned, reusing one that is already attached.
+		A missing image file is made as a sparse file of size bytes.
+		"""
+		if not self.image:
+			return self.disk
+		if not self.path.exists():
+			if size is None:
+				raise fleet_error(f"{self.path} doesn't exist. use --image-size to make it")
+			with open(self.path, 'wb') as file:
+				file.truncate(int(size))
+			print(f"made {self.path} as a sparse file")
+
+		# losetup -j lists loop devices already backed by our file. '/dev/loop0: [2049]:1234 (/srv/rack1.img)'
+		attached = self.shell.losetup('-j', self.path, logfile=DEFAULT, capture_output=True).stdout.decode().split('\n')
+		if attached[0]:
+			self.disk = Path(attached[0].split(':')[0])
+		else:
+			self.disk = Path(self.shell.losetup('-fP', '--show', self.path, logfile=DEFAULT, capture_output=True).stdout.decode().strip())
+		print(f"{self.path} is attached to {self.disk}")
+		return self.disk
+
+	def context(self, context: dict):
+		'returns a copy of the shared context for this target'
+		context = dict(context)
+		if context.get('answers') is not None:
+			context['answers'] = dict(context['answers'], disk=self.disk)
+		context.update({
+			'root': self.root,
+			'shell': self.shell,
+			'log': self.log,
+			'volume': self.volume,
+			'luks_name': self.luks_name,
+			'fleet': True,
+		})
+		return context
+
+def fleet_install(targets: list, context: dict, make_graph, jobs: int=FLEET_JOBS, key: dict=None, fresh: bool=False):
+	"""Installs to every target at once, up to jobs at a time
+
+	Arguments:
+		targets: install_targets that are attached
+		context: the context after the stages every target shares have run
+		make_graph: returns a new stage_graph with the stages each target runs
+		key: what has to match for a target's journal to be used. No journals without it
+		fresh: ignore the journals
+
+	returns the targets that failed. Their error is kept on them
+	"""
+	def install(target):
+		journal = None
+		if key is not None:
+			journal = install_journal(key, target.journal)
+			if fresh:
+				journal.clear()
+		target.graph = make_graph()
+		target.graph.run(target.context(context), journal)
+		if journal is not None:
+			journal.clear()
+
+	print(f"installing to {len(targets)} targets, {jobs} at a time")
+	with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+		futures = {pool.submit(install, target): target for target in targets}
+		for future in as_completed(futures):
+			target = futures[future]
+			try:
+				future.result()
+				print(f"{target.disk} finished")
+			except Exception as error:
+				target.error = error
+				eprint(f"{target.disk} failed: {error}. see {target.log}")
+
+	print_fleet(targets)
+	return [target for target in targets if target.error is not None]
+
+def print_fleet(targets: list):
+	'prints how each target went and how long it took'
+	col_width = max(len(str(target.path)) for target in targets) + 1
+	col_width = max(col_width, len("Target:") + 1)
+	print("Target:".ljust(col_width), "Device:".ljust(14), "Took:".ljust(10), "Result:")
+	for target in targets:
+		took = '-'
+		if target.graph is not None and target.graph.timings:
+			took = f"{max(end for start, end in target.graph.timings.values()):.2f}s"
+		result = 'ok' if target.error is None else f"failed. see {target.log}"
+		print(str(target.path).ljust(col_width), str(target.disk).ljust(14), took.ljust(10), result)
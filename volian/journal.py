@@ -0,0 +1,117 @@
+# This file is part of volian
+
+# volian is an installer for Debian or Ubuntu.
+# Copyright (C) 2021 Volitank
+
+# volian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# volian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with volian.  If not, see <https://www.gnu.org/licenses/>.
+
+if __name__ == "__main__":
+	print("journal isn't intended to be run directly.. exiting")
+	exit(1)
+
+import json
+from os import replace
+from pathlib import Path, PurePath
+from threading import Lock
+
+from logger import wprint
+from partition import partition
+from constant import VOLIAN_JOURNAL
+
+## Notes on how to use this module.
+## key is whatever has to match for an old journal to be any use to us
+# journal = install_journal({'distro': 'debian', 'release': 'stable'})
+## Hand it to stage_graph.run. It records each stage as it finishes and skips them next time
+# graph.run(context, journal)
+
+def encode(value):
+	'turns value into something json can hold. Paths, tuples and partitions are tagged so decode can bring them back'
+	if isinstance(value, PurePath):
+		return {'__path__': str(value)}
+	if isinstance(value, tuple):
+		return {'__tuple__': [encode(item) for item in value]}
+	if isinstance(value, list):
+		return [encode(item) for item in value]
+	if isinstance(value, dict):
+		return {key: encode(item) for key, item in value.items()}
+	if isinstance(value, partition):
+		return {'__partition__': {key: encode(item) for key, item in vars(value).items()}}
+	if value is None or isinstance(value, (str, int, float, bool)):
+		return value
+	raise TypeError(f"can't journal {type(value).__name__}")
+
+def decode(value):
+	if isinstance(value, list):
+		return [decode(item) for item in value]
+	if isinstance(value, dict):
+		if '__path__' in value:
+			return Path(value['__path__'])
+		if '__tuple__' in value:
+			return tuple(decode(item) for item in value['__tuple__'])
+		if '__partition__' in value:
+			fields = {key: decode(item) for key, item in value['__partition__'].items()}
+			restored = partition(fields.pop('path'), fields.pop('size'), fields.pop('filesystem'), fields.pop('name'))
+			vars(restored).update(fields)
+			return restored
+		return {key: decode(item) for key, item in value.items()}
+	return value
+
+class install_journal(object):
+	"""Record of the stages an install has finished and what they produced
+
+	Kept as json and rewritten atomically after every stage, so a crash leaves the last good copy.
+	A journal written for a different key is ignored.
+
+	Arguments:
+		key: dict of what has to match for the journal to apply. The distro, release and options
+		path: where the journal lives
+	"""
+	def __init__(self, key: dict, path: Path=VOLIAN_JOURNAL):
+		self.key = encode(key)
+		self.path = path
+		self.stages = {}
+		self._lock = Lock()
+
+	def load(self):
+		'reads the journal. returns a dict of stage name to its outputs'
+		try:
+			data = json.loads(self.path.read_text())
+		except (OSError, ValueError):
+			return {}
+		if data.get('key') != self.key:
+			wprint(f"{self.path} is from a different install. starting fresh")
+			return {}
+		self.stages = data.get('stages', {})
+		return {name: decode(outputs) for name, outputs in self.stages.items()}
+
+	def record(self, name: str, outputs: dict):
+		with self._lock:
+			self.stages[name] = encode(outputs)
+			self._write()
+
+	def forget(self, name: str):
+		with self._lock:
+			if self.stages.pop(name, None) is not None:
+				self._write()
+
+	def clear(self):
+		self.stages = {}
+		if self.path.exists():
+			self.path.unlink()
+
+	def _write(self):
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		tmp = self.path.with_name(self.path.name + '.tmp')
+		tmp.write_text(json.dumps({'key': self.key, 'stages': self.stages}, indent=1))
+		replace(tmp, self.path)
@@ -0,0 +1,194 @@
+# This file is part of volian
+
+# volian is an installer for Debian or Ubuntu.
+# Copyright (C) 2021 Volitank
+
+# volian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# volian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with volian.  If not, see <https://www.gnu.org/licenses/>.
+
+if __name__ == "__main__":
+	print("luks isn't intended to be run directly.. exiting")
+	exit(1)
+
+import re
+from pathlib import Path
+from platform import release
+from subprocess import CalledProcessError
+from threading import Lock
+
+from logger import wprint
+from topology import disk_topology
+from utils import shell, DEFAULT
+from constant import LUKS_KEY_TOLERANCE, LUKS_PBKDF_MEMORY, LUKS_SECTOR_SIZE, LUKS_UNLOCK_MS
+
+## Notes on how to use this module.
+## Benchmark what this cpu does best and work out the options for luksFormat and open from it
+# tuning = tune_luks(Path('/dev/nvme0n1'), log=VOLIAN_LOG)
+# shell.cryptsetup.luksFormat(*tuning['format'], luks_disk, input=luks_pass)
+# shell.cryptsetup.open(*tuning['open'], luks_disk, luks_name, input=luks_pass)
+
+# What we use when the benchmark can't tell us anything
+DEFAULT_CIPHER = ('aes-xts-plain64', 512)
+
+# '        aes-xts        512b      2760.4 MiB/s      2758.9 MiB/s'
+BENCHMARK_LINE = re.compile(r'^\s*(\S+)\s+(\d+)b\s+([\d.]+) ([KMG])iB/s\s+([\d.]+) ([KMG])iB/s', re.M)
+UNITS = {'K': 1 / 1024, 'M': 1, 'G': 1024}
+
+# The workqueue flags are in cryptsetup 2.3.4 and linux 5.9 and up
+WORKQUEUE_CRYPTSETUP = (2, 3, 4)
+WORKQUEUE_LINUX = (5, 9)
+# --sector-size came with luks2 in cryptsetup 2.0
+SECTOR_SIZE_CRYPTSETUP = (2, 0)
+
+def version(text: str):
+	'returns the first dotted version in text as a tuple of ints'
+	match = re.search(r'(\d+(?:\.\d+)+)', text)
+	return tuple(int(part) for part in match.group(1).split('.')) if match else (0,)
+
+def aes_ni():
+	'whether the cpu has AES-NI'
+	try:
+		return any(line.startswith('flags') and ' aes ' in f"{line} " for line in Path('/proc/cpuinfo').read_text().splitlines())
+	except OSError:
+		return False
+
+def mem_total():
+	'returns the memory we have in KiB'
+	try:
+		for line in Path('/proc/meminfo').read_text().splitlines():
+			if line.startswith('MemTotal:'):
+				return int(line.split()[1])
+	except (OSError, ValueError):
+		pass
+	return 0
+
+_benchmark = None
+_benchmark_lock = Lock()
+
+def benchmark(shell=shell):
+	"""Runs cryptsetup benchmark
+
+	returns (a list of (cipher, key bits, encryption MiB/s, decryption MiB/s), the output as it was)
+	Ciphers the kernel doesn't have are left out. Both are empty if cryptsetup can't benchmark.
+	It only runs once, so fleet targets don't all benchmark at the same time and skew each other.
+	"""
+	global _benchmark
+	with _benchmark_lock:
+		if _benchmark is None:
+			try:
+				output = shell.cryptsetup.benchmark(logfile=DEFAULT, capture_output=True).stdout.decode()
+			except (CalledProcessError, OSError) as error:
+				wprint(f"cryptsetup benchmark failed: {error}")
+				return [], ''
+			results = []
+			for match in BENCHMARK_LINE.finditer(output):
+				cipher, bits, encrypt, encrypt_unit, decrypt, decrypt_unit = match.groups()
+				results.append((cipher, int(bits), float(encrypt) * UNITS[encrypt_unit], float(decrypt) * UNITS[decrypt_unit]))
+			_benchmark = (results, output)
+		return _benchmark
+
+def choose_cipher(results: list, aes: bool=True):
+	"""Returns (cipher, key size) for luksFormat from benchmark results
+
+	Only the disk modes, xts and adiantum, are considered. The cipher that is fastest at the slower
+	of encrypting and decrypting wins. Its biggest key is used unless that is more than
+	LUKS_KEY_TOLERANCE slower than its fastest.
+
+	aes is whether the cpu has AES-NI. With it aes-xts wins unless something else is more than
+	LUKS_KEY_TOLERANCE faster. Without it aes is table lookups in software, so it is only used
+	when nothing else benchmarked.
+	"""
+	disk = [result for result in results if result[0].endswith('-xts') or result[0].endswith('-adiantum')]
+	if not disk:
+		return DEFAULT_CIPHER
+	speed = lambda result: min(result[2], result[3])
+	hardware = [result for result in disk if result[0] == 'aes-xts']
+	if aes and hardware and speed(max(hardware, key=speed)) >= speed(max(disk, key=speed)) * LUKS_KEY_TOLERANCE:
+		disk = hardware
+	elif not aes:
+		disk = [result for result in disk if result[0] != 'aes-xts'] or disk
+	best = max(disk, key=speed)
+	keys = [result for result in disk if result[0] == best[0] and speed(result) >= speed(best) * LUKS_KEY_TOLERANCE]
+	cipher, bits, encrypt, decrypt = max(keys, key=lambda result: result[1])
+	return f"{cipher}-plain64", bits
+
+def cryptsetup_version(shell=shell):
+	'returns the version of cryptsetup as a tuple of ints, (0,) if it won\'t say'
+	try:
+		return version(shell.cryptsetup('--version', logfile=DEFAULT, capture_output=True).stdout.decode())
+	except (CalledProcessError, OSError):
+		return (0,)
+
+def sector_size(topology, cryptsetup: tuple):
+	"""Returns (the luks sector size or None for cryptsetup's own choice, why)
+
+	4096 byte sectors are only used when the disk really writes 4096 bytes at a time.
+	Our partitions are on at least a 1MiB grain, so they can always be split into them.
+	"""
+	if cryptsetup == (0,):
+		return None, "cryptsetup wouldn't give its version"
+	if cryptsetup < SECTOR_SIZE_CRYPTSETUP:
+		return None, f"cryptsetup {'.'.join(map(str, cryptsetup))} is older than 2.0"
+	if topology.physical < LUKS_SECTOR_SIZE:
+		return None, f"the physical block size is {topology.physical}"
+	return LUKS_SECTOR_SIZE, f"the physical block size is {topology.physical}"
+
+def workqueue_flags(topology, cryptsetup: tuple):
+	'returns the flags that skip the dm-crypt workqueues. Only worth it on fast flash, where the queues are what slows us down'
+	if topology.rotational or not topology.device.name.startswith('nvme'):
+		return []
+	if cryptsetup < WORKQUEUE_CRYPTSETUP or version(release()) < WORKQUEUE_LINUX:
+		return []
+	return ['--perf-no_read_workqueue', '--perf-no_write_workqueue']
+
+def tune_luks(disk: Path, log: Path=None, shell=shell):
+	"""Works out the luksFormat and open options for a luks volume on disk
+
+	The cipher comes from cryptsetup benchmark and whether we have AES-NI. 4096 byte sectors are used when
+	the disk's physical blocks are that big and cryptsetup is new enough. argon2id is given LUKS_UNLOCK_MS
+	to unlock in with up to LUKS_PBKDF_MEMORY, or half our memory.
+	On fast NVMe the workqueue flags are set, and kept in the luks header for the installed system.
+
+	The benchmark and what we chose are written to log.
+	returns a dict with 'format' and 'open', the options for each
+	"""
+	results, output = benchmark(shell)
+	aes = aes_ni()
+	cipher, key_size = choose_cipher(results, aes)
+	topology = disk_topology(disk)
+	cryptsetup = cryptsetup_version(shell)
+
+	options = ['--batch-mode', '--type', 'luks2', '--cipher', cipher, f"--key-size={key_size}", '--hash=sha512']
+	sector, why = sector_size(topology, cryptsetup)
+	if sector is not None:
+		options.extend(('--sector-size', str(sector)))
+	memory = LUKS_PBKDF_MEMORY
+	if mem_total():
+		memory = min(memory, mem_total() // 2)
+	options.extend(('--pbkdf', 'argon2id', '--iter-time', str(LUKS_UNLOCK_MS), '--pbkdf-memory', str(memory)))
+
+	open_options = workqueue_flags(topology, cryptsetup)
+	if open_options:
+		open_options.append('--persistent')
+
+	choices = (
+		f"AES-NI: {'yes' if aes else 'no'}\n"
+		f"luks sector size: {sector or 'cryptsetup default'}, {why}\n"
+		f"luks format options: {' '.join(options)}\n"
+		f"luks open options: {' '.join(open_options) or 'none'}\n"
+	)
+	print(f"luks will use {cipher} with a {key_size} bit key")
+	if log is not None:
+		with open(log, 'a') as file:
+			file.write(f"cryptsetup benchmark:\n{output or 'failed'}\n{choices}")
+	return {'format': options, 'open': open_options}
@@ -20,79 +20,831 @@ if __name__ == "__main__":
 	print("partition isn't intended to be run directly.. exiting")
 	exit(1)
 
-from constant import DEBIAN_ORG, MIRROR_MASTER
-from utils import ask, ask_list
+import json
+import marshal
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from hashlib import sha256
+from http.client import HTTPConnection, HTTPException
+from math import asin, cos, radians, sin, sqrt
+from os import environ, readlink, replace
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from time import perf_counter
+import requests
+
+from logger import wprint
+from constant import (	DEBIAN_ORG, MIRROR_MASTER, MIRROR_CACHE, PROBE_TIMEOUT, PROBE_JOBS,
+						UPDATED_MASTER, UPDATED_MASTER_META, MASTERLIST_URL, MASTERLIST_TIMEOUT,
+						BENCH_TOP, BENCH_JOBS, BENCH_SIZE_M, BENCH_TIMEOUT, MAX_MIRROR_LAG_H,
+						PROBE_NEAREST, COUNTRY_CENTROIDS, TIMEZONE_FILE, LOCALTIME, ZONEINFO, ZONE_TAB
+						)
+from utils import ask, ask_list, meg_to_byte
+
+# Bump this whenever the layout of the compiled cache changes
+CACHE_VERSION = 1
+
+# InRelease probes for this run keyed by (site, release) so each mirror is only contacted once
+_release_cache = {}
 
 ## Notes on how to use this module.
 # arch = 'amd64'
-## parse the master list
-# master_list = parse_mirror_master()
+## load our index. This uses the compiled cache and only parses the master list when it changed
+# index = load_mirror_index()
 
-## Pass the master list to get the country list
-# country_list = get_country_list(master_list, arch)
+## Pass the index to get the country list
+# country_list = get_country_list(index, arch)
 
 ## user picks country with ask list
 # country = ask_list(country_list)
 
 ## Now that we have a country we can get a URL list of that countries sites
-# url_list = get_url_list(master_list, country, arch)
+# url_list = get_url_list(index, country, arch)
 
 ## Now we can ask the user what mirror they would like to use
 # ask_list(url_list, country, arch)
 
-def parse_mirror_master():
-	with open(MIRROR_MASTER, 'r') as mirror_list:
-		data = mirror_list.read()
-		# Split data into list by empty line
-		master_list = data.split('\n\n')
-		# Remove all empty entries from the list
-		master_list = list(filter(('').__ne__, master_list))	
-		return master_list
-
-def get_country_list(master_list, arch):
-	'Takes our initally parsed mirror list and returns a list of countries'
-	country_set = set()
-
-	# Split data into their own comfy list
-	for n in range(0, len(master_list)):
-		mirror_data = master_list[n].splitlines()
-
-		# We get all of the applicable repos and then put their country in a set
-		# The set doesn't allow for duplicates so we can get a consise list
-		if arch in str(mirror_data) and 'Archive-http:' in str(mirror_data):
-			if 'Country' in mirror_data[1]:
-				# We take the data, remove Country header, strip white space and the country code
-				add_set = mirror_data[1].replace('Country:', '').strip()[3:]
-				country_set.add(add_set)
-			if 'Country' in mirror_data[2]:
-				# Country may be in the third place, so just to be sure we do a chekc here too
-				add_set = mirror_data[2].replace('Country:', '').strip()[3:]
-				country_set.add(add_set)
-		# We need it a list so we convert it back and then sort alphabetically
-		country_list = list(country_set)
-		country_list.sort()
-	return country_list
-
-def get_url_list(master_list, country, arch):
-	'Takes our initally parsed mirror list and returns a list of urls in the country we choose'
-	url_list = []
-	for n in range(0, len(master_list)):
-		mirror_data = master_list[n].splitlines()
-		if arch in str(mirror_data) and 'Archive-http:' in str(mirror_data):
-			if country in str(mirror_data):
-				url_list.append(mirror_data[0].replace('Site:', '').strip())
-	return url_list
+class mirror_site(object):
+	"""Object representing a single site from the masterlist
+
+	Only the fields we actually use are kept. __slots__ keeps the few hundred of these small.
+	"""
+	__slots__ = ('site', 'country_code', 'country', 'location', 'arch', 'http', 'rsync')
+
+	def __init__(self,
+			site: str, country_code: str=None, country: str=None,
+			location: str=None, arch: frozenset=frozenset(),
+			http: str=None, rsync: str=None):
+		self.site = site
+		self.country_code = country_code
+		self.country = country
+		self.location = location
+		self.arch = arch
+		self.http = http
+		self.rsync = rsync
+
+	def __repr__(self):
+		return f"mirror_site({self.site!r}, {self.country_code!r}, {self.http!r})"
+
+	def to_tuple(self):
+		'returns the site as a plain tuple that marshal can handle'
+		return (self.site, self.country_code, self.country, self.location, tuple(sorted(self.arch)), self.http, self.rsync)
+
+	@classmethod
+	def from_tuple(cls, data: tuple):
+		site, country_code, country, location, arch, http, rsync = data
+		return cls(site, country_code, country, location, frozenset(arch), http, rsync)
+
+def parse_mirror_master(master=MIRROR_MASTER):
+	with open(master, 'r') as mirror_list:
+		return split_mirror_master(mirror_list.read())
+
+def split_mirror_master(data: str):
+	'splits the raw master list into one entry per site'
+	# Split data into list by empty line
+	master_list = data.split('\n\n')
+	# Remove all empty entries from the list
+	return list(filter(('').__ne__, master_list))
+
+def parse_mirror_data(master_list):
+	'Takes our initially parsed mirror list and returns a list of mirror_site objects'
+	site_list = []
+	for block in master_list:
+		fields = {}
+		for line in block.splitlines():
+			# Every line is 'Field: value'. We only keep the first of repeated fields like Sponsor
+			key, sep, value = line.partition(':')
+			key = key.strip()
+			if sep and key not in fields:
+				fields[key] = value.strip()
+
+		site = fields.get('Site')
+		if site is None:
+			continue
+
+		country_code = country = None
+		if 'Country' in fields:
+			# Country is the two letter code followed by the name 'US United States'
+			country_code, _, country = fields['Country'].partition(' ')
+
+		site_list.append(mirror_site(
+			site, country_code, country or None,
+			fields.get('Location'),
+			frozenset(fields.get('Archive-architecture', '').split()),
+			fields.get('Archive-http'),
+			fields.get('Archive-rsync'),
+		))
+	return site_list
+
+class mirror_index(object):
+	"""Index of the archive mirrors in the masterlist
+
+	Built once so every lookup after that is a dict access instead of a scan.
+	by_country and by_arch map to lists of site names, use get() for the full record.
+
+	Arguments:
+		site_list: a list of mirror_site objects, usually from parse_mirror_data
+		tables: the output of tables() from a previous index. Skips building the indexes
+	"""
+	def __init__(self, site_list: list, tables: tuple=None):
+		# Only sites that serve the archive over http are of any use to debootstrap
+		self.sites = {mirror.site: mirror for mirror in site_list if mirror.http is not None}
+
+		if tables is not None:
+			self.by_country, self.by_arch, self._countries, self._urls = tables
+			return
+
+		self.by_country = {}
+		self.by_arch = {}
+		self._countries = {}
+		self._urls = {}
+
+		for mirror in self.sites.values():
+			if mirror.country is not None:
+				self.by_country.setdefault(mirror.country, []).append(mirror.site)
+			for arch in mirror.arch:
+				self.by_arch.setdefault(arch, []).append(mirror.site)
+				if mirror.country is not None:
+					self._urls.setdefault(f"{mirror.country}\0{arch}", []).append(mirror.site)
+
+		# The prompts want sorted country names per arch so we do that up front as well
+		for arch, site_list in self.by_arch.items():
+			self._countries[arch] = sorted({self.sites[site].country for site in site_list if self.sites[site].country is not None})
+
+	def tables(self):
+		'returns our indexes as plain dicts so they can be cached'
+		return self.by_country, self.by_arch, self._countries, self._urls
+
+	def countries(self, arch: str):
+		'returns a sorted list of countries that have a mirror for arch'
+		return self._countries.get(arch, [])
+
+	def urls(self, country: str, arch: str):
+		'returns a list of sites in country that have a mirror for arch'
+		return self._urls.get(f"{country}\0{arch}", [])
+
+	def get(self, site: str):
+		'returns the mirror_site for site or None'
+		return self.sites.get(site)
+
+def current_mirror_master():
+	'returns the refreshed master list if we have one, otherwise the one we ship with'
+	if UPDATED_MASTER.is_file():
+		return UPDATED_MASTER
+	return MIRROR_MASTER
+
+def update_mirror_master(url: str=MASTERLIST_URL, target=UPDATED_MASTER, meta=UPDATED_MASTER_META,
+		timeout: float=MASTERLIST_TIMEOUT):
+	"""Refreshes our copy of the master list from url with a conditional GET
+
+	The ETag and Last-Modified of the last download are kept in meta beside target.
+	A new download is streamed to a temp file and swapped in atomically, but only if the content
+	actually changed so the compiled index cache stays valid otherwise.
+	Any failure leaves things as they were and we carry on with the copy we have.
+	So does anything that doesn't parse to at least one Site:, like a login page.
+
+	returns True if target changed
+	"""
+	try:
+		validators = json.loads(meta.read_text()) if target.is_file() else {}
+	except (OSError, ValueError):
+		validators = {}
+
+	headers = {'User-Agent': 'volian'}
+	if validators.get('etag'):
+		headers['If-None-Match'] = validators['etag']
+	if validators.get('last_modified'):
+		headers['If-Modified-Since'] = validators['last_modified']
+
+	tmp = None
+	try:
+		with requests.get(url, headers=headers, timeout=timeout, stream=True) as response:
+			if response.status_code == 304:
+				return False
+			response.raise_for_status()
+
+			target.parent.mkdir(parents=True, exist_ok=True)
+			digest = sha256()
+			with NamedTemporaryFile(dir=target.parent, prefix=target.name, delete=False) as file:
+				tmp = Path(file.name)
+				for chunk in response.iter_content(65536):
+					digest.update(chunk)
+					file.write(chunk)
+
+			validators = {
+				'etag': response.headers.get('ETag'),
+				'last_modified': response.headers.get('Last-Modified'),
+			}
+
+		# A captive portal answers 200 as well. Only a list with mirrors in it replaces the one we have
+		try:
+			sites = parse_mirror_data(parse_mirror_master(tmp))
+		except (OSError, ValueError):
+			sites = []
+		if not sites:
+			wprint(f"{url} didn't give us a mirror list. keeping the one we have")
+			return False
+
+		changed = not target.is_file() or sha256(target.read_bytes()).hexdigest() != digest.hexdigest()
+		if changed:
+			tmp.chmod(0o644)
+			replace(tmp, target)
+			tmp = None
+		meta.write_text(json.dumps(validators))
+		return changed
+
+	except (requests.RequestException, OSError):
+		return False
+	finally:
+		if tmp is not None and tmp.exists():
+			tmp.unlink()
+
+def load_mirror_index(master=None, cache=MIRROR_CACHE):
+	"""Returns a mirror_index, using the compiled cache when it matches the master list
+
+	The cache is keyed by the size, mtime and sha256 of the master list.
+	If size and mtime match we trust it without reading the master list at all.
+	If they don't we hash the master list and only reparse when the content changed.
+	master defaults to current_mirror_master()
+	"""
+	if master is None:
+		master = current_mirror_master()
+	stat = master.stat()
+	cached = None
+	try:
+		cached = marshal.loads(cache.read_bytes())
+		version, size, mtime, digest, site_data, tables = cached
+		if version == CACHE_VERSION and (size, mtime) == (stat.st_size, stat.st_mtime_ns):
+			return mirror_index([mirror_site.from_tuple(data) for data in site_data], tables)
+	except (OSError, EOFError, ValueError, TypeError):
+		cached = None
+
+	data = master.read_bytes()
+	new_digest = sha256(data).hexdigest()
+	if cached is not None and cached[0] == CACHE_VERSION and cached[3] == new_digest:
+		# Only the mtime moved. Keep what we have and just update our key
+		site_data, tables = cached[4], cached[5]
+		index = mirror_index([mirror_site.from_tuple(data) for data in site_data], tables)
+	else:
+		index = mirror_index(parse_mirror_data(split_mirror_master(data.decode())))
+		site_data = tuple(mirror.to_tuple() for mirror in index.sites.values())
+		tables = index.tables()
+
+	write_mirror_cache(cache, (CACHE_VERSION, stat.st_size, stat.st_mtime_ns, new_digest, site_data, tables))
+	return index
+
+def write_mirror_cache(cache, data: tuple):
+	'atomically writes our compiled cache. Failure is not fatal, we just parse next time'
+	try:
+		cache.parent.mkdir(parents=True, exist_ok=True)
+		tmp = cache.with_name(cache.name + '.tmp')
+		tmp.write_bytes(marshal.dumps(data))
+		replace(tmp, cache)
+	except OSError as error:
+		wprint(f"unable to write mirror cache {cache}: {error}")
+
+def get_country_list(index, arch):
+	'Takes our mirror index and returns a list of countries'
+	return index.countries(arch)
+
+def get_url_list(index, country, arch):
+	'Takes our mirror index and returns a list of urls in the country we choose'
+	return index.urls(country, arch)
+
+@lru_cache(maxsize=None)
+def load_centroids(path=COUNTRY_CENTROIDS):
+	'returns a dict of country code to (latitude, longitude) from our bundled table. Read once, don\'t change what it gives back'
+	centroids = {}
+	with open(path, 'r') as file:
+		for line in file:
+			if line.startswith('#') or not line.strip():
+				continue
+			code, lat, lon = line.split()
+			centroids[code] = (float(lat), float(lon))
+	return centroids
+
+def parse_iso6709(coordinates: str):
+	'converts zone.tab coordinates such as +4230+00131 or +404251-0740023 to decimal (latitude, longitude)'
+	# Split on the sign that starts the longitude
+	split = max(coordinates.rfind('+'), coordinates.rfind('-'))
+	values = []
+	for part, degree_digits in ((coordinates[:split], 2), (coordinates[split:], 3)):
+		sign = -1 if part[0] == '-' else 1
+		digits = part[1:]
+		degrees = int(digits[:degree_digits])
+		minutes = int(digits[degree_digits:degree_digits + 2])
+		seconds = int(digits[degree_digits + 2:] or 0)
+		values.append(sign * (degrees + minutes / 60 + seconds / 3600))
+	return tuple(values)
+
+def get_timezone():
+	'returns the configured timezone such as Europe/Berlin, or None'
+	try:
+		zone = TIMEZONE_FILE.read_text().strip()
+		if zone:
+			return zone
+	except OSError:
+		pass
+	try:
+		# /etc/localtime is usually a symlink into the zoneinfo directory
+		return str(Path(readlink(LOCALTIME)).relative_to(ZONEINFO))
+	except (OSError, ValueError):
+		return None
+
+def locate_installer(index=None, country: str=None):
+	"""Works out roughly where we are without touching the network
+
+	In order of preference this uses the country we were given, the timezone and the locale.
+	country may be a code 'DE' or a name 'Germany'.
+
+	returns (country_code, (latitude, longitude)) or (None, None) if we can't tell
+	"""
+	centroids = load_centroids()
+
+	if country is not None:
+		code = country.upper()
+		if code not in centroids and index is not None:
+			# Look the name up in the masterlist
+			for mirror in index.sites.values():
+				if mirror.country is not None and mirror.country.lower() == country.lower():
+					code = mirror.country_code
+					break
+		if code in centroids:
+			return code, centroids[code]
+		wprint(f"unknown country {country}")
+
+	zone = get_timezone()
+	if zone is not None:
+		try:
+			with open(ZONE_TAB, 'r') as file:
+				for line in file:
+					if line.startswith('#'):
+						continue
+					fields = line.split('\t')
+					if len(fields) >= 3 and fields[2].strip() == zone:
+						return fields[0], parse_iso6709(fields[1])
+		except (OSError, ValueError, IndexError):
+			pass
+
+	# Locales look like en_US.UTF-8
+	for variable in ('LC_ALL', 'LC_MESSAGES', 'LANG'):
+		locale = environ.get(variable, '')
+		code = locale.split('.')[0].partition('_')[2].upper()
+		if code in centroids:
+			return code, centroids[code]
+
+	return None, None
+
+def distance(first: tuple, second: tuple):
+	'great circle distance in km between two (latitude, longitude) points'
+	lat1, lon1, lat2, lon2 = map(radians, (*first, *second))
+	hav = sin((lat2 - lat1) / 2)**2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2)**2
+	return 6371 * 2 * asin(sqrt(hav))
+
+def rank_by_proximity(index, site_list: list, origin: tuple):
+	"""Sorts site_list by the distance from origin to the centroid of each sites country
+
+	Sites without a known country go last. Sites in the same country keep their masterlist order.
+	"""
+	centroids = load_centroids()
+	def key(site):
+		mirror = index.get(site)
+		if mirror is None or mirror.country_code not in centroids:
+			return float('inf')
+		return distance(origin, centroids[mirror.country_code])
+	return sorted(site_list, key=key)
+
+def rank_countries(index, arch: str, origin: tuple):
+	'returns the countries with a mirror for arch, closest to origin first'
+	centroids = load_centroids()
+	codes = {}
+	for site in index.by_arch.get(arch, []):
+		mirror = index.get(site)
+		if mirror.country is not None:
+			codes[mirror.country] = mirror.country_code
+	def key(country):
+		code = codes.get(country)
+		if code not in centroids:
+			return (float('inf'), country)
+		return (distance(origin, centroids[code]), country)
+	return sorted(index.countries(arch), key=key)
+
+class probe_result(object):
+	"""Object representing the outcome of probing a mirror
+
+	connect, first and fetch are in seconds.
+	first is the time from the request to the first byte, fetch from the request to the last byte.
+	"""
+	__slots__ = ('site', 'connect', 'first', 'fetch', 'status', 'error', 'body', '_fields')
+
+	def __init__(self, site: str):
+		self.site = site
+		self.connect = None
+		self.first = None
+		self.fetch = None
+		self.status = None
+		self.error = None
+		self.body = None
+		self._fields = None
+
+	@property
+	def fields(self):
+		'the body parsed as a Release file. Empty if the probe failed'
+		if self._fields is None:
+			self._fields = parse_release(self.body) if self.healthy and self.body else {}
+		return self._fields
+
+	@property
+	def date(self):
+		'the Date: of the Release file as an aware datetime, or None'
+		return parse_release_date(self.fields.get('Date'))
+
+	@property
+	def valid_until(self):
+		'the Valid-Until: of the Release file as an aware datetime, or None'
+		return parse_release_date(self.fields.get('Valid-Until'))
+
+	@property
+	def healthy(self):
+		return self.error is None and self.status == 200
+
+	@property
+	def latency(self):
+		'connect plus fetch time, or None if the probe failed'
+		if not self.healthy:
+			return None
+		return self.connect + self.fetch
+
+	@property
+	def rate(self):
+		'sustained transfer rate in MB/s once the first byte arrived, or None if the probe failed'
+		# A range request answers with 206. Some mirrors ignore the range and send 200
+		if self.error is not None or self.status not in (200, 206) or not self.body:
+			return None
+		return len(self.body) / 1024**2 / max(self.fetch - self.first, 1e-6)
+
+def parse_release(data: bytes):
+	"""Parses the top level fields of a Release or InRelease file into a dict
+
+	Multiline fields such as SHA256 are kept as their raw text.
+	"""
+	fields = {}
+	key = None
+	lines = data.decode(errors='replace').splitlines()
+	# InRelease is clearsigned. Skip the armor header which ends at the first empty line
+	if lines and lines[0].startswith('-----BEGIN PGP SIGNED MESSAGE'):
+		lines = lines[lines.index('') + 1:] if '' in lines else []
+	for line in lines:
+		if line.startswith('-----BEGIN PGP SIGNATURE'):
+			break
+		if line[:1] in (' ', '\t'):
+			if key is not None:
+				fields[key] += '\n' + line.strip()
+			continue
+		key, sep, value = line.partition(':')
+		if not sep:
+			key = None
+			continue
+		fields[key] = value.strip()
+	return fields
+
+def parse_release_date(value: str):
+	'converts a Release date such as "Sat, 14 Aug 2021 08:57:09 UTC" to an aware datetime'
+	if not value:
+		return None
+	try:
+		date = parsedate_to_datetime(value)
+	except (TypeError, ValueError):
+		return None
+	if date.tzinfo is None:
+		date = date.replace(tzinfo=timezone.utc)
+	return date
+
+def split_site(site: str):
+	'returns (host, port) from a site. Sites may carry a port, mostly for testing against local servers'
+	host, sep, port = site.rpartition(':')
+	if sep and port.isdigit() and not host.endswith(']'):
+		return host, int(port)
+	return site, 80
+
+def archive_path(index, site: str):
+	'returns where site keeps the archive, from Archive-http in the masterlist. \'/debian/\' if we don\'t know the site'
+	mirror = index.get(site) if index is not None else None
+	return mirror.http if mirror is not None else '/debian/'
+
+def release_path(index, site: str, release: str, name: str='InRelease'):
+	'returns the path to a file in dists/<release>/ on site'
+	return f"{archive_path(index, site)}dists/{release}/{name}"
+
+def http_get(site: str, path: str, timeout: float=PROBE_TIMEOUT, headers: dict=None, limit: int=None):
+	"""Fetches path from site over plain http and times it
+
+	timeout is a hard limit for the whole request, not just each socket operation.
+	limit stops reading after that many bytes.
+
+	returns a probe_result with the body attached
+	"""
+	result = probe_result(site)
+	host, port = split_site(site)
+	request_headers = {'User-Agent': 'volian', 'Connection': 'close'}
+	if headers:
+		request_headers.update(headers)
+
+	start = perf_counter()
+	connection = HTTPConnection(host, port, timeout=timeout)
+	try:
+		connection.connect()
+		result.connect = perf_counter() - start
+
+		sent = perf_counter()
+		connection.request('GET', path, headers=request_headers)
+		response = connection.getresponse()
+		result.first = perf_counter() - sent
+		result.status = response.status
+		body = bytearray()
+		while limit is None or len(body) < limit:
+			chunk = response.read(65536 if limit is None else min(65536, limit - len(body)))
+			if not chunk:
+				break
+			body += chunk
+			if perf_counter() - start > timeout:
+				raise TimeoutError(f"exceeded {timeout}s")
+		result.fetch = perf_counter() - sent
+		result.body = bytes(body)
+	except (OSError, HTTPException) as error:
+		result.error = str(error) or type(error).__name__
+	finally:
+		connection.close()
+	return result
+
+def probe_mirrors(site_list: list, release: str, index=None, jobs: int=PROBE_JOBS, timeout: float=PROBE_TIMEOUT):
+	"""Probes every site in site_list concurrently by fetching dists/<release>/InRelease
+
+	Arguments:
+		site_list: list of sites to probe. 'host' or 'host:port'
+		release: the release we're going to install, 'stable' or 'focal'
+		index: mirror_index used to find the archive path of each site. '/debian/' is assumed without it
+		jobs: how many probes may run at once
+		timeout: hard limit in seconds for each probe
+
+	Results are cached for the run, a mirror that was already probed for release isn't contacted again.
+
+	returns a list of probe_result. healthy mirrors first, fastest to slowest
+	"""
+	def probe(site):
+		result = _release_cache.get((site, release))
+		if result is None:
+			result = http_get(site, release_path(index, site, release), timeout)
+			_release_cache[(site, release)] = result
+		return result
+
+	with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(site_list)))) as pool:
+		results = list(pool.map(probe, site_list))
+
+	healthy = sorted((result for result in results if result.healthy), key=lambda result: result.latency)
+	failed = [result for result in results if not result.healthy]
+	return healthy + failed
+
+def filter_stale(results: list, release: str, index=None,
+		max_lag: float=MAX_MIRROR_LAG_H, reference: str=DEBIAN_ORG):
+	"""Splits probe results into fresh and stale mirrors
+
+	A mirror is stale if its InRelease Date lags the reference by more than max_lag hours,
+	if its Valid-Until has passed or if it has no Date at all.
+	When the reference can't be reached the newest Date among the results is used instead.
+
+	returns (fresh, stale). Order of results is kept, failed probes are in neither
+	"""
+	healthy = [result for result in results if result.healthy]
+	reference_date = probe_mirrors([reference], release, index)[0].date
+	if reference_date is None:
+		dates = [result.date for result in healthy if result.date is not None]
+		if not dates:
+			return healthy, []
+		reference_date = max(dates)
+
+	oldest = reference_date - timedelta(hours=max_lag)
+	now = datetime.now(timezone.utc)
+	fresh = []
+	stale = []
+	for result in healthy:
+		date = result.date
+		valid_until = result.valid_until
+		if date is None or date < oldest or (valid_until is not None and valid_until < now):
+			stale.append(result)
+		else:
+			fresh.append(result)
+	return fresh, stale
+
+def print_probe_results(results: list):
+	'prints our probe results as a table'
+	col_width = max([len(result.site) for result in results] + [len('Mirror:')]) + 1
+	print("Mirror:".ljust(col_width), "Connect:".ljust(10), "Fetch:".ljust(10), "Status:")
+	for result in results:
+		if result.healthy:
+			print(
+				result.site.ljust(col_width),
+				f"{result.connect * 1000:.0f} ms".ljust(10),
+				f"{result.fetch * 1000:.0f} ms".ljust(10),
+				result.status
+			)
+		else:
+			print(result.site.ljust(col_width), "-".ljust(10), "-".ljust(10), result.error or result.status)
+
+def bench_mirrors(site_list: list, release: str, arch: str, index=None,
+		size: int=meg_to_byte(BENCH_SIZE_M), jobs: int=BENCH_JOBS, timeout: float=BENCH_TIMEOUT):
+	"""Measures the bandwidth of each site by pulling the first size bytes of Packages.xz
+
+	Arguments:
+		site_list: list of sites to benchmark. Keep this short, these are real downloads
+		release: the release we're going to install
+		arch: the architecture we're going to install
+		index: mirror_index used to find the archive path of each site
+		size: how many bytes to request from each site
+		jobs: how many sites to download from at once
+		timeout: hard limit in seconds for each download
+
+	returns a list of probe_result. fastest sustained rate first
+	"""
+	def bench(site):
+		path = release_path(index, site, release, f"main/binary-{arch}/Packages.xz")
+		return http_get(site, path, timeout, {'Range': f"bytes=0-{size - 1}"}, limit=size)
+
+	with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(site_list)))) as pool:
+		results = list(pool.map(bench, site_list))
+
+	working = sorted((result for result in results if result.rate is not None), key=lambda result: result.rate, reverse=True)
+	failed = [result for result in results if result.rate is None]
+	return working + failed
+
+def print_bench_results(results: list):
+	'prints our bandwidth results as a table'
+	col_width = max([len(result.site) for result in results] + [len('Mirror:')]) + 1
+	print("Mirror:".ljust(col_width), "Size:".ljust(10), "Time:".ljust(10), "Rate:")
+	for result in results:
+		if result.rate is not None:
+			print(
+				result.site.ljust(col_width),
+				f"{len(result.body) / 1024**2:.2f} MB".ljust(10),
+				f"{result.fetch:.2f} s".ljust(10),
+				f"{result.rate:.2f} MB/s"
+			)
+		else:
+			print(result.site.ljust(col_width), "-".ljust(10), "-".ljust(10), result.error or result.status)
+
+def auto_mirror(index, arch: str, release: str, site_list: list=None,
+		top: int=BENCH_TOP, size: int=meg_to_byte(BENCH_SIZE_M), jobs: int=BENCH_JOBS,
+		max_lag: float=MAX_MIRROR_LAG_H):
+	"""Probes mirrors and returns the fastest healthy site
+
+	Mirrors are ranked by latency first and anything stale is dropped. The top fastest are then
+	benchmarked for bandwidth and the one with the best sustained rate wins. A top of 0 skips the bandwidth stage.
+
+	site_list defaults to every mirror that carries arch. Falls back to deb.debian.org if nothing usable answers
+
+	returns (site, ranked) where ranked is the list of fresh healthy probe results
+	"""
+	if site_list is None:
+		site_list = index.by_arch.get(arch, [])
+	print(f"probing {len(site_list)} mirrors..")
+	results = probe_mirrors(site_list, release, index)
+	print_probe_results(results)
+
+	results, stale = filter_stale(results, release, index, max_lag)
+	for result in stale:
+		wprint(f"{result.site} is out of date. dropping it")
+	if not results:
+		wprint(f"no usable mirror answered in time. using {DEBIAN_ORG}")
+		return DEBIAN_ORG, results
+	best = results[0]
+	print(f"fastest mirror is {best.site} at {best.latency * 1000:.0f} ms")
+
+	candidates = [result.site for result in results[:top]]
+	if len(candidates) > 1:
+		print(f"benchmarking bandwidth of the {len(candidates)} fastest mirrors..")
+		bench_results = bench_mirrors(candidates, release, arch, index, size, jobs)
+		print_bench_results(bench_results)
+		if bench_results[0].rate is not None:
+			best = bench_results[0]
+			print(f"best bandwidth is {best.site} at {best.rate:.2f} MB/s")
+			# Put the winner at the front so the ranking we hand back agrees with our pick
+			results.sort(key=lambda result: result.site != best.site)
+
+	return best.site, results
+
+def probe_country(index, arch: str, release: str, country: str,
+		max_lag: float=MAX_MIRROR_LAG_H, reference: str=DEBIAN_ORG):
+	"""Probes the mirrors in country that carry arch and prints how they did
+
+	This is the cheap check for when the user picks a mirror. One InRelease from each, nothing is benchmarked.
+	reference is what the mirrors are checked against for freshness, see filter_stale
+
+	returns the fresh healthy probe results, fastest first. Empty if nothing usable answered
+	"""
+	site_list = get_url_list(index, country, arch)
+	print(f"probing the {len(site_list)} mirrors in {country}..")
+	results = probe_mirrors(site_list, release, index)
+	print_probe_results(results)
+	results, stale = filter_stale(results, release, index, max_lag, reference)
+	for result in stale:
+		wprint(f"{result.site} is out of date. leaving it out")
+	return results
+
+def stripe_mirrors(arch: str, release: str, first: tuple, count: int,
+		max_lag: float=MAX_MIRROR_LAG_H, country: str=None):
+	"""Returns up to count mirrors to spread downloads over, first always leads
+
+	first is the (site, archive path) choose_mirror gave us. The others are the fastest fresh mirrors
+	close to us. Mirrors probed earlier in the run aren't probed again.
+
+	returns a list of (site, archive path)
+	"""
+	index = load_mirror_index()
+	site_list = index.by_arch.get(arch, [])
+	code, origin = locate_installer(index, country)
+	if origin is not None:
+		site_list = rank_by_proximity(index, site_list, origin)[:PROBE_NEAREST]
+	results, stale = filter_stale(probe_mirrors(site_list, release, index), release, index, max_lag)
+
+	others = [(result.site, archive_path(index, result.site)) for result in results if result.site != first[0]]
+	return ([first] + others)[:count]
 
 # Our main function for choosing a mirror that will be called upon in the main file.
-def choose_mirror(arch):
-	master_list = parse_mirror_master()
+def choose_mirror(arch, release='stable', mirror=None,
+		top: int=BENCH_TOP, size: int=meg_to_byte(BENCH_SIZE_M), jobs: int=BENCH_JOBS,
+		max_lag: float=MAX_MIRROR_LAG_H, country: str=None):
+	"""Returns the site we'll be installing from and where it keeps the archive
+
+	Arguments:
+		arch: the architecture we are installing. 'amd64'
+		release: the release we are installing. Used for probing mirrors
+		mirror: None to ask the user, 'auto' to pick the fastest mirror,
+			'nearest' to pick the closest mirror without probing, otherwise the site to use.
+			A site may carry its archive path, 'ftp.example.org/pub/debian/'
+		top, size, jobs: how many mirrors auto benchmarks for bandwidth, bytes to pull from each and how many at once
+		max_lag: hours a mirror may lag deb.debian.org before we drop it
+		country: where we are. Code or name. Worked out from the timezone or locale when None
+
+	returns (site, archive path). ('deb.debian.org', '/debian/')
+	"""
+	index = load_mirror_index()
+	if mirror not in (None, 'auto', 'nearest'):
+		site, sep, path = mirror.partition('/')
+		path = path.strip('/')
+		return site, f"/{path}/" if path else archive_path(index, site)
+	site = _choose_site(index, arch, release, mirror, top, size, jobs, max_lag, country)
+	return site, archive_path(index, site)
+
+def _choose_site(index, arch, release, mirror, top, size, jobs, max_lag, country):
+	'asks for, probes or looks up the site for choose_mirror'
+	code, origin = locate_installer(index, country)
+	if code is not None:
+		print(f"we appear to be in {code}")
+
+	if mirror == 'nearest':
+		if origin is None:
+			wprint(f"unable to tell where we are. using {DEBIAN_ORG}")
+			return DEBIAN_ORG
+		ranked = rank_by_proximity(index, index.by_arch.get(arch, []), origin)
+		if not ranked:
+			wprint(f"no mirror carries {arch}. using {DEBIAN_ORG}")
+			return DEBIAN_ORG
+		print(f"closest mirror is {ranked[0]}")
+		return ranked[0]
+
+	if mirror == 'auto':
+		site_list = index.by_arch.get(arch, [])
+		# Only bother probing mirrors that are close to us
+		if origin is not None:
+			site_list = rank_by_proximity(index, site_list, origin)[:PROBE_NEAREST]
+		url, results = auto_mirror(index, arch, release, site_list, top, size, jobs, max_lag)
+		return url
+
 	if ask("the default repository is 'deb.debian.org'\nwould you like to choose a mirror"):
 		
 		while True:
-			country_list = get_country_list(master_list, arch)
+			# Closest countries go first when we know where we are
+			if origin is not None:
+				country_list = rank_countries(index, arch, origin)
+			else:
+				country_list = get_country_list(index, arch)
 			country = ask_list(country_list, 'country')
-			url_list = get_url_list(master_list, country, arch)
-			url = ask_list(url_list, 'mirror')
+
+			# Rank the countries mirrors for the user so they aren't picking blind
+			# This is only the latency probe. Benchmarking bandwidth is for auto
+			results = probe_country(index, arch, release, country, max_lag)
+			if not results:
+				wprint(f"none of the mirrors in {country} answered in time")
+				if ask("would you like to choose another country"):
+					continue
+				wprint(f"substituting {DEBIAN_ORG} as nothing in {country} answered")
+				return DEBIAN_ORG
+			url = results[0].site
+			if ask(f"{url} answered fastest\nwould you like to use it"):
+				return url
+			url = ask_list([result.site for result in results], 'mirror')
 			return url
 	else:
 		url = DEBIAN_ORG
@@ -0,0 +1,494 @@
+# This file is part of volian
+
+# volian is an installer for Debian or Ubuntu.
+# Copyright (C) 2021 Volitank
+
+# volian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# volian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with volian.  If not, see <https://www.gnu.org/licenses/>.
+
+if __name__ == "__main__":
+	print("native isn't intended to be run directly.. exiting")
+	exit(1)
+
+import tarfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from hashlib import md5, sha256
+from http.client import HTTPException
+from io import BytesIO
+from os import environ, replace, unlink
+from os.path import dirname, islink, ismount, realpath
+from pathlib import Path
+from subprocess import CalledProcessError, run, PIPE
+from threading import Lock, Thread
+from time import perf_counter
+from urllib.parse import urlsplit
+
+from mirror import parse_release
+from proxy import mirror_pool
+from packages import package_index, write_index
+from bootstrap import deb_name, file_hash, seed
+from chroot import chroot_mounts
+from utils import byte_to_gig_trunc, shell
+from constant import (	APT_ARCHIVES, ARCHIVE_KEYRINGS, DPKG_INFO, DPKG_STATUS, ESTIMATE_HEADROOM, NATIVE_JOBS, POLICY_RC_D,
+						STAGING_DIR, STRIPE_TIMEOUT, UNPACK_JOBS
+						)
+
+## Notes on how to use this module.
+## A python replacement for debootstrap. Packages are downloaded at once, dpkg installs the essential set,
+## the rest is unpacked in parallel after its preinst, and then dpkg configures them all in one pass
+## A failed install() empties the target again and raises native_error, so debootstrap can take over
+# native = native_bootstrap('debian', 'stable', 'http://deb.debian.org/debian', 'amd64')
+# native.install(ROOT_DIR)
+## prepare() does everything that doesn't need the disk, so it can be started early
+# native.start()
+## Anything that goes wrong in prepare() is a native_error, and debootstrap can be used instead
+## estimate_install uses the same index to tell how much space an install will need
+# estimate_install('debian', 'stable', 'http://deb.debian.org/debian', 'amd64', extra=['sudo'])
+
+# merged /usr. These are symlinks into usr before anything is unpacked, as debootstrap does it
+MERGED_USR = ('bin', 'sbin', 'lib', 'lib64')
+
+# What dpkg unpacks first out of the essential set, as debootstrap does it
+EARLY = ('base-passwd', 'base-files')
+
+class native_error(Exception):
+	'raised when the native bootstrap can\'t do its job. Either nothing was written to the target yet, or it was emptied again'
+
+def base_packages(index, minimal: bool=False):
+	"""Returns the packages a bootstrap installs
+
+	That is everything of Priority required, and important unless minimal, with what they depend on.
+	Like debootstrap's minbase, minimal adds apt.
+	"""
+	priorities = ('required',) if minimal else ('required', 'important')
+	names = index.select('Priority', *priorities) | index.select('Essential', 'yes')
+	if minimal and 'apt' in index:
+		names.add('apt')
+	return index.closure(names)
+
+def estimate_install(distro: str, release: str, url: str, arch: str, minimal: bool=False,
+		extra: list=(), standard: bool=True):
+	"""Predicts how much space an install takes. returns a dict of mount path to bytes
+
+	What the bootstrap installs, extra and the standard task are closed over their dependencies
+	and their Installed-Size added up. With merged /usr almost all of that lands in /usr.
+	/var holds the apt lists, and the debs while apt has them.
+
+	raises native_error if we can't get the index
+	"""
+	# Its own staging so it can't trip over a bootstrap downloading at the same time
+	bootstrap = native_bootstrap(distro, release, url, arch, minimal, staging=STAGING_DIR / 'estimate')
+	parts = urlsplit(url)
+	pool = mirror_pool(parts.netloc, parts.path, 1, STRIPE_TIMEOUT)
+	try:
+		bootstrap.select(pool)
+	except (OSError, HTTPException, CalledProcessError, ValueError) as error:
+		raise native_error(str(error) or type(error).__name__)
+	finally:
+		pool.close()
+
+	index = bootstrap.index
+	wanted = list(extra)
+	if standard:
+		# tasksel's standard task is every package of Priority standard
+		wanted.extend(index.select('Priority', 'standard'))
+	names = set(bootstrap.packages) | index.closure(wanted)
+	installed = index.installed_size(names)
+	var = index.download_size(names) + index.path.stat().st_size
+	print(f"{len(names)} packages take {byte_to_gig_trunc(installed)} GB installed")
+	return {'/usr': int(installed * ESTIMATE_HEADROOM), '/var': int(var * ESTIMATE_HEADROOM)}
+
+def read_ar(path: str):
+	'yields (name, data) for each member of an ar archive. A .deb is one'
+	with open(path, 'rb') as file:
+		if file.read(8) != b'!<arch>\n':
+			raise native_error(f"{path} isn't a deb")
+		while True:
+			header = file.read(60)
+			if len(header) < 60:
+				return
+			name = header[:16].decode().strip().rstrip('/')
+			size = int(header[48:58])
+			data = file.read(size)
+			# Members are padded to an even size
+			if size % 2:
+				file.read(1)
+			yield name, data
+
+def open_member(path: str, name: str, data: bytes):
+	'returns a tarfile for a control or data member of a deb'
+	if name.endswith('.zst'):
+		# The standard library can't do zstd. dpkg-deb can
+		option = '--ctrl-tarfile' if name.startswith('control') else '--fsys-tarfile'
+		data = run(['dpkg-deb', option, path], stdout=PIPE, check=True).stdout
+	return tarfile.open(fileobj=BytesIO(data), mode='r:*')
+
+def member_path(name: str):
+	'returns a tar member name the way dpkg lists it. "./usr/bin/" becomes "/usr/bin" and "./" becomes "/."'
+	if name.startswith('./'):
+		name = name[2:]
+	elif name == '.':
+		name = ''
+	path = '/' + name.strip('/')
+	return '/.' if path == '/' else path
+
+def unpack_control(deb: str, root: str, info_name: str):
+	"""Writes the control files of a deb into dpkg's info directory as info_name.<file>
+
+	Runs in a worker process. The maintainer scripts are in place after this, so preinst can run before the payload is extracted.
+
+	returns (control stanza, conffiles)
+	"""
+	members = dict(read_ar(deb))
+	control_name = next(name for name in members if name.startswith('control.tar'))
+
+	info = Path(root) / DPKG_INFO
+	control = ''
+	conffiles = []
+	with open_member(deb, control_name, members[control_name]) as tar:
+		for member in tar.getmembers():
+			if not member.isfile():
+				continue
+			name = member_path(member.name)[1:]
+			content = tar.extractfile(member).read()
+			if name == 'control':
+				control = content.decode(errors='replace').strip('\n')
+				continue
+			if name == 'conffiles':
+				# Newer dpkg can put flags such as remove-on-upgrade before the path
+				conffiles = [line.split()[-1] for line in content.decode().splitlines() if line.strip()]
+			target = info / f"{info_name}.{name}"
+			target.write_bytes(content)
+			target.chmod(member.mode)
+	return control, conffiles
+
+def unpack_data(deb: str, root: str, conffiles: list=()):
+	"""Extracts the payload of a deb into root the way dpkg --unpack would, without running anything
+
+	Runs in a worker process.
+
+	returns (list of files, conffiles with their md5)
+	"""
+	root_real = realpath(root)
+	members = dict(read_ar(deb))
+	data_name = next(name for name in members if name.startswith('data.tar'))
+
+	files = []
+	with open_member(deb, data_name, members[data_name]) as tar:
+		for member in tar:
+			path = member_path(member.name)
+			files.append(path)
+			if path == '/.':
+				continue
+			dest = root + path
+			# Never follow a symlink out of the target
+			parent = realpath(dirname(dest))
+			if parent != root_real and not parent.startswith(root_real + '/'):
+				raise native_error(f"{member.name} in {deb} would land outside {root}")
+			# Write over a symlink instead of through it
+			if not member.isdir() and islink(dest):
+				unlink(dest)
+			if hasattr(tarfile, 'fully_trusted_filter'):
+				tar.extract(member, root, numeric_owner=True, filter='fully_trusted')
+			else:
+				tar.extract(member, root, numeric_owner=True)
+
+	sums = []
+	for conffile in conffiles:
+		try:
+			sums.append((conffile, md5(Path(root + conffile).read_bytes()).hexdigest()))
+		except OSError:
+			sums.append((conffile, 'newconffile'))
+	return files, sums
+
+def clear_target(root: Path):
+	"""Empties root so debootstrap can start over in it
+
+	Anything mounted below root is emptied but stays mounted, and lost+found is kept.
+	"""
+	for path in Path(root).iterdir():
+		if path.name == 'lost+found':
+			continue
+		if path.is_dir() and not path.is_symlink():
+			clear_target(path)
+			if not ismount(path):
+				path.rmdir()
+		else:
+			path.unlink()
+
+def status_stanza(control: str, conffiles: list):
+	'turns a control stanza into a dpkg status stanza for an unpacked package'
+	lines = control.splitlines()
+	lines.insert(1, 'Status: install ok unpacked')
+	if conffiles:
+		lines.append('Conffiles:')
+		lines.extend(f" {path} {digest}" for path, digest in conffiles)
+	return '\n'.join(lines)
+
+class native_bootstrap(object):
+	"""Bootstraps a release into a target without debootstrap
+
+	The Packages index is checked against an InRelease verified with the archive keyring.
+	Every package is downloaded at once over a pool of keep alive connections and checked against its SHA256.
+	dpkg installs the essential set, the rest is unpacked by a pool of processes after its preinst ran,
+	and dpkg configures all of them in a single pass.
+
+	Arguments:
+		distro, release, url, arch: what to bootstrap and from where
+		minimal: required packages and apt only, like debootstrap's minbase
+		cache: a package_cache to download into and reuse packages from
+		jobs: how many packages to download at once
+		staging: where packages go when there is no cache
+	"""
+	def __init__(self, distro: str, release: str, url: str, arch: str, minimal: bool=False,
+			cache=None, jobs: int=NATIVE_JOBS, staging: Path=STAGING_DIR):
+		self.distro = distro
+		self.release = release
+		self.url = url
+		self.arch = arch
+		self.minimal = minimal
+		self.cache = cache
+		self.jobs = jobs
+		self.dir = cache.dir if cache is not None else Path(staging) / f"native-{distro}-{release}-{arch}"
+		self.index = None
+		self.packages = {}
+		self.debs = {}
+		self.timings = {}
+		self.error = None
+		self._done = False
+		self._lock = Lock()
+
+	def start(self):
+		'runs prepare in the background'
+		print("downloading packages in the background")
+		Thread(target=self._prepare_quietly, daemon=True).start()
+		return self
+
+	def _prepare_quietly(self):
+		try:
+			self.prepare()
+		except native_error:
+			pass
+
+	def prepare(self):
+		"""Works out what to install and downloads it. Safe to call from several threads, it only runs once
+
+		raises native_error if we can't
+		"""
+		with self._lock:
+			if not self._done:
+				try:
+					self._prepare()
+				except native_error as error:
+					self.error = error
+				except (OSError, HTTPException, CalledProcessError, ValueError) as error:
+					self.error = native_error(str(error) or type(error).__name__)
+				finally:
+					self._done = True
+		if self.error is not None:
+			raise self.error
+
+	def _prepare(self):
+		if self.cache is not None:
+			self.cache.prepare()
+		parts = urlsplit(self.url)
+		pool = mirror_pool(parts.netloc, parts.path, self.jobs, STRIPE_TIMEOUT)
+		try:
+			start = perf_counter()
+			self.select(pool)
+			self.timings['index'] = perf_counter() - start
+			print(f"bootstrapping {len(self.packages)} packages")
+
+			start = perf_counter()
+			with ThreadPoolExecutor(max_workers=max(1, self.jobs)) as executor:
+				self.debs = dict(zip(self.packages, executor.map(lambda name: self.download(pool, name), self.packages)))
+			self.timings['download'] = perf_counter() - start
+		finally:
+			pool.close()
+
+	def select(self, pool):
+		'fetches the index and works out what we bootstrap'
+		self.dir.mkdir(parents=True, exist_ok=True)
+		self.index = package_index(self.fetch_index(pool))
+		names = base_packages(self.index, self.minimal)
+		self.packages = {name: self.index[name] for name in sorted(names)}
+
+	def fetch_index(self, pool):
+		'returns the path of the decompressed Packages file for main, checked against a verified InRelease'
+		status, inrelease = pool.get(f"dists/{self.release}/InRelease")
+		if status != 200:
+			raise native_error(f"unable to get the InRelease for {self.release}. status {status}")
+		self.verify_inrelease(inrelease)
+
+		hashes = {}
+		for line in parse_release(inrelease).get('SHA256', '').splitlines():
+			parts = line.split()
+			if len(parts) == 3:
+				hashes[parts[2]] = parts[0]
+
+		for extension in ('.xz', '.gz', ''):
+			name = f"main/binary-{self.arch}/Packages{extension}"
+			if name not in hashes:
+				continue
+			status, body = pool.get(f"dists/{self.release}/{name}")
+			if status != 200:
+				continue
+			if sha256(body).hexdigest() != hashes[name]:
+				raise native_error(f"{name} doesn't match the InRelease")
+			return write_index(body, extension, self.dir / f"{self.release}_{self.arch}_Packages")
+		raise native_error(f"no Packages index for {self.arch} in {self.release}")
+
+	def verify_inrelease(self, inrelease: bytes):
+		'checks the InRelease signature with the archive keyring'
+		keyring = ARCHIVE_KEYRINGS.get(self.distro)
+		if keyring is None or not keyring.exists():
+			raise native_error(f"no archive keyring for {self.distro}. install {self.distro}-archive-keyring")
+		signed = self.dir / f"{self.release}.InRelease"
+		signed.write_bytes(inrelease)
+		try:
+			shell.gpgv('--keyring', keyring, signed)
+		except CalledProcessError:
+			raise native_error(f"the InRelease for {self.release} isn't signed by {keyring.name}")
+
+	def download(self, pool, name: str):
+		'returns the path of the verified deb for name, downloading it if we don\'t have it'
+		fields = self.packages[name]
+		deb = self.dir / deb_name(name, fields['Version'], fields.get('Architecture', self.arch))
+		if deb.exists() and file_hash(deb) == fields['SHA256']:
+			return deb
+		status, body = pool.get(fields['Filename'])
+		if status != 200:
+			raise native_error(f"unable to download {fields['Filename']}. status {status}")
+		if sha256(body).hexdigest() != fields['SHA256']:
+			raise native_error(f"{fields['Filename']} doesn't match its SHA256")
+		tmp = deb.with_name(deb.name + '.part')
+		tmp.write_bytes(body)
+		replace(tmp, deb)
+		return deb
+
+	def info_name(self, name: str):
+		'dpkg keeps Multi-Arch: same packages under name:arch'
+		fields = self.packages[name]
+		if fields.get('Multi-Arch') == 'same':
+			return f"{name}:{fields.get('Architecture', self.arch)}"
+		return name
+
+	def install(self, root: Path, shell=shell):
+		"""Installs into root. prepare() is run first if it hasn't been
+
+		Like debootstrap, the essential set is extracted so the target can run anything at all.
+		dpkg then installs the essential set and what it depends on for real, so their preinsts run before their payload.
+		Everything else has its preinst run and is then extracted by a pool of processes.
+		dpkg configures the rest in one pass at the end.
+
+		raises native_error if it fails. root is emptied again first, so debootstrap can be used instead
+		returns a dict of phase name to seconds
+		"""
+		self.prepare()
+		root = Path(root)
+		try:
+			self._install(root, shell)
+		except (native_error, CalledProcessError, OSError, RuntimeError) as error:
+			clear_target(root)
+			raise native_error(f"unable to install into {root}: {str(error) or type(error).__name__}")
+
+		if self.cache is not None:
+			self.cache.update(root)
+		print("native bootstrap: " + ', '.join(f"{phase} {seconds:.2f}s" for phase, seconds in self.timings.items()))
+		return self.timings
+
+	def _install(self, root: Path, shell=shell):
+		self.setup_root(root)
+
+		# The essential set and everything it needs is configured before any other preinst runs.
+		# base-passwd and base-files lay down what the other preinsts expect, so dpkg gets them first
+		essential = [name for name in self.packages if self.packages[name].get('Essential') == 'yes']
+		core = sorted(self.index.closure(essential) & set(self.packages),
+						key=lambda name: (EARLY.index(name) if name in EARLY else len(EARLY), name))
+		rest = [name for name in self.packages if name not in core]
+
+		start = perf_counter()
+		with ProcessPoolExecutor(max_workers=max(1, UNPACK_JOBS)) as executor:
+			extracted = [executor.submit(unpack_data, str(self.debs[name]), str(root)) for name in essential]
+			controls = {name: executor.submit(unpack_control, str(self.debs[name]), str(root), self.info_name(name))
+						for name in rest}
+			for future in extracted:
+				future.result()
+			controls = {name: future.result() for name, future in controls.items()}
+		self.timings['extract'] = perf_counter() - start
+
+		env = dict(environ, DEBIAN_FRONTEND='noninteractive', DEBCONF_NONINTERACTIVE_SEEN='true', LC_ALL='C',
+					PATH='/usr/sbin:/usr/bin:/sbin:/bin')
+		# Services must not start in the target
+		policy = root / POLICY_RC_D
+		policy.write_text("#!/bin/sh\n# Written by volian while it bootstraps\nexit 101\n")
+		policy.chmod(0o755)
+		try:
+			with chroot_mounts(root, shell):
+				start = perf_counter()
+				# The debs go where apt keeps them, as debootstrap leaves them
+				archives = root / APT_ARCHIVES
+				for name in core:
+					seed(self.debs[name], archives / self.debs[name].name)
+				shell.chroot(root, 'dpkg', '--force-depends', '--unpack',
+							*(f"/{APT_ARCHIVES / self.debs[name].name}" for name in core), env=env)
+				shell.chroot(root, 'dpkg', '--configure', '-a', '--force-depends', env=env)
+				self.timings['essential'] = perf_counter() - start
+
+				start = perf_counter()
+				for name in rest:
+					preinst = DPKG_INFO / f"{self.info_name(name)}.preinst"
+					if (root / preinst).exists():
+						shell.chroot(root, f"/{preinst}", 'install', env=self.maintscript_env(env, name, 'preinst'))
+				stanzas = []
+				with ProcessPoolExecutor(max_workers=max(1, UNPACK_JOBS)) as executor:
+					futures = {name: executor.submit(unpack_data, str(self.debs[name]), str(root), controls[name][1])
+								for name in rest}
+					for name, future in futures.items():
+						files, conffiles = future.result()
+						(root / DPKG_INFO / f"{self.info_name(name)}.list").write_text('\n'.join(files) + '\n')
+						stanzas.append(status_stanza(controls[name][0], conffiles))
+				# dpkg already has the core set in the status file
+				status = root / DPKG_STATUS
+				stanzas.insert(0, status.read_text().strip('\n'))
+				status.write_text('\n\n'.join(stanza for stanza in stanzas if stanza) + '\n')
+				self.timings['unpack'] = perf_counter() - start
+
+				start = perf_counter()
+				shell.chroot(root, 'dpkg', '--configure', '-a', '--force-depends', env=env)
+				self.timings['configure'] = perf_counter() - start
+		finally:
+			if policy.exists():
+				policy.unlink()
+
+	def maintscript_env(self, env: dict, name: str, script: str):
+		'returns env with what dpkg tells a maintainer script about itself. dpkg-maintscript-helper won\'t run without it'
+		return dict(env,
+			DPKG_MAINTSCRIPT_NAME=script,
+			DPKG_MAINTSCRIPT_PACKAGE=name,
+			DPKG_MAINTSCRIPT_ARCH=self.packages[name].get('Architecture', self.arch),
+			DPKG_MAINTSCRIPT_PACKAGE_REFCOUNT='1',
+		)
+
+	def setup_root(self, root: Path):
+		'lays out merged /usr and an empty dpkg database'
+		root.mkdir(parents=True, exist_ok=True)
+		for name in MERGED_USR:
+			(root / 'usr' / name).mkdir(parents=True, exist_ok=True)
+			link = root / name
+			if not link.exists() and not link.is_symlink():
+				link.symlink_to(f"usr/{name}")
+		for path in (DPKG_INFO, DPKG_INFO.parent / 'updates', DPKG_INFO.parent / 'triggers', DPKG_INFO.parent / 'alternatives'):
+			(root / path).mkdir(parents=True, exist_ok=True)
+		(root / DPKG_INFO.parent / 'available').touch()
+		(root / DPKG_STATUS).touch()
@@ -27,8 +27,8 @@ import requests
 import re
 
 from logger import eprint, wprint
-from utils import ask, ask_list, shell, DEFAULT
-from constant import RESOLV_CONF, SUBNET_MASK_DICT, INTERFACES_FILE, INTERFACE_HEADER
+from utils import ask, ask_list, target_path, shell, DEFAULT
+from constant import RESOLV_CONF, SUBNET_MASK_DICT, INTERFACES_FILE, INTERFACE_HEADER, ROOT_DIR
 
 # Initially we are only going to support ethernet.
 # I want to get this finished but wifi will be a feature we'll add in the future.
@@ -194,7 +194,7 @@ def configure_static_network(interface, ip, subnet_mask, gateway, domain=None, s
 
 	with RESOLV_CONF.open('w') as file:
 		file.write(f"nameserver {nameserver}\n")
-		if search is not False:
+		if search:
 			file.write(f"search {search}\n")
 
 	if test_network():
@@ -274,7 +274,13 @@ def configure_dhcp_network(interface):
 
 		return False
 
-def initial_network_configuration():
+def initial_network_configuration(network: dict=None):
+	"""Sets up the network for the installer and returns the network tuple
+
+	network is the network from an answer file. With it nothing is asked and we exit if it doesn't work.
+	"""
+	if network is not None:
+		return answer_network_configuration(network)
 	print()
 	# Print a new line to add some separation and notify the user of some things.
 	wprint("only a wired ethernet connection is supported at the moment")
@@ -308,7 +314,24 @@ def initial_network_configuration():
 			sleep(2)
 			continue
 
-def write_interface_file(network_tuple):
+def answer_network_configuration(network: dict):
+	'configures the network from an answer file. answers.py has already checked it'
+	interface = network.get('interface') or define_interface()
+	if network['mode'] == 'dhcp':
+		if configure_dhcp_network(interface):
+			print("connection secured. continuing")
+			return 'dhcp', interface
+	else:
+		ip, subnet, gateway = network['ip'], network['subnet'], network['gateway']
+		domain, search, nameserver = network['domain'], network['search'], network['nameserver']
+		if configure_static_network(interface, ip, subnet, gateway, domain, search, nameserver):
+			print("connection secured. continuing")
+			return ip, subnet, gateway, domain, search, nameserver, interface
+
+	eprint(f"unable to configure {interface} with the network from the answer file.. exiting")
+	exit(1)
+
+def write_interface_file(network_tuple, root: Path=ROOT_DIR):
 	if network_tuple[0] == 'dhcp':
 		static = False
 		mode = 'dhcp'
@@ -331,7 +354,7 @@ def write_interface_file(network_tuple):
 	f"\tgateway {gateway}\n"
 	f"\tdns-namesever {nameserver}\n"
 	)	
-	with open(INTERFACES_FILE, 'w') as file:
+	with open(target_path(root, INTERFACES_FILE), 'w') as file:
 		file.write(INTERFACE_HEADER)
 		file.write(write_interface)
 		if static:
@@ -21,7 +21,7 @@ from pydoc import pager
 from pathlib import Path
 from sys import stderr, argv
 
-from constant import RELEASE_OPTIONS, LICENSE
+from constant import RELEASE_OPTIONS, LICENSE, MASTERLIST_URL, PACKAGE_CACHE_G, MKFS_JOBS, MOUNT_PROFILES, STAGE_JOBS, FLEET_JOBS, BENCH_TOP, BENCH_JOBS, BENCH_SIZE_M, MAX_MIRROR_LAG_H, VOLIAN_JOURNAL
 
 # Custom Parser for printing help on error.
 class volianParser(argparse.ArgumentParser):
@@ -83,6 +83,32 @@ def arg_parse():
 	# Taking out --no-part for now. We won't be using it at the moment and likely will remove it completely in the future. Not sure
 #	parser.add_argument('--no-part', action="store_true", help="using this switch will skip partitioning")
 	parser.add_argument('--minimal', action='store_true', help="uses the variant=minbase on the backend of debootstrap. Only use this if you're sure you want it")
+	parser.add_argument('--mirror', metavar='<site|auto|nearest>', help="use this mirror for debian, site or site/archive/path/. auto probes the mirrors and picks the fastest. nearest picks the closest without probing")
+	parser.add_argument('--country', metavar='country', help="the country we're in, code or name. used to find close mirrors. default is worked out from the timezone")
+	parser.add_argument('--bench-top', type=int, default=BENCH_TOP, metavar='K', help=f"benchmark the bandwidth of the K fastest mirrors. 0 disables it. default {BENCH_TOP}")
+	parser.add_argument('--bench-size', type=int, default=BENCH_SIZE_M, metavar='MiB', help=f"how much to download from each mirror when benchmarking. default {BENCH_SIZE_M}")
+	parser.add_argument('--bench-jobs', type=int, default=BENCH_JOBS, metavar='N', help=f"how many mirrors to benchmark at once. default {BENCH_JOBS}")
+	parser.add_argument('--max-lag', type=float, default=MAX_MIRROR_LAG_H, metavar='hours', help=f"drop mirrors that are more than this far behind deb.debian.org. default {MAX_MIRROR_LAG_H}")
+	parser.add_argument('--masterlist-url', default=MASTERLIST_URL, metavar='url', help="where to refresh the debian mirror list from")
+	parser.add_argument('--no-mirror-update', action='store_true', help="don't refresh the debian mirror list, use the copy we have")
+	parser.add_argument('--stripe', type=int, default=0, metavar='N', help="spread debian package downloads over the N best mirrors through a local proxy")
+	parser.add_argument('--cache-dir', type=Path, metavar='dir', help="keep downloaded packages here and reuse them on later installs. local disk or a mounted share")
+	parser.add_argument('--cache-size', type=float, default=PACKAGE_CACHE_G, metavar='GB', help=f"how big each package cache may get. default {PACKAGE_CACHE_G}")
+	parser.add_argument('--tarball-dir', type=Path, metavar='dir', help="bootstrap from a tarball kept here. it is built on the first install and rebuilt when the mirror moves on")
+	parser.add_argument('--pipeline', action='store_true', help="download packages in the background while the disk is being set up")
+	parser.add_argument('--native', action='store_true', help="bootstrap with volian's parallel bootstrap instead of debootstrap. debootstrap is used if it fails. --tarball-dir is ignored")
+	parser.add_argument('--discard', action='store_true', help="discard the whole disk before partitioning it so used flash starts out clean. spinning disks are skipped")
+	parser.add_argument('--mount-profile', choices=MOUNT_PROFILES, help="fstab options. tuned picks them for each filesystem and the disk under it, defaults is plain defaults. default tuned")
+	parser.add_argument('--mkfs-jobs', type=int, default=MKFS_JOBS, metavar='N', help=f"how many filesystems to make at once. default {MKFS_JOBS}")
+	parser.add_argument('--jobs', type=int, default=STAGE_JOBS, metavar='N', help=f"how many install stages may run at once. default {STAGE_JOBS}")
+	parser.add_argument('--no-standard', action='store_true', help="don't install the standard task. things like manpages, bash-completion and ssh won't be there")
+	parser.add_argument('--safe-io', action='store_true', help="let dpkg fsync every file in the chroot. slower, but useful to compare against")
+	parser.add_argument('--config', type=Path, metavar='file', help="install without asking anything, using the answers in this json file")
+	parser.add_argument('--fleet', nargs='+', type=Path, metavar='disk|image', help="install to all of these at once. needs --config. image files are attached to loop devices")
+	parser.add_argument('--image-size', type=float, metavar='GB', help="make fleet image files that don't exist yet this big. they are sparse")
+	parser.add_argument('--fleet-jobs', type=int, default=FLEET_JOBS, metavar='N', help=f"how many fleet targets to install to at once. default {FLEET_JOBS}")
+	parser.add_argument('--fresh', action='store_true', help="ignore the journal of an unfinished install and start over")
+	parser.add_argument('--journal', type=Path, metavar='file', help=f"where to keep the journal that lets an install resume. put it somewhere that survives a reboot. default is beside the answer file, or {VOLIAN_JOURNAL}")
 	parser.add_argument('--version', action='version', version=f'{bin_name} {version}')
 	parser.add_argument('--release-options', action=releaseOptions)
 	parser.add_argument('--license', action=GPLv3)
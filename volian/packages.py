@@ -0,0 +1,289 @@
+# This file is part of volian
+
+# volian is an installer for Debian or Ubuntu.
+# Copyright (C) 2021 Volitank
+
+# volian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# volian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with volian.  If not, see <https://www.gnu.org/licenses/>.
+
+if __name__ == "__main__":
+	print("packages isn't intended to be run directly.. exiting")
+	exit(1)
+
+import bz2
+import gzip
+import lzma
+import re
+from bisect import bisect_right
+from collections.abc import Mapping
+from io import BytesIO
+from mmap import mmap, ACCESS_READ
+from os import replace
+from pathlib import Path
+from shutil import copyfileobj
+
+from logger import wprint
+
+## Notes on how to use this module.
+## A Packages file is memory mapped and only the offset of each stanza is kept.
+## Fields are read from the map when they are asked for
+# index = package_index(Path('/var/lib/volian/Packages'))
+# index['apt']['Version']
+## Everything a set of packages needs, without parsing every stanza into a dict
+# names = index.closure(['sudo', 'lvm2'])
+# base = index.closure(index.select('Priority', 'required', 'important'))
+# index.installed_size(base)
+## Compressed indexes are decompressed to disk a chunk at a time
+# write_index(body, '.xz', Path('/var/lib/volian/Packages'))
+
+OPEN_COMPRESSED = {'.xz': lzma.open, '.gz': gzip.open, '.bz2': bz2.open}
+
+# Stanzas are split on a blank line. 'Package:' is normally the first field, but doesn't have to be
+STANZA_END = re.compile(rb'\n\n+')
+PACKAGE_FIELD = re.compile(rb'^Package:[ \t]*(\S+)', re.M)
+
+def write_index(body: bytes, extension: str, path: Path):
+	'decompresses a downloaded index into path without holding the decompressed copy in memory'
+	path = Path(path)
+	tmp = path.with_name(path.name + '.part')
+	with open(tmp, 'wb') as file:
+		if extension:
+			with OPEN_COMPRESSED[extension](BytesIO(body)) as source:
+				copyfileobj(source, file, 1024 * 1024)
+		else:
+			file.write(body)
+	replace(tmp, path)
+	return path
+
+def parse_depends(value: str):
+	"""Splits a Depends field into a list of alternatives
+
+	'libc6 (>= 2.14), debconf | debconf-2.0' becomes [['libc6'], ['debconf', 'debconf-2.0']]
+	Versions and arch qualifiers are dropped. We install the one version the index has.
+	"""
+	depends = []
+	for group in value.split(','):
+		names = [option.split('(')[0].split('[')[0].strip().split(':')[0] for option in group.split('|')]
+		names = [name for name in names if name]
+		if names:
+			depends.append(names)
+	return depends
+
+class package_stanza(Mapping):
+	"""The fields of one package, read out of the map the first time one is asked for
+
+	It acts like the dict of fields it would be if we had parsed it.
+	"""
+	def __init__(self, index, start: int, end: int):
+		self._index = index
+		self._start = start
+		self._end = end
+		self._fields = None
+
+	def __repr__(self):
+		return f"package_stanza({self.get('Package')!r})"
+
+	def _parse(self):
+		if self._fields is None:
+			fields = {}
+			key = None
+			for line in self._index.map[self._start:self._end].decode(errors='replace').splitlines():
+				if line[:1] in (' ', '\t'):
+					if key is not None:
+						fields[key] += '\n' + line
+					continue
+				key, sep, value = line.partition(':')
+				if not sep:
+					key = None
+					continue
+				fields[key] = value.strip()
+			self._fields = fields
+		return self._fields
+
+	def __getitem__(self, key: str):
+		return self._parse()[key]
+
+	def __iter__(self):
+		return iter(self._parse())
+
+	def __len__(self):
+		return len(self._parse())
+
+	def raw(self):
+		'returns the stanza as it is in the index'
+		return self._index.map[self._start:self._end].decode(errors='replace')
+
+class package_index(Mapping):
+	"""A Packages file that is memory mapped instead of read
+
+	Only a name to stanza offset index is built. A 50MB index costs a few MB of memory rather than a few hundred,
+	and the page cache does the rest. Looking up one field of a package doesn't parse the others.
+
+	Arguments:
+		path: a decompressed Packages file
+	"""
+	def __init__(self, path: Path):
+		self.path = Path(path)
+		self._file = open(self.path, 'rb')
+		try:
+			# mmap can't map an empty file
+			self.map = mmap(self._file.fileno(), 0, access=ACCESS_READ) if self.path.stat().st_size else b''
+		except (OSError, ValueError):
+			self._file.close()
+			raise
+		self.offsets = {}
+		self._starts = []
+		self._ends = []
+		self._names = []
+		self._provides = None
+		self._stanzas = {}
+		self._build()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		self._stanzas = {}
+		if isinstance(self.map, mmap):
+			self.map.close()
+		self._file.close()
+
+	def _build(self):
+		'finds where each stanza starts and ends, and the name of its package'
+		start = 0
+		size = len(self.map)
+		while start < size:
+			match = STANZA_END.search(self.map, start)
+			end = match.start() if match else size
+			name = PACKAGE_FIELD.search(self.map, start, end)
+			if name is not None:
+				# A name that shows up twice keeps its last stanza, as apt would
+				name = name.group(1).decode()
+				self.offsets[name] = (start, end)
+				self._starts.append(start)
+				self._ends.append(end)
+				self._names.append(name)
+			if match is None:
+				break
+			start = match.end()
+
+	def __getitem__(self, name: str):
+		stanza = self._stanzas.get(name)
+		if stanza is None:
+			start, end = self.offsets[name]
+			stanza = self._stanzas[name] = package_stanza(self, start, end)
+		return stanza
+
+	def __iter__(self):
+		return iter(self.offsets)
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def __contains__(self, name):
+		return name in self.offsets
+
+	def _owner(self, offset: int):
+		'returns the name of the package whose stanza holds offset'
+		position = bisect_right(self._starts, offset) - 1
+		if position < 0 or offset >= self._ends[position]:
+			return None
+		name = self._names[position]
+		# Only the stanza the index kept for a name counts
+		if self.offsets[name][0] != self._starts[position]:
+			return None
+		return name
+
+	def field(self, name: str, key: str, default=None):
+		'returns one field of name, only parsing that line'
+		start, end = self.offsets[name]
+		match = re.compile(rb'^' + re.escape(key.encode()) + rb':[ \t]*(.*)$', re.M).search(self.map, start, end)
+		if match is None:
+			return default
+		return match.group(1).decode(errors='replace').strip()
+
+	def _lines(self, key: str, value: bytes=rb'[^\n]*'):
+		"""Yields (package name, value) for every line in the map that sets key
+
+		We look for a newline rather than using ^ so re can skip ahead to the key. That is about ten times faster.
+		"""
+		pattern = re.compile(rb'\n' + re.escape(key.encode()) + rb':[ \t]*(' + value + rb')[ \t]*(?=\n|$)')
+		# The first line of the file has no newline in front of it
+		line_end = self.map.find(b'\n')
+		first = pattern.match(b'\n' + self.map[:line_end if line_end != -1 else len(self.map)])
+		if first is not None and self._owner(0) is not None:
+			yield self._owner(0), first.group(1).decode(errors='replace')
+		for match in pattern.finditer(self.map):
+			name = self._owner(match.start() + 1)
+			if name is not None:
+				yield name, match.group(1).decode(errors='replace')
+
+	def select(self, key: str, *values: str):
+		'returns the names of every package with key set to one of values. Only the matching lines are read'
+		values = b'|'.join(re.escape(value.encode()) for value in values)
+		return {name for name, value in self._lines(key, values)}
+
+	def provides(self):
+		'returns a dict of virtual package to the packages that provide it'
+		if self._provides is None:
+			provides = {}
+			for name, value in self._lines('Provides'):
+				for provided in parse_depends(value):
+					provides.setdefault(provided[0], []).append(name)
+			self._provides = provides
+		return self._provides
+
+	def depends(self, name: str):
+		'returns the Pre-Depends and Depends of name as lists of alternatives'
+		return parse_depends(self.field(name, 'Pre-Depends', '')) + parse_depends(self.field(name, 'Depends', ''))
+
+	def installed_size(self, names):
+		'returns how many bytes names take once installed. Installed-Size is in KiB'
+		return sum(int(self.field(name, 'Installed-Size') or 0) for name in names) * 1024
+
+	def download_size(self, names):
+		'returns how many bytes the debs of names come to'
+		return sum(int(self.field(name, 'Size') or 0) for name in names)
+
+	def closure(self, names):
+		"""Returns names and everything they depend on, as a set
+
+		Alternatives go to the first one we have, real or provided. Anything we can't satisfy is warned about and skipped.
+		Only the dependency lines of the packages we reach are read.
+		"""
+		closure = set()
+		missing = set()
+		pending = [name for name in names if name in self.offsets]
+		while pending:
+			name = pending.pop()
+			if name in closure:
+				continue
+			closure.add(name)
+			for group in self.depends(name):
+				if any(option in closure for option in group):
+					continue
+				for option in group:
+					if option in self.offsets:
+						pending.append(option)
+						break
+					if option in self.provides():
+						pending.append(sorted(self.provides()[option])[0])
+						break
+				else:
+					missing.add(' | '.join(group))
+		if missing:
+			wprint(f"nothing provides {', '.join(sorted(missing))}")
+		return closure
@@ -21,21 +21,30 @@ if __name__ == "__main__":
 	exit(1)
 
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from os import PathLike
+from os.path import ismount
 from pathlib import Path
-from time import sleep
+from time import perf_counter, sleep
 from typing import Union
 
 
 from logger import eprint 
-from constant import FILESYSTEMS, FSTAB_FILE, FSTAB_HEADER, ROOT_DIR, BOOT_DIR, EFI_DIR
-from utils import byte_to_gig_trunc, ask, meg_to_byte, gig_to_byte, ask_list, shell, DEFAULT
+from constant import FILESYSTEMS, FSTAB_FILE, FSTAB_HEADER, ROOT_DIR, BOOT_DIR, EFI_DIR, MKFS_JOBS, LVM_EXTENT, DISCARD_JOBS, DISCARD_SPLIT
+from topology import disk_topology, extents, lcm
+from tuning import mkfs_options, mount_options
+from utils import byte_to_gig_trunc, ask, meg_to_byte, gig_to_byte, ask_list, target_path, shell, DEFAULT
 
-def define_partitions():
-	"""Main function for defining partitions. Takes no arguments and returns a list of tuples, disk, and the space left on disk
+def define_partitions(disk: Path=None, layout: list=None, estimate: dict=None, profile: str='tuned'):
+	"""Main function for defining partitions. Returns a list of tuples, disk, and the space left on disk
 
 	tuples contain (path, size, filesystem). space_left is in bytes
+	With disk and a layout of (path, size, filesystem) from an answer file nothing is asked.
+	estimate is what the install needs, as mount path to bytes. Layouts it won't fit in are refused.
+	profile is the mount option profile each partition gets. See MOUNT_PROFILES
 	"""
+	if layout is not None:
+		return answer_partitions(disk, layout, estimate, profile)
 	while True:
 		# We wrap the entire function in a try except to handle Ctrl+C
 		# Which wil restart the function
@@ -45,7 +54,8 @@ def define_partitions():
 			# No print is so we don't print the partition layout more than once if we configure custom parts.
 			_no_print = False
 			disk = choose_disk()
-			true_size = (float(Path(f"/sys/block/{disk.name}/size").read_text()) * 512)
+			# What is left once the partition table and alignment have had theirs
+			true_size = disk_topology(disk).usable()
 			#space_left = true_size - (ESP_SIZE_M + BOOT_SIZE_M)
 			space_left = true_size
 			# When using our installer defining root, esp and boot are not optional
@@ -100,7 +110,8 @@ def define_partitions():
 						break
 
 					# Print our layout to the user so they can check it over
-					print_part_layout(part_list, space_left)
+					set_mount_options(part_list, disk, profile)
+					print_part_layout(part_list, space_left, estimate)
 					_no_print = True
 
 					# Ask them if they want to restart the loop, break if they don't
@@ -109,9 +120,21 @@ def define_partitions():
 
 			if _restart_switch:
 				continue
+			set_mount_options(part_list, disk, profile)
 			if not _no_print:
 				# Print our layout to the user so they can check it over
-				print_part_layout(part_list, space_left)
+				print_part_layout(part_list, space_left, estimate)
+
+			# Finding out now beats debootstrap running out of space halfway through
+			errors = layout_fits(part_list, space_left, estimate)
+			if errors:
+				print()
+				for error in errors:
+					eprint(error)
+				eprint("restarting partitioner..\n")
+				sleep(2)
+				print()
+				continue
 
 			if ask("Is this layout okay"):
 				# Iterate through the list and bring 100%FREE to the last
@@ -128,6 +151,67 @@ def define_partitions():
 			sleep(2)
 			continue
 
+def answer_partitions(disk: Path, layout: list, estimate: dict=None, profile: str='tuned'):
+	'builds our partitions from an answer file layout. answers.py has already checked it, apart from the estimate'
+	space_left = disk_topology(disk).usable()
+	part_list = []
+	for path, size, filesystem in layout:
+		part_list.append(new_partition(path, size, filesystem, disk))
+		if size != '100%FREE':
+			space_left = space_left - size
+	# 100%FREE has to be last for LVM creation
+	part_list.sort(key=lambda partition: partition.size == '100%FREE')
+	set_mount_options(part_list, disk, profile)
+	print_part_layout(part_list, space_left, estimate)
+	return part_list, disk, space_left
+
+def set_mount_options(part_list: list, disk: Path, profile: str):
+	'picks the fstab options of every partition for profile and the kind of disk they are on'
+	rotational = disk_topology(disk).rotational
+	for partition in part_list:
+		partition.options = mount_options(partition.filesystem, profile, rotational, partition.name == 'root')
+
+def part_device(disk: PathLike, number: int):
+	'returns the device for partition number of disk. Disks whose name ends in a digit, like loop0 or nvme0n1, put a p in between'
+	disk = str(disk)
+	if disk[-1].isdigit():
+		return Path(f"{disk}p{number}")
+	return Path(f"{disk}{number}")
+
+def disk_size(disk: Path):
+	'returns the size of disk in bytes. sysfs counts in 512 byte units whatever the sector size is'
+	return int(Path(f"/sys/block/{disk.name}/size").read_text()) * 512
+
+def discard_disk(disk: Path, jobs: int=DISCARD_JOBS, shell=shell):
+	"""Tells flash that everything on disk is free, so it doesn't have to garbage collect it under our writes
+
+	Disks bigger than DISCARD_SPLIT are discarded in jobs ranges at once.
+	Spinning disks and disks that can't discard are skipped.
+
+	returns how many seconds it took
+	"""
+	topology = disk_topology(disk)
+	if topology.rotational:
+		print(f"{disk} is a spinning disk. not discarding")
+		return 0
+	if not topology.discard:
+		print(f"{disk} doesn't support discard. not discarding")
+		return 0
+
+	count = max(1, jobs) if topology.size > DISCARD_SPLIT else 1
+	# Ranges start and end on the discard granularity, the last one takes the rest
+	step = lcm(topology.discard_granularity, topology.logical)
+	length = topology.size // count // step * step
+	ranges = [(number * length, length if number < count - 1 else topology.size - number * length) for number in range(count)]
+
+	print(f"discarding {byte_to_gig_trunc(topology.size)} GB on {disk} in {count} ranges")
+	start = perf_counter()
+	with ThreadPoolExecutor(max_workers=count) as pool:
+		list(pool.map(lambda span: shell.blkdiscard('--offset', str(span[0]), '--length', str(span[1]), disk), ranges))
+	seconds = perf_counter() - start
+	print(f"discarding {disk} took {seconds:.2f}s")
+	return seconds
+
 def choose_disk():
 	'Asks user for block device. Returns Path object'
 	# There may be a better way of getting disks that are applicable but for now this works.
@@ -186,33 +270,12 @@ def ask_part_size(part_path: str, size: int, disk=None):
 					eprint(f"{human_part_size} GB is more than you have left.. try again")
 			else:
 				continue
-			# Now we can iterate through our paths an generate an LV name based on it
-			# For boot_efi and boot these names are only for identification
-			# Let us name root appropriately 
-			if str(part_path) == '/':
-				lv_name = 'root'
-			# Incase someone tries to create a root home this won't break anything
-			elif str(part_path) == '/root':
-				lv_name = 'roothome'
-			# Everything else will be named according to their path minus the first slash
-			# All remaining slashes will be replaced with an underscore '/srv/volian' becomes 'srv_volian'
-			else:
-				lv_name = str(part_path).lstrip('/').replace('/', '_')
-
-			# Handle our special efi and boot scenarios	
-			boot = None
-			efi = None
-
-			if lv_name == 'boot_efi':
-				efi = Path(str(disk)+'1')
+			if str(part_path).rstrip('/') == '/boot/efi':
 				filesystem = 'fat32'
 			else:
 				filesystem = ask_list(FILESYSTEMS, 'filesystem')
-			
-			if lv_name == 'boot':
-				boot = Path(str(disk)+'2')
 
-			part_object = partition(part_path, part_size, filesystem, lv_name, efi, boot)
+			part_object = new_partition(part_path, part_size, filesystem, disk)
 			try:
 				return part_object, (size - part_size)
 			except TypeError:
@@ -221,11 +284,65 @@ def ask_part_size(part_path: str, size: int, disk=None):
 		except ValueError:
 			eprint(f"that isn't a valid number")
 
-def print_part_layout(part_list: list, space_left: int):
+def new_partition(part_path: Path, part_size, filesystem: str, disk: Path=None):
+	'returns a partition for part_path with its LV name worked out from the path'
+	# Now we can iterate through our paths an generate an LV name based on it
+	# For boot_efi and boot these names are only for identification
+	# Let us name root appropriately 
+	if str(part_path) == '/':
+		lv_name = 'root'
+	# Incase someone tries to create a root home this won't break anything
+	elif str(part_path) == '/root':
+		lv_name = 'roothome'
+	# Everything else will be named according to their path minus the first slash
+	# All remaining slashes will be replaced with an underscore '/srv/volian' becomes 'srv_volian'
+	else:
+		lv_name = str(part_path).lstrip('/').replace('/', '_')
+
+	# Handle our special efi and boot scenarios	
+	boot = None
+	efi = None
+
+	if lv_name == 'boot_efi':
+		efi = part_device(disk, 1)
+	if lv_name == 'boot':
+		boot = part_device(disk, 2)
+
+	return partition(part_path, part_size, filesystem, lv_name, efi, boot)
+
+def predicted_usage(part_list: list, estimate: dict):
+	"""Returns how many bytes of estimate each partition gets, as a dict of partition name to bytes
+
+	Each path in estimate lands on the partition mounted closest to it. '/usr' is on '/' unless there is a '/usr'.
+	"""
+	usage = {partition.name: 0 for partition in part_list}
+	if not estimate:
+		return usage
+	for path, size in estimate.items():
+		path = Path(path)
+		owners = [partition for partition in part_list
+					if Path(partition.path) == path or Path(partition.path) in path.parents]
+		if owners:
+			owner = max(owners, key=lambda partition: len(Path(partition.path).parts))
+			usage[owner.name] += size
+	return usage
+
+def layout_fits(part_list: list, space_left: int, estimate: dict):
+	'returns a list of errors for each partition the estimate doesn\'t fit in. Empty if it all fits or there is no estimate'
+	errors = []
+	usage = predicted_usage(part_list, estimate)
+	for partition in part_list:
+		size = space_left if partition.size == '100%FREE' else partition.size
+		if usage[partition.name] > size:
+			errors.append(f"{partition.path} needs about {byte_to_gig_trunc(usage[partition.name])} GB "
+						f"but only has {byte_to_gig_trunc(size)} GB")
+	return errors
+
+def print_part_layout(part_list: list, space_left: int, estimate: dict=None):
 	"""Takes a list of tuples and prints the layout
 
 	Tupels in the list should consist of (path, size, filesystem)
-	
+	With an estimate what the install will put on each partition is shown as well.
 	"""
 	# Print our layout to the user so they can check it over
 
@@ -240,11 +357,18 @@ def print_part_layout(part_list: list, space_left: int):
 	# Define the width of our columns plus a pad using the largest size from our list
 	col_width = max(column_list) + 1
 
+	usage = predicted_usage(part_list, estimate)
+	# Options can run long, so they get a column of their own width
+	options_width = max(len(str(partition.options or 'defaults')) for partition in part_list)
+	options_width = max(options_width, len("Options:")) + 1
+
 	# Print our header
 	print(
 		"Mount:".ljust(col_width),
 		"Filesystem:".ljust(col_width),
 		"Size:".ljust(col_width),
+		"Options:".ljust(options_width),
+		"Needs:" if estimate else '',
 	)
 	# Iterate through the part list once more
 	for partition in part_list:
@@ -257,10 +381,12 @@ def print_part_layout(part_list: list, space_left: int):
 		print(
 			str(partition.path).ljust(col_width),
 			str(partition.filesystem).ljust(col_width),
-			str(byte_to_gig_trunc(size))+' GB'.ljust(col_width)
+			(str(byte_to_gig_trunc(size))+' GB').ljust(col_width),
+			str(partition.options or 'defaults').ljust(options_width),
+			f"{byte_to_gig_trunc(usage[partition.name])} GB" if estimate else '',
 		)
 
-def write_fstab(boot_uuid: str, efi_uuid: str, volume: str, part_list: list):
+def write_fstab(boot_uuid: str, efi_uuid: str, volume: str, part_list: list, root: Path=ROOT_DIR):
 	"""Function for encrypting a block device.
 
 	Arguments:
@@ -268,24 +394,27 @@ def write_fstab(boot_uuid: str, efi_uuid: str, volume: str, part_list: list):
 		boot_uuid: The UUID of the boot partition. Example '8e1fdc49-4a15-41cc-bf87-799954c039ad'
 		volume: The name of the volume group. Example 'debianvg'
 		part_list: This is our list of tuples from the partition setup
+		root: where the system we are installing is mounted
 	"""
 	fstab_list = [("# <file system>","<mount point>","<type>","<options>","<dump>","<pass>")]
 
 	# This should be fine to iterate because the first three should always be in this order
 	for partition in part_list:
+		# Partitions from before there were profiles get what we always wrote
+		options = partition.options or mount_options(partition.filesystem, 'defaults', root=partition.name == 'root')
 		if partition.name == 'root':
 			iter_tupe = (
 					f"/dev/mapper/{volume}-{partition.name}",
-					str(partition.path),partition.filesystem,"errors=remount-ro","0","1")
+					str(partition.path),partition.filesystem,options,"0","1")
 		elif partition.name == 'boot':
 			iter_tupe = (f"UUID={boot_uuid}",
-						str(partition.path),partition.filesystem,"defaults","0","2")
+						str(partition.path),partition.filesystem,options,"0","2")
 		elif partition.name == 'boot_efi':
 			iter_tupe = (f"UUID={efi_uuid}",
 						str(partition.path),"vfat","umask=0077","0","1")
 		else:
 			iter_tupe = (f"/dev/mapper/{volume}-{partition.name}",
-						str(partition.path),partition.filesystem,"defaults","0","2")
+						str(partition.path),partition.filesystem,options,"0","2")
 
 		fstab_list.append(iter_tupe)
 
@@ -311,7 +440,7 @@ def write_fstab(boot_uuid: str, efi_uuid: str, volume: str, part_list: list):
 	mount_width = max(mount_list) + 1
 	options_width = max(options_list) + 1
 
-	with open(FSTAB_FILE, 'w') as fstab_file:
+	with open(target_path(root, FSTAB_FILE), 'w') as fstab_file:
 		fstab_file.write(FSTAB_HEADER)
 
 		# root, boot, efi should be in that order.
@@ -327,6 +456,66 @@ def write_fstab(boot_uuid: str, efi_uuid: str, volume: str, part_list: list):
 				file=fstab_file
 				)
 
+def get_uuid(device: PathLike):
+	'returns the filesystem UUID of device'
+	return shell.blkid._s('UUID', '-o', 'value', device, logfile=DEFAULT, capture_output=True).stdout.decode().strip()
+
+def mount_order(part_list: list):
+	"""Returns part_list in the order it has to be mounted
+
+	Parents before children. Root, then /boot, then /boot/efi and everything else by path depth.
+	"""
+	return sorted(part_list, key=lambda partition: len(Path(partition.path).parts))
+
+def format_partitions(part_list: list, volume: str, space_left: int, jobs: int=MKFS_JOBS,
+		root: Path=ROOT_DIR, shell=shell):
+	"""Creates our logical volumes, makes every filesystem and mounts them under root
+
+	lvcreate takes the volume group lock so those run one at a time. mkfs on separate
+	volumes doesn't depend on anything so up to jobs of those run at once.
+	Mounting waits for all of them and goes in mount_order.
+	A resumed install leaves alone what is already mounted. It was formatted and mkfs would refuse it anyway.
+
+	returns a dict of partition name to (mkfs seconds, mount seconds)
+	"""
+	# Now time to create our Logical Volumes from our part_list
+	for partition in part_list:
+		# We don't need boot or efi, they aren't going to be lvm
+		if partition.name != 'boot_efi' and partition.name != 'boot':
+			partition.lv_create(volume, space_left, shell)
+
+	def make(partition):
+		if ismount(partition.mount_path(root)):
+			print(f"{partition.mount_path(root)} is already formatted and mounted")
+			return partition.name, 0
+		start = perf_counter()
+		partition.mkfs(volume, shell)
+		return partition.name, perf_counter() - start
+
+	timings = {}
+	start = perf_counter()
+	with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+		for name, seconds in pool.map(make, part_list):
+			timings[name] = [seconds, 0]
+	print(f"formatting {len(part_list)} filesystems took {perf_counter() - start:.2f}s")
+
+	for partition in mount_order(part_list):
+		start = perf_counter()
+		partition.mount(volume, root, shell)
+		timings[partition.name][1] = perf_counter() - start
+
+	print_timings(part_list, timings)
+	return timings
+
+def print_timings(part_list: list, timings: dict):
+	'prints how long each partition took to format and mount'
+	col_width = max(len(str(partition.path)) for partition in part_list) + 1
+	col_width = max(col_width, len("Mount:") + 1)
+	print("Mount:".ljust(col_width), "mkfs:".ljust(10), "mount:")
+	for partition in mount_order(part_list):
+		mkfs, mount = timings[partition.name]
+		print(str(partition.path).ljust(col_width), f"{mkfs:.2f}s".ljust(10), f"{mount:.2f}s")
+
 class partition(object):
 	def __init__(self,
 			path: PathLike, size: Union[int, str], 
@@ -346,37 +535,47 @@ class partition(object):
 		self.name = name
 		self.efi = efi # Path(str(disk)+'1')
 		self.boot = boot # Path(str(disk)+'2')
+		self.options = None # fstab options. See set_mount_options
 
-	def lv_create(self, volume, space_left):
-		try:
-			print(f"creating logical volume {self.name} with {byte_to_gig_trunc(self.size)} GB")
-		except:
-			print(f"creating logical volume {self.name} with {byte_to_gig_trunc(space_left)} GB")
-
+	def lv_create(self, volume, space_left, shell=shell):
+		# A resumed install may have made this already
+		if Path(f"/dev/{volume}/{self.name}").exists():
+			print(f"logical volume {self.name} already exists")
+			return
 		if self.size == '100%FREE':
+			print(f"creating logical volume {self.name} with {byte_to_gig_trunc(space_left)} GB")
 			shell.lvcreate._n(self.name, '-l', self.size, '--yes', volume)
 		else:
-			shell.lvcreate._n(self.name, '-L', f'{int(self.size)}b', '--yes', volume)
+			# Whole extents, so the volume ends where the next one starts
+			count = extents(self.size)
+			print(f"creating logical volume {self.name} with {byte_to_gig_trunc(count * LVM_EXTENT)} GB, {count} extents")
+			shell.lvcreate._n(self.name, '-l', str(count), '--yes', volume)
 
-	def mkfs(self, volume: str=None):
+	def mkfs(self, volume: str=None, shell=shell):
 		device = f"/dev/{volume}/{self.name}"
 		# Need to change some options if we're running fat
 		if self.filesystem == 'fat32':
-			option = '-F32'
 			filesystem = 'fat'
 		else:
 			filesystem = self.filesystem
-			option = '-F'
 
 		if self.efi:
 			device = self.efi
 		if self.boot:
 			device = self.boot
 
-		print(f"making filesystem: {self.filesystem} on {device}")
-		shell(f"mkfs.{filesystem}", option, device)
+		# Tuned for what is under the volume, which sees through lvm and luks
+		options = mkfs_options(self.filesystem, disk_topology(device), shell)
+		print(f"making filesystem: {self.filesystem} on {device} with {' '.join(options)}")
+		shell(f"mkfs.{filesystem}", *options, device)
+
+	def mount_path(self, root: Path=ROOT_DIR):
+		'where we mount this under root'
+		if self.name == 'root':
+			return root
+		return root / str(self.path).lstrip('/')
 
-	def mount(self, volume: str=None):
+	def mount(self, volume: str=None, root: Path=ROOT_DIR, shell=shell):
 		device = f"/dev/{volume}/{self.name}"
 
 		if self.efi:
@@ -384,19 +583,17 @@ class partition(object):
 		if self.boot:
 			device = self.boot
 
-		if self.name == 'root':
-			if ROOT_DIR.exists():
-				eprint("/target already exists. stopping so we don't ruin anything")
-				exit(1)
-			ROOT_DIR.mkdir()
-			mount_path = ROOT_DIR
-
-		else:
-			mount_path = ROOT_DIR / str(self.path).lstrip('/')
-			if mount_path.exists():
-				eprint(f"{mount_path} already exists. stopping so we don't ruin anything")
-				exit(1)
-			mount_path.mkdir()
+		mount_path = self.mount_path(root)
+
+		# A resumed install may already have this mounted
+		if ismount(mount_path):
+			print(f"{mount_path} is already mounted")
+			return
+		# An empty directory is left behind by an interrupted install and is safe to use
+		if mount_path.exists() and any(mount_path.iterdir()):
+			eprint(f"{mount_path} already exists. stopping so we don't ruin anything")
+			exit(1)
+		mount_path.mkdir(parents=True, exist_ok=True)
 
 		print(f"mounting {device} to {mount_path}")
 		shell.mount(device, mount_path)
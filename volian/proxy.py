@@ -0,0 +1,236 @@
+# This file is part of volian
+
+# volian is an installer for Debian or Ubuntu.
+# Copyright (C) 2021 Volitank
+
+# volian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# volian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with volian.  If not, see <https://www.gnu.org/licenses/>.
+
+if __name__ == "__main__":
+	print("proxy isn't intended to be run directly.. exiting")
+	exit(1)
+
+import bz2
+import gzip
+import lzma
+from hashlib import sha256
+from http.client import HTTPConnection, HTTPException
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from itertools import count
+from queue import Empty, LifoQueue
+from socketserver import ThreadingMixIn
+from threading import BoundedSemaphore, Lock, Thread
+
+from logger import wprint
+from mirror import parse_release, split_site
+from constant import STRIPE_CONNECTIONS, STRIPE_TIMEOUT
+
+## Notes on how to use this module.
+## mirrors are (site, archive path) pairs, best first. Index files always come from the first
+# proxy = striping_proxy([('deb.debian.org', '/debian/'), ('ftp.de.debian.org', '/debian/')], '/debian')
+# url = proxy.start()
+## Hand url to debootstrap instead of http://<mirror>/debian and stop the proxy when it is done
+# proxy.stop()
+
+DECOMPRESS = {'.xz': lzma.decompress, '.gz': gzip.decompress, '.bz2': bz2.decompress}
+
+class fetch_error(Exception):
+	'raised when no mirror could give us a good copy of a file'
+
+class mirror_pool(object):
+	"""Pool of keep-alive connections to one mirror
+
+	Arguments:
+		site: 'host' or 'host:port'
+		base: archive path on the site. '/debian/'
+		size: the most connections we'll open to this mirror at once
+		timeout: socket timeout in seconds
+	"""
+	def __init__(self, site: str, base: str, size: int=STRIPE_CONNECTIONS, timeout: float=STRIPE_TIMEOUT):
+		self.site = site
+		self.base = base.rstrip('/')
+		self.timeout = timeout
+		self._idle = LifoQueue()
+		self._slots = BoundedSemaphore(size)
+
+	def _connection(self):
+		try:
+			return self._idle.get_nowait()
+		except Empty:
+			host, port = split_site(self.site)
+			return HTTPConnection(host, port, timeout=self.timeout)
+
+	def get(self, path: str):
+		'fetches path relative to the archive root. returns (status, body)'
+		with self._slots:
+			# A kept alive connection may have been closed by the mirror, so we get one retry on a fresh one
+			for attempt in range(2):
+				connection = self._connection()
+				try:
+					connection.request('GET', f"{self.base}/{path}", headers={'User-Agent': 'volian'})
+					response = connection.getresponse()
+					body = response.read()
+				except (OSError, HTTPException):
+					connection.close()
+					if attempt:
+						raise
+					continue
+				if response.will_close:
+					connection.close()
+				else:
+					self._idle.put(connection)
+				return response.status, body
+
+	def close(self):
+		while True:
+			try:
+				self._idle.get_nowait().close()
+			except Empty:
+				return
+
+class _server(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+class _handler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		proxy = self.server.proxy
+		if not self.path.startswith(proxy.prefix + '/'):
+			self.send_error(404)
+			return
+		path = self.path[len(proxy.prefix) + 1:]
+		try:
+			body = proxy.fetch(path)
+		except fetch_error as error:
+			wprint(str(error))
+			self.send_error(404)
+			return
+		self.send_response(200)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+class striping_proxy(object):
+	"""Local http proxy that spreads .deb downloads across several mirrors
+
+	Index files (anything under dists/) come from the first mirror so they are consistent with each other.
+	Their hashes are checked against the Release file, and the hashes in the Packages files
+	are then used to verify every .deb. A .deb that fails or doesn't verify is tried on the next mirror.
+
+	Arguments:
+		mirrors: list of (site, archive path) pairs, best first
+		prefix: the path debootstrap will ask for files under. '/debian'
+		connections: how many connections to keep to each mirror
+		timeout: socket timeout in seconds
+	"""
+	def __init__(self, mirrors: list, prefix: str='/debian',
+			connections: int=STRIPE_CONNECTIONS, timeout: float=STRIPE_TIMEOUT):
+		self.pools = [mirror_pool(site, base, connections, timeout) for site, base in mirrors]
+		self.prefix = '/' + prefix.strip('/')
+		self.index_hashes = {}
+		self.deb_hashes = {}
+		self.served = {pool.site: 0 for pool in self.pools}
+		self._next = count()
+		self._lock = Lock()
+		self._server = None
+
+	def start(self, address: tuple=('127.0.0.1', 0)):
+		'starts serving in the background and returns the url to hand to debootstrap'
+		self._server = _server(address, _handler)
+		self._server.proxy = self
+		Thread(target=self._server.serve_forever, daemon=True).start()
+		host, port = self._server.server_address[:2]
+		return f"http://{host}:{port}{self.prefix}"
+
+	def stop(self):
+		if self._server is not None:
+			self._server.shutdown()
+			self._server.server_close()
+			self._server = None
+		for pool in self.pools:
+			pool.close()
+
+	def fetch(self, path: str):
+		'returns the verified contents of path, relative to the archive root'
+		if path.startswith('dists/'):
+			# Always try the primary first so all our indexes come from the same snapshot
+			order = self.pools
+		else:
+			# Round robin our starting mirror for everything else
+			start = next(self._next) % len(self.pools)
+			order = self.pools[start:] + self.pools[:start]
+
+		for pool in order:
+			try:
+				status, body = pool.get(path)
+			except (OSError, HTTPException) as error:
+				wprint(f"{pool.site} failed on {path}: {error}")
+				continue
+			if status != 200:
+				continue
+			if not self.verify(path, body):
+				wprint(f"{pool.site} sent a bad copy of {path}")
+				continue
+			with self._lock:
+				self.served[pool.site] += 1
+			self.learn(path, body)
+			return body
+		raise fetch_error(f"no mirror could provide {path}")
+
+	def verify(self, path: str, body: bytes):
+		'checks body against the hashes we know. Files we have no hash for pass'
+		expected = self.deb_hashes.get(path) or self.index_hashes.get(path)
+		if expected is None:
+			return True
+		return sha256(body).hexdigest() == expected
+
+	def learn(self, path: str, body: bytes):
+		'picks the hashes out of Release and Packages files as they go past'
+		name = path.rsplit('/', 1)[-1]
+		if path.startswith('dists/') and name in ('Release', 'InRelease'):
+			suite = path[:-len(name)]
+			fields = parse_release(body)
+			hashes = {}
+			for line in fields.get('SHA256', '').splitlines():
+				parts = line.split()
+				if len(parts) == 3:
+					hashes[suite + parts[2]] = parts[0]
+			with self._lock:
+				self.index_hashes.update(hashes)
+		elif name.startswith('Packages'):
+			extension = name[len('Packages'):]
+			try:
+				data = DECOMPRESS[extension](body) if extension else body
+			except (KeyError, OSError, EOFError, lzma.LZMAError):
+				return
+			hashes = parse_package_hashes(data)
+			with self._lock:
+				self.deb_hashes.update(hashes)
+
+def parse_package_hashes(data: bytes):
+	'returns a dict of Filename to SHA256 from a Packages file'
+	hashes = {}
+	for stanza in data.split(b'\n\n'):
+		filename = digest = None
+		for line in stanza.split(b'\n'):
+			if line.startswith(b'Filename:'):
+				filename = line[9:].strip().decode()
+			elif line.startswith(b'SHA256:'):
+				digest = line[7:].strip().decode()
+		if filename and digest:
+			hashes[filename] = digest
+	return hashes
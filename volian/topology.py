@@ -0,0 +1,175 @@
+# This file is part of volian
+
+# volian is an installer for Debian or Ubuntu.
+# Copyright (C) 2021 Volitank
+
+# volian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# volian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with volian.  If not, see <https://www.gnu.org/licenses/>.
+
+if __name__ == "__main__":
+	print("topology isn't intended to be run directly.. exiting")
+	exit(1)
+
+from math import gcd
+from os import PathLike, stat, major, minor
+from pathlib import Path
+
+from constant import PART_ALIGNMENT, GPT_ENTRIES_SIZE, LVM_EXTENT
+
+## Notes on how to use this module.
+## Everything here is whole sectors of the device's logical block size. No floats
+# topology = disk_topology(Path('/dev/nvme0n1'))
+# print(topology.describe())
+## Partition starts and sizes on the alignment grain. None takes what is left
+# topology.layout([ESP_SIZE, BOOT_SIZE, None])
+## Logical volumes go by whole extents
+# extents(gig_to_byte(10))
+
+def lcm(*numbers: int):
+	'returns the least common multiple of numbers, ignoring zeros'
+	result = 1
+	for number in numbers:
+		if number:
+			result = result * number // gcd(result, number)
+	return result
+
+def sys_block(device: PathLike):
+	"""Returns the sysfs directory of device
+
+	Works for partitions and device mapper nodes as well as whole disks. Partitions use the queue of their disk.
+	"""
+	device = Path(device).resolve()
+	rdev = stat(device).st_rdev
+	sys_dev = Path(f"/sys/dev/block/{major(rdev)}:{minor(rdev)}").resolve()
+	if not (sys_dev / 'queue').exists() and (sys_dev.parent / 'queue').exists():
+		return sys_dev.parent, sys_dev
+	return sys_dev, sys_dev
+
+def read_int(path: Path, default: int=0):
+	'returns the number in a sysfs file, or default if it isn\'t there'
+	try:
+		return int(path.read_text().strip())
+	except (OSError, ValueError):
+		return default
+
+class disk_topology(object):
+	"""What a block device tells us about its layout in /sys/block/<dev>/queue
+
+	Arguments:
+		device: a disk, partition, loop or device mapper node
+
+	The grain is what every partition starts and ends on, in bytes. It is 1MiB or a multiple of it
+	that is also a multiple of the physical block size and the optimal io size, so 4Kn drives and RAID
+	stripes are both covered.
+	"""
+	def __init__(self, device: PathLike):
+		self.device = Path(device)
+		queue_dir, device_dir = sys_block(self.device)
+		queue = queue_dir / 'queue'
+		self.logical = read_int(queue / 'logical_block_size', 512)
+		self.physical = read_int(queue / 'physical_block_size', self.logical)
+		self.minimum_io = read_int(queue / 'minimum_io_size', self.physical)
+		self.optimal_io = read_int(queue / 'optimal_io_size')
+		self.alignment_offset = read_int(device_dir / 'alignment_offset')
+		self.rotational = read_int(queue / 'rotational', 1) == 1
+		self.discard_max = read_int(queue / 'discard_max_bytes')
+		self.discard_granularity = read_int(queue / 'discard_granularity')
+		# size is always in 512 byte units, whatever the logical block size is
+		self.sectors = read_int(device_dir / 'size') * 512 // self.logical
+		self.grain = lcm(PART_ALIGNMENT, self.physical, self.minimum_io, self.optimal_io)
+
+	def __repr__(self):
+		return f"disk_topology({str(self.device)!r})"
+
+	@property
+	def discard(self):
+		'whether the device takes discards'
+		return self.discard_max > 0
+
+	def stripe(self):
+		"""Returns (stripe unit, stripe width) in bytes if the device is striped, like md raid, otherwise None
+
+		RAID reports its chunk as the minimum io size and a full stripe as the optimal io size.
+		"""
+		if self.minimum_io <= self.physical or self.optimal_io <= self.minimum_io or self.optimal_io % self.minimum_io:
+			return None
+		return self.minimum_io, self.optimal_io
+
+	@property
+	def grain_sectors(self):
+		return self.grain // self.logical
+
+	@property
+	def size(self):
+		'size of the device in bytes'
+		return self.sectors * self.logical
+
+	def to_sectors(self, size: int):
+		'returns the sectors it takes to hold size bytes'
+		return -(-int(size) // self.logical)
+
+	def align_up(self, sectors: int):
+		'rounds sectors up to the grain. The alignment offset is where the device says its first aligned sector is'
+		offset = self.alignment_offset // self.logical
+		grain = self.grain_sectors
+		return -(-(sectors - offset) // grain) * grain + offset
+
+	def align_down(self, sectors: int):
+		offset = self.alignment_offset // self.logical
+		grain = self.grain_sectors
+		return (sectors - offset) // grain * grain + offset
+
+	def first_sector(self):
+		'first usable aligned sector. The primary GPT is in front of it'
+		return self.align_up(1 + 1 + GPT_ENTRIES_SIZE // self.logical)
+
+	def last_sector(self):
+		'the sector after the last usable aligned one. The backup GPT is behind it'
+		return self.align_down(self.sectors - 1 - GPT_ENTRIES_SIZE // self.logical)
+
+	def usable(self):
+		'returns the bytes that partitions can use'
+		return max(0, self.last_sector() - self.first_sector()) * self.logical
+
+	def layout(self, sizes: list):
+		"""Returns a list of (start, size) in sectors for partitions of sizes bytes, one after the other
+
+		Every start and size is on the grain. A size of None takes what is left, and has to be the last.
+		"""
+		layout = []
+		start = self.first_sector()
+		for size in sizes:
+			if size is None:
+				length = self.last_sector() - start
+			else:
+				length = self.align_up(start + self.to_sectors(size)) - start
+			if length <= 0 or start + length > self.last_sector():
+				raise ValueError(f"partitions don't fit on {self.device}")
+			layout.append((start, length))
+			start += length
+		return layout
+
+	def describe(self):
+		'returns the alignment we chose and why, for the user'
+		reasons = [f"logical {self.logical}", f"physical {self.physical}"]
+		if self.minimum_io > self.physical:
+			reasons.append(f"minimum io {self.minimum_io}")
+		if self.optimal_io:
+			reasons.append(f"optimal io {self.optimal_io}")
+		if self.alignment_offset:
+			reasons.append(f"alignment offset {self.alignment_offset}")
+		return f"{self.device}: aligning to {self.grain // 1024} KiB ({', '.join(reasons)} bytes)"
+
+def extents(size: int, extent: int=LVM_EXTENT):
+	'returns how many whole extents hold size bytes'
+	return -(-int(size) // extent)
@@ -0,0 +1,133 @@
+# This file is part of volian
+
+# volian is an installer for Debian or Ubuntu.
+# Copyright (C) 2021 Volitank
+
+# volian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# volian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with volian.  If not, see <https://www.gnu.org/licenses/>.
+
+if __name__ == "__main__":
+	print("tuning isn't intended to be run directly.. exiting")
+	exit(1)
+
+import re
+from functools import lru_cache
+
+from utils import shell, DEFAULT
+from constant import FS_BLOCK_SIZE
+
+## Notes on how to use this module.
+## Picks mkfs options from what the device under a filesystem looks like. See topology.py
+# mkfs_options('ext4', disk_topology(Path('/dev/debian/root')))
+## gives something like ['-F', '-b', '4096', '-E', 'lazy_itable_init=1,...', '-O', 'fast_commit']
+## And the fstab options for a profile, see MOUNT_PROFILES
+# mount_options('btrfs', 'tuned', rotational=False)
+
+# What each mkfs wants to be told to write over an old filesystem
+FORCE = {'fat32': '-F32', 'xfs': '-f', 'btrfs': '-f'}
+
+# Mount options of the tuned profile for each filesystem, and what flash gets on top
+MOUNT_TUNING = {
+	'ext4': ('noatime',),
+	'ext3': ('noatime',),
+	'ext2': ('noatime',),
+	'xfs': ('noatime', 'logbsize=256k'),
+	'btrfs': ('noatime', 'compress=zstd'),
+}
+MOUNT_FLASH = {
+	# Fewer journal commits, which flash has to write
+	'ext4': ('commit=60',),
+	'btrfs': ('ssd', 'discard=async'),
+}
+
+# fast_commit is in e2fsprogs 1.46 and up
+FAST_COMMIT_E2FSPROGS = (1, 46)
+
+@lru_cache(maxsize=None)
+def e2fsprogs_version(shell=shell):
+	'returns the e2fsprogs version as a tuple, or (0,) if we can\'t tell. Asked once for each shell'
+	try:
+		# The version goes to stderr
+		output = shell.mke2fs('-V', logfile=DEFAULT, capture_output=True, check=False).stderr.decode()
+	except OSError:
+		return (0,)
+	# 'mke2fs 1.46.2 (28-Feb-2021)'
+	match = re.search(r'mke2fs (\d+)\.(\d+)', output)
+	return (int(match.group(1)), int(match.group(2))) if match else (0,)
+
+def ext_options(filesystem: str, topology, shell=shell):
+	extended = []
+	stripe = topology.stripe()
+	if stripe is not None:
+		unit, width = stripe
+		extended.append(f"stride={unit // FS_BLOCK_SIZE},stripe_width={width // FS_BLOCK_SIZE}")
+	# The inode tables and journal are zeroed by the kernel after the first mount instead of by mkfs now
+	extended.append("lazy_itable_init=1,lazy_journal_init=1")
+	extended.append("discard" if topology.discard and not topology.rotational else "nodiscard")
+	options = ['-b', str(FS_BLOCK_SIZE), '-E', ','.join(extended)]
+	if filesystem == 'ext4' and e2fsprogs_version(shell) >= FAST_COMMIT_E2FSPROGS:
+		options.extend(('-O', 'fast_commit'))
+	return options
+
+def xfs_options(topology):
+	options = []
+	stripe = topology.stripe()
+	if stripe is not None:
+		unit, width = stripe
+		options.extend(('-d', f"su={unit},sw={width // unit}"))
+	if not topology.discard or topology.rotational:
+		options.append('-K')
+	return options
+
+def btrfs_options(topology):
+	# One device. Metadata is kept twice so a bad sector can't take out the tree
+	options = ['-d', 'single', '-m', 'dup']
+	if not topology.discard or topology.rotational:
+		options.append('--nodiscard')
+	return options
+
+def mkfs_options(filesystem: str, topology, shell=shell):
+	"""Returns the options for mkfs.<filesystem> on the device topology describes
+
+	That is the flag to write over whatever is there, the stripe geometry on raid, whether to discard
+	first, and for ext4 lazy init and a fast commit journal. shell is what asks mke2fs its version.
+	"""
+	options = [FORCE.get(filesystem, '-F')]
+	if filesystem in ('ext2', 'ext3', 'ext4'):
+		options.extend(ext_options(filesystem, topology, shell))
+	elif filesystem == 'xfs':
+		options.extend(xfs_options(topology))
+	elif filesystem == 'btrfs':
+		options.extend(btrfs_options(topology))
+	elif filesystem == 'ntfs':
+		# Without this mkfs.ntfs writes zeros over the whole device
+		options.append('--quick')
+	return options
+
+def mount_options(filesystem: str, profile: str='tuned', rotational: bool=True, root: bool=False):
+	"""Returns the fstab options for a filesystem mounted with profile
+
+	defaults is what we always used to write. tuned turns off atime updates and adds what
+	suits the filesystem, and flash when the disk isn't rotational.
+	"""
+	if filesystem == 'fat32':
+		return 'umask=0077'
+	options = []
+	if profile == 'tuned':
+		options.extend(MOUNT_TUNING.get(filesystem, ()))
+		if not rotational:
+			options.extend(MOUNT_FLASH.get(filesystem, ()))
+	# Only the ext filesystems know errors=
+	if root and filesystem in ('ext2', 'ext3', 'ext4'):
+		options.append('errors=remount-ro')
+	return ','.join(options) or 'defaults'
@@ -23,9 +23,10 @@ if __name__ == "__main__":
 from getpass import getpass
 from time import sleep
 from math import trunc
+from pathlib import Path
 
 from logger import eprint
-from constant import VOLIAN_LOG
+from constant import ROOT_DIR, VOLIAN_LOG
 #DEFAULT is imported just so it can be imported from utils
 from pyshell import pyshell, DEFAULT
 
@@ -109,6 +110,10 @@ def filter_input(unknown):
 		eprint("Invalid input")
 		return False
 
+def target_path(root: Path, path: Path):
+	'returns path, one of our /target constants, under root instead'
+	return Path(root) / Path(path).relative_to(ROOT_DIR)
+
 def get_password():
 	"Asks user for password, confirms it and returns it"
 	while True: